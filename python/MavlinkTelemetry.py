@@ -2,12 +2,110 @@
 
 import time
 import queue
+import select
 import logging
 import threading
+import collections
 import socket
 import serial
 import pymavlink.mavutil as mavutil
 from pymavlink.dialects.v10 import ardupilotmega as mavlink2
+from pymavlink.dialects.v20 import ardupilotmega as mavlink_v2
+from openhd import tx_scheduler
+from openhd.mavlink_parser import MavlinkParser
+from openhd.telemetry_rates import RateLimiter
+from openhd.telemetry_batch import DatagramBatcher
+from openhd.tlog import TlogRecorder
+from openhd.telemetry_state import TelemetryState
+
+# The maximum size of a MAVLink v2 frame (header + payload + crc + signature)
+MAVLINK_MAX_FRAME = 10 + 255 + 2 + 13
+
+# RC_CHANNELS_OVERRIDE values that leave a channel unchanged, and release channels 9-18
+RC_IGNORE = 65535
+RC_RELEASE_EXTENDED = 65534
+
+# The responses that complete each uplink command / parameter / mission request
+COMMAND_RESPONSES = {
+    mavlink2.MAVLINK_MSG_ID_COMMAND_LONG: (mavlink2.MAVLINK_MSG_ID_COMMAND_ACK,),
+    mavlink2.MAVLINK_MSG_ID_COMMAND_INT: (mavlink2.MAVLINK_MSG_ID_COMMAND_ACK,),
+    mavlink2.MAVLINK_MSG_ID_PARAM_SET: (mavlink2.MAVLINK_MSG_ID_PARAM_VALUE,),
+    mavlink2.MAVLINK_MSG_ID_PARAM_REQUEST_READ: (mavlink2.MAVLINK_MSG_ID_PARAM_VALUE,),
+    mavlink2.MAVLINK_MSG_ID_MISSION_REQUEST_LIST: (mavlink2.MAVLINK_MSG_ID_MISSION_COUNT,),
+    mavlink2.MAVLINK_MSG_ID_MISSION_COUNT: (mavlink2.MAVLINK_MSG_ID_MISSION_REQUEST,
+                                            mavlink2.MAVLINK_MSG_ID_MISSION_REQUEST_INT,
+                                            mavlink2.MAVLINK_MSG_ID_MISSION_ACK),
+    mavlink2.MAVLINK_MSG_ID_MISSION_ITEM: (mavlink2.MAVLINK_MSG_ID_MISSION_REQUEST,
+                                           mavlink2.MAVLINK_MSG_ID_MISSION_REQUEST_INT,
+                                           mavlink2.MAVLINK_MSG_ID_MISSION_ACK),
+    mavlink2.MAVLINK_MSG_ID_MISSION_ITEM_INT: (mavlink2.MAVLINK_MSG_ID_MISSION_REQUEST,
+                                               mavlink2.MAVLINK_MSG_ID_MISSION_REQUEST_INT,
+                                               mavlink2.MAVLINK_MSG_ID_MISSION_ACK)
+}
+
+class PendingCommand(object):
+    """An uplink request that is waiting for any one of it's responses"""
+    __slots__ = ('time', 'done')
+
+    def __init__(self, t):
+        self.time = t
+        self.done = False
+
+class CommandLatency(object):
+    """
+    Measure the round trip time from an uplink request to the matching response from the flight controller.
+    A request is queued on each of it's response types, and is completed by the first one that arrives.
+    Responses that no request is waiting for are ignored.
+    """
+
+    def __init__(self, timeout=5.0):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.outstanding = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.count = 0
+        self.timeouts = 0
+        self.rtt_sum = 0.0
+        self.rtt_max = 0.0
+
+    def request(self, msgid, t):
+        responses = COMMAND_RESPONSES.get(msgid)
+        if responses:
+            cmd = PendingCommand(t)
+            with self.lock:
+                for r in responses:
+                    self.outstanding.setdefault(r, collections.deque()).append(cmd)
+
+    def response(self, msgid, now):
+        pending = self.outstanding.get(msgid)
+        if not pending:
+            return
+        with self.lock:
+            while pending:
+                cmd = pending.popleft()
+                if cmd.done:
+                    continue
+                cmd.done = True
+                rtt = now - cmd.time
+                if rtt > self.timeout:
+                    self.timeouts += 1
+                    continue
+                self.count += 1
+                self.rtt_sum += rtt
+                self.rtt_max = max(self.rtt_max, rtt)
+                break
+
+    def expire(self, now):
+        """Count the requests that weren't answered within the timeout as timeouts, and forget them"""
+        with self.lock:
+            for pending in self.outstanding.values():
+                while pending and (pending[0].done or (now - pending[0].time) > self.timeout):
+                    cmd = pending.popleft()
+                    if not cmd.done:
+                        cmd.done = True
+                        self.timeouts += 1
 
 class MavlinkTelemetry(object):
     """
@@ -17,43 +115,69 @@ class MavlinkTelemetry(object):
 
     def __init__(self, uart = "/dev/ttyS0", baudrate = 57600,
                  host = "127.0.0.1", port = 14550,
-                 rc_host = None, rc_port = 14551):
-        self.queue = queue.Queue()
+                 max_delay = 0, rates = '',
+                 uplink_port = 14556, uplink_queue = 64, mtu = 1400, max_hold = 0.005,
+                 log_dir = None, state_socket = None):
         self.uart = uart
         self.baudrate = baudrate
         self.done = False
         self.host = host
         self.port = port
-        self.rc_host = rc_host
-        self.rc_port = rc_port
-        self.rc_chan = None
         self.thread = None
+        self.rates = RateLimiter(rates)
+        self.batcher = DatagramBatcher(mtu, max_hold)
+        self.state = TelemetryState(state_socket)
+        self.tlog = None
+        if log_dir:
+            try:
+                self.tlog = TlogRecorder(log_dir)
+            except OSError as e:
+                logging.warning("Unable to create the telemetry log in " + log_dir + ": " + str(e))
+        self.uplink_port = uplink_port
+        self.uplink = queue.Queue(maxsize=uplink_queue)
+        self.commands = CommandLatency()
+        self.uplink_bytes = 0
+        self.uplink_queue_delay = 0.0
+        self.write_lock = threading.Lock()
+
+        # RC overrides are sent as the GCS to the autopilot, which is learned from it's heartbeat
+        self.rc_mav = mavlink_v2.MAVLink(None, srcSystem=255, srcComponent=190)
+        self.target_system = 1
+
+        # Partial frames are flushed after max_delay seconds, which defaults to 1.5x the time
+        # it takes to receive the largest frame at the UART baudrate.
+        if max_delay > 0:
+            self.max_delay = max_delay
+        else:
+            self.max_delay = 1.5 * MAVLINK_MAX_FRAME * 10.0 / int(baudrate)
         try:
             # Pymavlink takes too much CPU on the zero!
             #self.mavs = mavutil.mavlink_connection(uart, baud=baudrate)
-            self.mavs = serial.Serial(uart, baudrate, timeout=0.05)
+            self.mavs = serial.Serial(uart, baudrate, timeout=0)
 
         except:
             logging.warning("Unable to start Mavlink telemetry on " + uart +
                             " at baudrate " + str(baudrate))
             return
 
-        # Create the RC receive thread
-        if rc_host:
-            self.recv_thread = threading.Thread(target = self.recv_rc)
-        else:
-            self.recv_thread = None
-
         # Start the processing threads
         self.thread = threading.Thread(target = self.start)
-        #self.send_thread = threading.Thread(target = self.start_send)
         self.thread.start()
-        #self.send_thread.start()
+        if uplink_port:
+            self.uplink_recv_thread = threading.Thread(target = self.recv_uplink, daemon=True)
+            self.uplink_write_thread = threading.Thread(target = self.write_uplink, daemon=True)
+            self.uplink_recv_thread.start()
+            self.uplink_write_thread.start()
 
     def __del__(self):
         self.done = True
+        if self.tlog:
+            self.tlog.close()
         self.join()
 
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
     def join(self):
         if self.thread:
             self.thread.join()
@@ -62,40 +186,178 @@ class MavlinkTelemetry(object):
             while 1:
                 time.sleep(1)
 
-    def recv_rc(self):
+    def set_rates(self, rates):
+        """Replace the rate policy, which the processing thread picks up on it's next pass"""
+        self.rates = RateLimiter(rates)
 
-        # Create the receive socket
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    def send_rc(self, channels):
+        """Write an RC_CHANNELS_OVERRIDE to the flight controller immediately, ahead of any queued uplink frames"""
+        values = list(channels[:18]) + [RC_IGNORE] * (18 - min(len(channels), 18))
+        self.write_frame(self.rc_mav.rc_channels_override_encode(self.target_system, 0, *values).pack(self.rc_mav))
 
-        # Find to the receive port
-        sock.bind((self.rc_host, self.rc_port))
+    def release_rc(self):
+        """Return control of all the RC channels to the flight controller's own receiver"""
+        values = [0] * 8 + [RC_RELEASE_EXTENDED] * 10
+        self.write_frame(self.rc_mav.rc_channels_override_encode(self.target_system, 0, *values).pack(self.rc_mav))
 
-        # Receive RC messages off the UDP port
-        while True:
+    def write_frame(self, frame):
+        try:
+            with self.write_lock:
+                self.mavs.write(frame)
+        except serial.SerialException as e:
+            logging.warning("Error writing to " + self.uart + ": " + str(e))
+            return
+        self.uplink_bytes += len(frame)
 
-            # Receive the next RC message
-            data, addr = sock.recvfrom(1024)
+    def start(self):
+        sched = tx_scheduler.get_scheduler()
+        parser = MavlinkParser()
+        poller = select.poll()
+        poller.register(self.mavs.fileno(), select.POLLIN)
 
-            # Unpack the channels
-            self.rc_chan = struct.unpack("<HHHHHHHHHHHHHHHH", data)
+        # The stream offset and arrival time of each block of bytes read from the UART
+        arrivals = collections.deque()
+        latency_sum = 0.0
+        latency_max = 0.0
+        frames = 0
+        deadline_flushes = 0
+        prev_report = time.monotonic()
 
-    def start(self):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         while not self.done:
-            #msg = self.mavs.recv_match(blocking=True, timeout=1.0)
-            #if msg:
-            #    self.queue.put(msg)
-            buf = self.mavs.read(1024)
-            if len(buf):
-                sock.sendto(buf, (self.host, self.port))
-
-    def start_send(self):
-        obuf = bytearray()
+
+            # Wait for data to arrive, or for the deadline of a partial / held frame or datagram to expire
+            rates = self.rates
+            batcher = self.batcher
+            if parser.pending():
+                timeout = max(0, arrivals[0][1] + self.max_delay - time.monotonic())
+            else:
+                timeout = 1.0
+            next_due = rates.next_due()
+            if next_due is not None:
+                timeout = max(0, min(timeout, next_due - time.monotonic()))
+            next_flush = batcher.deadline()
+            if next_flush is not None:
+                timeout = max(0, min(timeout, next_flush - time.monotonic()))
+            if poller.poll(timeout * 1000.0):
+                buf = self.mavs.read(self.mavs.in_waiting or 1)
+                if buf:
+                    arrivals.append((parser.base + parser.pending(), time.monotonic()))
+                    parser.feed(buf)
+
+            # Batch all the complete frames that pass the rate policy into datagrams
+            datagrams = []
+            now = time.monotonic()
+            wall = time.time()
+            while parser.parse():
+                self.commands.response(parser.msgid, now)
+                if parser.msgid == mavlink2.MAVLINK_MSG_ID_HEARTBEAT and parser.compid == mavlink2.MAV_COMP_ID_AUTOPILOT1:
+                    self.target_system = parser.sysid
+                self.state.update(parser.msgid, parser.sysid, parser.frame, now)
+                if self.tlog:
+                    self.tlog.write(parser.frame, wall)
+                if not rates.submit(parser.msgid, parser.frame, now):
+                    continue
+                while len(arrivals) > 1 and arrivals[1][0] <= parser.offset:
+                    arrivals.popleft()
+                latency = now - arrivals[0][1]
+                latency_sum += latency
+                latency_max = max(latency_max, latency)
+                frames += 1
+                datagrams += batcher.add(parser.frame, now)
+            for held in rates.due(now):
+                datagrams += batcher.add(held, now)
+
+            # Flush a partial frame that has been waiting too long
+            while len(arrivals) > 1 and arrivals[1][0] <= parser.base:
+                arrivals.popleft()
+            if parser.pending() and (now - arrivals[0][1]) >= self.max_delay:
+                datagrams += batcher.add(parser.take_pending(), now)
+                deadline_flushes += 1
+            if not parser.pending():
+                arrivals.clear()
+
+            # Send the datagrams that are full or have been held for too long
+            next_flush = batcher.deadline()
+            if next_flush is not None and now >= next_flush:
+                datagrams.append(batcher.flush(now))
+            for d in datagrams:
+                sched.sendto('telemetry', d, (self.host, self.port))
+
+            # Periodically report the forwarding latency
+            if (now - prev_report) > 2.0:
+                if frames > 0:
+                    logging.debug("telemetry: %d msgs  latency avg: %6.2f ms  max: %6.2f ms  deadline flushes: %d  bad bytes: %d  crc errors: %d" %
+                                  (frames, 1e3 * latency_sum / frames, 1e3 * latency_max, deadline_flushes,
+                                   parser.bad_bytes, parser.crc_errors))
+                batcher.report()
+                cmds = self.commands
+                cmds.expire(now)
+                if cmds.count > 0 or cmds.timeouts > 0 or self.uplink_bytes > 0:
+                    logging.debug("uplink: %d bytes  queued: %d  queue delay max: %6.2f ms  commands: %d  rtt avg: %6.2f ms  max: %6.2f ms  timeouts: %d" %
+                                  (self.uplink_bytes, self.uplink.qsize(), 1e3 * self.uplink_queue_delay, cmds.count,
+                                   1e3 * cmds.rtt_sum / cmds.count if cmds.count else 0, 1e3 * cmds.rtt_max,
+                                   cmds.timeouts))
+                    cmds.reset_stats()
+                    self.uplink_bytes = 0
+                    self.uplink_queue_delay = 0.0
+                latency_sum = 0.0
+                latency_max = 0.0
+                frames = 0
+                deadline_flushes = 0
+                prev_report = now
+            rates.report(now)
+
+    def recv_uplink(self):
+        """Receive MAVLink frames from the ground and queue them for the flight controller"""
+
+        # Create the receive socket
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('', self.uplink_port))
+        parser = MavlinkParser()
+
+        while not self.done:
+            data, addr = sock.recvfrom(4096)
+            now = time.monotonic()
+
+            # Queue whole frames. The put blocks when the queue is full, which pushes the backpressure
+            # back onto the socket receive buffer rather than overrunning the UART.
+            parser.feed(data)
+            while parser.parse():
+                self.commands.request(parser.msgid, now)
+                if self.tlog:
+                    self.tlog.write(parser.frame)
+                self.uplink.put((now, bytes(parser.frame)))
+
+    def write_uplink(self):
+        """Write the queued uplink frames to the UART, coalescing and pacing them to the baudrate"""
+        byte_time = 10.0 / int(self.baudrate)
+        max_write = max(64, int(0.02 / byte_time))
+        busy_until = time.monotonic()
+
         while not self.done:
-            msg = self.queue.get()
-            buf = msg.get_msgbuf()
-            sock.sendto(buf, (self.host, self.port))
+            try:
+                t, frame = self.uplink.get(timeout=1.0)
+            except queue.Empty:
+                continue
+
+            # Coalesce the frames that are waiting into a single write
+            out = bytearray(frame)
+            oldest = t
+            while len(out) < max_write:
+                try:
+                    t, frame = self.uplink.get_nowait()
+                except queue.Empty:
+                    break
+                out += frame
+
+            # Don't write faster than the UART can drain
+            now = time.monotonic()
+            if busy_until > now:
+                time.sleep(busy_until - now)
+                now = busy_until
+            self.uplink_queue_delay = max(self.uplink_queue_delay, now - oldest)
+            self.write_frame(out)
+            busy_until = max(busy_until, now) + len(out) * byte_time
 
 if __name__ == '__main__':
     # /dev/ttyS0 pi, /dev/ttyS1 nanopi
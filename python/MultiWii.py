@@ -16,10 +16,179 @@
 # Downloaded from https://github.com/ke4ukz/PyMSP
 
 from serial import Serial
-from threading import Thread, Event
-from time import sleep, time
+from threading import Thread, Event, Lock
+from collections import deque
+from time import time
 import struct
 
+def _makeCrc8DvbS2Table():
+        """Build the lookup table of the CRC-8/DVB-S2 checksum used by MSP v2"""
+        table = []
+        for i in range(256):
+                crc = i
+                for _ in range(8):
+                        crc = ((crc << 1) ^ 0xD5) & 0xFF if (crc & 0x80) else (crc << 1) & 0xFF
+                #end for
+                table.append(crc)
+        #end for
+        return bytes(table)
+#end def _makeCrc8DvbS2Table
+
+_CRC8_DVB_S2 = _makeCrc8DvbS2Table()
+
+class MSPResult(object):
+        """Base class of the decoded MSP messages
+
+        The fields are slots, which can be accessed as attributes (att.angx) or as dictionary
+        items (att["angx"]) like the dicts that were returned by earlier versions.
+        """
+        __slots__ = ()
+
+        def __init_subclass__(cls, **kwargs):
+                #Generate an __init__ that assigns each slot directly (like namedtuple does), which is
+                #several times faster than a generic setattr loop
+                super().__init_subclass__(**kwargs)
+                source = "def __init__(self, %s):\n" % ", ".join(cls.__slots__)
+                source += "".join("        self.%s = %s\n" % (name, name) for name in cls.__slots__)
+                namespace = {}
+                exec(source, namespace)
+                cls.__init__ = namespace["__init__"]
+        #end def __init_subclass__
+
+        def __getitem__(self, key):
+                try:
+                        return getattr(self, key)
+                except (AttributeError, TypeError):
+                        raise KeyError(key)
+        #end def __getitem__
+
+        def __setitem__(self, key, value):
+                try:
+                        setattr(self, key, value)
+                except (AttributeError, TypeError):
+                        raise KeyError(key)
+        #end def __setitem__
+
+        def __contains__(self, key):
+                return key in self.__slots__
+        #end def __contains__
+
+        def __iter__(self):
+                return iter(self.__slots__)
+        #end def __iter__
+
+        def __len__(self):
+                return len(self.__slots__)
+        #end def __len__
+
+        def get(self, key, default=None):
+                return getattr(self, key, default) if key in self.__slots__ else default
+        #end def get
+
+        def keys(self):
+                return list(self.__slots__)
+        #end def keys
+
+        def values(self):
+                return [getattr(self, name) for name in self.__slots__]
+        #end def values
+
+        def items(self):
+                return [(name, getattr(self, name)) for name in self.__slots__]
+        #end def items
+
+        def __eq__(self, other):
+                return type(self) == type(other) and self.values() == other.values()
+        #end def __eq__
+
+        def __repr__(self):
+                return "%s(%s)" % (type(self).__name__, ", ".join("%s=%r" % i for i in self.items()))
+        #end def __repr__
+#end class MSPResult
+
+class MSPIdent(MSPResult):
+        __slots__ = ("version", "type", "mspversion", "capability")
+
+class MSPAttitude(MSPResult):
+        __slots__ = ("angx", "angy", "heading")
+
+class MSPIMU(MSPResult):
+        __slots__ = ("accx", "accy", "accz", "gyrx", "gyry", "gyrz", "magx", "magy", "magz")
+
+class MSPRC(MSPResult):
+        __slots__ = ("pitch", "roll", "yaw", "throttle", "aux1", "aux2", "aux3", "aux4")
+
+class MSPAnalog(MSPResult):
+        __slots__ = ("vbat", "powermetersum", "rssi", "amperage")
+
+class MSPAltitude(MSPResult):
+        __slots__ = ("altitude", "vari")
+
+class MSPGPS(MSPResult):
+        __slots__ = ("fix", "numsat", "latitude", "longitude", "altitude", "speed", "course")
+
+class MSPStatus(MSPResult):
+        __slots__ = ("cycletime", "i2cerrorcount", "sensor", "flag", "currentset")
+
+class MSPMotors(MSPResult):
+        __slots__ = tuple("motor%d" % (i + 1) for i in range(8))
+
+class MSPMisc(MSPResult):
+        __slots__ = ("powertrigger", "minthrottle", "maxthrottle", "mincommand", "failsafethrottle", "armedtime",
+                     "uptime", "magdeclination", "vbatscale", "vbatwarn1", "vbatwarn2", "vbatcrit")
+
+class MSPDistanceToHome(MSPResult):
+        __slots__ = ("distance", "heading")
+
+class MSPServos(MSPResult):
+        __slots__ = tuple("servo%d" % (i + 1) for i in range(8))
+
+class _MSPCodec(object):
+        """Decode an MSP payload into a result object with a single precompiled struct call
+
+        Args:
+                fmt (str): The struct format of the payload (which may be followed by fields that aren't decoded)
+                result (class): The MSPResult subclass
+                convert (function): An optional function that scales / converts the unpacked tuple
+        """
+        __slots__ = ("struct", "result", "convert", "empty")
+
+        def __init__(self, fmt, result, convert=None):
+                self.struct = struct.Struct(fmt)
+                self.result = result
+                self.convert = convert
+                self.empty = tuple(convert(self.struct.unpack(bytes(self.struct.size))) if convert else
+                                   self.struct.unpack(bytes(self.struct.size)))
+        #end def __init__
+
+        def decode(self, rdata):
+                """Decode a payload, returning a result with all fields zero if it's missing or too short"""
+                if (rdata is None) or (len(rdata) < self.struct.size):
+                        return self.result(*self.empty)
+                #end if
+                values = self.struct.unpack_from(rdata)
+                if self.convert:
+                        values = self.convert(values)
+                #end if
+                return self.result(*values)
+        #end def decode
+#end class _MSPCodec
+
+_IDENT = _MSPCodec("<BBBI", MSPIdent)
+_ATTITUDE = _MSPCodec("<hhh", MSPAttitude, lambda v: (v[0] / 10.0, v[1] / 10.0, v[2] - 180))
+_IMU = _MSPCodec("<9h", MSPIMU)
+_ANALOG = _MSPCodec("<BHHH", MSPAnalog)
+_ALTITUDE = _MSPCodec("<ih", MSPAltitude)
+_GPS = _MSPCodec("<BBiiHHH", MSPGPS, lambda v: (v[0] == 1,) + v[1:])
+_STATUS = _MSPCodec("<HHHIB", MSPStatus)
+_MOTORS = _MSPCodec("<8H", MSPMotors)
+_MISC = _MSPCodec("<6HIH4B", MSPMisc)
+_DISTANCE_TO_HOME = _MSPCodec("<HH", MSPDistanceToHome)
+_SERVOS = _MSPCodec("<8H", MSPServos)
+
+#MSP_RC has a variable number of channels, so it has a struct for each channel count
+_RC_STRUCTS = [struct.Struct("<%dH" % n) for n in range(19)]
+
 class MultiWii(object):
         """Connect to and communicate with an RC device using the MultiWii Serial Protocol
         
@@ -30,7 +199,8 @@ class MultiWii(object):
 
         Notes:
                 Some values may be needed to tested by observing their values to interpret their meaning.
-                Values returned by getIMU depend on the sensor type installed. GPS values currently are
+                The get* methods return MSPResult objects, whose fields can be accessed as attributes or as
+                dictionary items. Values returned by getIMU depend on the sensor type installed. GPS values currently are
                 the raw data returned by the flight controller (if a GPS receiver is installed), but may
                 be changed in the future to something more useful (decimal degrees probably).
         """
@@ -41,8 +211,11 @@ class MultiWii(object):
         #       _port: serial.Serial object
         #       _monitorThread: threading.Thread object that monitors the incoming serial data
         #       _exitNow: threading.Event object that is set when the thread should exit
-        #       _responses: dict of {command: _MSPResponse} used to store responses
+        #       _responses: dict of {command: deque of _MSPResponse} holding the outstanding requests in the order they were sent
+        #       _stats: dict of {command: _MSPStats}
         #       responseTimeout: number of seconds to wait for a response to a command (defaults to 3)
+        #       commandTimeouts: dict of {command: seconds} overriding responseTimeout for individual commands
+        #       retries: number of times a command that times out is resent (defaults to 0)
 
         MULTITYPENAMES = {0:"Unknown", 1:"TRI", 2:"QUADP", 3:"QUADX", 4:"BI", 5:"GIMBAL", 6:"Y6", 7:"HEX6", 8:"FLYING_WING", 9:"Y4", 10:"HEX6X", 11:"OCTOX8", 12:"OCTOFLATX", 13:"OCTOFLATP", 14:"AIRPLANE", 15:"HELI_120_CCPM", 16:"HELI_90_DEG", 17:"VTAIL4", 18:"HEX6H", 19:"PPM_TO_SERVO", 20:"DUALCOPTER", 21:"SINGLECOPTER"}
         _MODERANGENAMES = {0:"ARM", 1:"ANGLE", 2:"HORIZON", 3:"BARO", 4:"Reserved", 5:"MAG", 6:"HEADFREE", 7:"HEADADJ", 8:"CAMSTAB", 9:"CAMTRIG", 10:"GPSHOME", 11:"GPSHOLD", 12:"PASSTHRU", 13:"BEEPERON", 14:"LEDMAX", 15:"LEDLOW", 16:"LLIGHTS", 17:"CALIB", 18:"GOV", 19:"OSD", 20:"TELEMETRY", 21:"AUTOTUNE", 22:"SONAR"}
@@ -75,35 +248,84 @@ class MultiWii(object):
                 MSP_SET_HEAD = 211
         #end class _MSPCOMMANDS
 
-        class _MSPSTATES:
-                """Enum of MSP States"""
-                IDLE = 0
-                HEADER_START = 1
-                HEADER_M = 2
-                HEADER_ARROW = 3
-                HEADER_SIZE = 4
-                HEADER_CMD = 5
-        #end class _MSPSTATES
+        class _MSPFRAME:
+                """MSP framing constants"""
+                START = 36 #chr(36)=='$'
+                V1 = 77 #chr(77)=='M'
+                V2 = 88 #chr(88)=='X'
+                RESPONSE = 62 #chr(62)=='>'
+                ERROR = 33 #chr(33)=='!'
+                V1_OVERHEAD = 6 #'$', 'M', direction, size, command, checksum
+                V2_OVERHEAD = 9 #'$', 'X', direction, flag, command (2), size (2), crc
+                V2_HEADER = struct.Struct("<HH") #command, size
+                V2_MAX_SIZE = 4096
+        #end class _MSPFRAME
+
+        #The request and decoder of each get* method, used by getMultiple
+        _REQUESTS = {
+                "getIdent": (_MSPCOMMANDS.MSP_IDENT, 7, "_decodeIdent"),
+                "getAttitude": (_MSPCOMMANDS.MSP_ATTITUDE, 6, "_decodeAttitude"),
+                "getIMU": (_MSPCOMMANDS.MSP_RAW_IMU, 18, "_decodeIMU"),
+                "getRC": (_MSPCOMMANDS.MSP_RC, None, "_decodeRC"),
+                "getAnalog": (_MSPCOMMANDS.MSP_ANALOG, 7, "_decodeAnalog"),
+                "getAltitude": (_MSPCOMMANDS.MSP_ALTITUDE, 6, "_decodeAltitude"),
+                "getGPS": (_MSPCOMMANDS.MSP_RAW_GPS, 16, "_decodeGPS"),
+                "getStatus": (_MSPCOMMANDS.MSP_STATUS, 11, "_decodeStatus"),
+                "getMotors": (_MSPCOMMANDS.MSP_MOTOR, 16, "_decodeMotors"),
+                "getBoxnames": (_MSPCOMMANDS.MSP_BOXNAMES, None, "_decodeBoxnames"),
+                "getModeRanges": (_MSPCOMMANDS.MSP_MODE_RANGES, None, "_decodeModeRanges"),
+                "getMisc": (_MSPCOMMANDS.MSP_MISC, 22, "_decodeMisc"),
+                "getDistanceToHome": (_MSPCOMMANDS.MSP_COMP_GPS, 5, "_decodeDistanceToHome"),
+                "getServos": (_MSPCOMMANDS.MSP_SERVO, 16, "_decodeServos")
+        }
 
         class _MSPResponse:
-                """Combine MSP response data and finished communication flag"""
-                def __init__(self):
+                """An outstanding request, completed by the monitor thread when the response arrives"""
+                def __init__(self, command):
+                        self.command = command
                         self.finished = False
+                        self.error = False
                         self.data = []
+                        self.sent = time()
+                        self.event = Event()
                 #end def __init__
         #end class _MSPResponse
 
+        class _MSPStats:
+                """Request counters of a single command"""
+                __slots__ = ("requests", "responses", "errors", "timeouts", "retries", "rttSum", "rttMax")
+                def __init__(self):
+                        self.requests = 0
+                        self.responses = 0
+                        self.errors = 0
+                        self.timeouts = 0
+                        self.retries = 0
+                        self.rttSum = 0.0
+                        self.rttMax = 0.0
+                #end def __init__
+        #end class _MSPStats
+
 # construction/destruction #################################################################################
         def __init__(self):
                 self._port = Serial()
                 self._monitorThread = Thread(target=self._monitorSerialPort)
                 self._exitNow = Event()
                 self._responses = {}
+                self._lock = Lock()
+                self._writeLock = Lock()
+                self._stats = {}
                 self.responseTimeout = 3
+                self.commandTimeouts = {}
+                self.retries = 0
+                self.unmatchedResponses = 0
+                self._noReply = set()
+                self.readTimeout = 0.1
+                self.framesReceived = 0
+                self.checksumErrors = 0
         #end def __init__
 
         def __del__(self):
-                if self._monitorThread.isAlive():
+                if self._monitorThread.is_alive():
                         self._exitNow.set()
                 elif self._port.isOpen():
                         self._port.close()
@@ -112,7 +334,7 @@ class MultiWii(object):
 # connection methods #################################################################################
         def disconnect(self):
                 """Disconnect from a MultiWii RC device"""
-                if self._monitorThread.isAlive():
+                if self._monitorThread.is_alive():
                         self._exitNow.set()
                         self._monitorThread.join()
         #end def disconnect
@@ -130,6 +352,7 @@ class MultiWii(object):
                 try:
                         self._port.port = portName
                         self._port.baudrate = baudRate
+                        self._port.timeout = self.readTimeout
                         self._port.open()
                 except Exception as ex:
                         print("Error opening serial port: " + str(ex))
@@ -193,126 +416,357 @@ class MultiWii(object):
 
 # command processing methods #################################################################################
         def _monitorSerialPort(self):
-                state = self._MSPSTATES.IDLE
-                data = bytearray()
-                dataSize = 0
-                dataChecksum = 0
-                command = self._MSPCOMMANDS.MSP_NULL
+                buf = bytearray()
                 while (not self._exitNow.isSet()):
-                        if (self._port.inWaiting() > 0):
-                                inByte = ord(self._port.read())
-                                if (state == self._MSPSTATES.IDLE):
-                                        state = self._MSPSTATES.HEADER_START if (inByte==36) else self._MSPSTATES.IDLE #chr(36)=='$'
-                                elif (state == self._MSPSTATES.HEADER_START):
-                                        state = self._MSPSTATES.HEADER_M if (inByte==77) else self._MSPSTATES.IDLE #chr(77)=='M'
-                                elif (state == self._MSPSTATES.HEADER_M):
-                                        state = self._MSPSTATES.HEADER_ARROW if (inByte==62) else self._MSPSTATES.IDLE #chr(62)=='>'
-                                elif (state == self._MSPSTATES.HEADER_ARROW):
-                                        dataSize = inByte
-                                        data = bytearray()
-                                        dataChecksum = inByte
-                                        state = self._MSPSTATES.HEADER_SIZE
-                                elif (state == self._MSPSTATES.HEADER_SIZE):
-                                        command = inByte
-                                        dataChecksum = (dataChecksum ^ inByte)
-                                        state = self._MSPSTATES.HEADER_CMD
-                                elif (state == self._MSPSTATES.HEADER_CMD) and (len(data) < dataSize):
-                                        data.append(inByte)
-                                        dataChecksum = (dataChecksum ^ inByte)
-                                elif (state == self._MSPSTATES.HEADER_CMD) and (len(data) >= dataSize):
-                                        if (dataChecksum == inByte):
-                                                #Good command, do something with it
-                                                self._processCommand(command, data)
-                                        else:
-                                                #Bad checksum
-                                                pass
-                                        state = self._MSPSTATES.IDLE
-                                        #end if
-                                #end if
-                        else:
-                                sleep(0.01)
+                        #Block until data arrives (or the read times out), then take everything that is waiting in one read
+                        try:
+                                inData = self._port.read(max(1, self._port.in_waiting))
+                        except Exception as ex:
+                                print("Error reading serial port: " + str(ex))
+                                break
+                        #end try
+                        if inData:
+                                buf += inData
+                                del buf[:self._parseFrames(buf)]
                         #end if
                 #end while
                 self._port.close()
         #end def _monitorSerialPort
 
-        def _processCommand(self, command, data):
-                if (command in self._responses):
-                        self._responses[command].data = data
-                        self._responses[command].finished = True
-                        self.commandRecceived(command, data) #Call the subclass method
-                        return True
-                else:
+        def _xorChecksum(self, data):
+                #XOR all the bytes together by folding the buffer in half as one big integer
+                value = int.from_bytes(data, "little")
+                size = len(data)
+                while (size > 1):
+                        half = (size + 1) // 2
+                        value = (value & ((1 << (8 * half)) - 1)) ^ (value >> (8 * half))
+                        size = half
+                #end while
+                return value
+        #end def _xorChecksum
+
+        def _crc8DvbS2(self, data):
+                crc = 0
+                for b in data:
+                        crc = _CRC8_DVB_S2[crc ^ b]
+                #end for
+                return crc
+        #end def _crc8DvbS2
+
+        def _parseFrames(self, buf):
+                """Dispatch all the complete MSP v1/v2 frames in buf
+
+                Args:
+                        buf (bytearray): The received data
+
+                Returns:
+                        int: The number of bytes that were consumed. Any remaining bytes are the start of an incomplete frame.
+                """
+                F = self._MSPFRAME
+                end = len(buf)
+                pos = 0
+                while True:
+                        pos = buf.find(b"$", pos)
+                        if (pos < 0):
+                                return end
+                        if (end - pos < 3):
+                                return pos
+                        version = buf[pos+1]
+                        direction = buf[pos+2]
+                        if (direction != F.RESPONSE and direction != F.ERROR) or (version != F.V1 and version != F.V2):
+                                pos += 1
+                                continue
+                        #end if
+                        if (version == F.V1):
+                                if (end - pos < F.V1_OVERHEAD - 1):
+                                        return pos
+                                dataSize = buf[pos+3]
+                                command = buf[pos+4]
+                                frameEnd = pos + F.V1_OVERHEAD + dataSize
+                                if (frameEnd > end):
+                                        return pos
+                                valid = (self._xorChecksum(buf[pos+3:frameEnd-1]) == buf[frameEnd-1])
+                                data = buf[pos+5:frameEnd-1]
+                        else:
+                                if (end - pos < F.V2_OVERHEAD - 1):
+                                        return pos
+                                command, dataSize = F.V2_HEADER.unpack_from(buf, pos+4)
+                                if (dataSize > F.V2_MAX_SIZE):
+                                        self.checksumErrors += 1
+                                        pos += 1
+                                        continue
+                                #end if
+                                frameEnd = pos + F.V2_OVERHEAD + dataSize
+                                if (frameEnd > end):
+                                        return pos
+                                valid = (self._crc8DvbS2(buf[pos+3:frameEnd-1]) == buf[frameEnd-1])
+                                data = buf[pos+8:frameEnd-1]
+                        #end if
+                        if valid:
+                                self.framesReceived += 1
+                                self._processCommand(command, data, direction == F.ERROR)
+                                pos = frameEnd
+                        else:
+                                #Bad checksum, so resynchronize on the next start byte
+                                self.checksumErrors += 1
+                                pos += 1
+                        #end if
+                #end while
+        #end def _parseFrames
+
+        def _processCommand(self, command, data, error=False):
+                #Responses are matched to the oldest outstanding request of the same command
+                with self._lock:
+                        pending = self._responses.get(command)
+                        request = pending.popleft() if pending else None
+                #end with
+                if (request is None):
+                        if (command not in self._noReply):
+                                self.unmatchedResponses += 1
+                        #end if
                         return False
                 #end if
+                rtt = time() - request.sent
+                stats = self._getStats(command)
+                stats.responses += 1
+                stats.errors += 1 if error else 0
+                stats.rttSum += rtt
+                stats.rttMax = max(stats.rttMax, rtt)
+                request.data = data
+                request.error = error
+                request.finished = True
+                request.event.set()
+                self.commandRecceived(command, data, error) #Call the subclass method
+                return True
         #end def _processCommand
 
-        def _sendCommand(self, command, data=None):
+        def _getStats(self, command):
+                stats = self._stats.get(command)
+                if (stats is None):
+                        stats = self._stats.setdefault(command, self._MSPStats())
+                #end if
+                return stats
+        #end def _getStats
+
+        def _encodeCommand(self, command, data=None):
                 if (data is None):
                         dataSize = 0
                 else:
                         if len(data) < 256:
                                 dataSize = len(data)
                         else:
-                                return False
+                                return None
                 output = bytearray(b"$M<")
                 output.append(dataSize)
-                checksum = dataSize
                 output.append(command)
-                checksum = (checksum ^ command)
                 if (dataSize > 0):
-                        for b in data:
-                                output.append(b)
-                                checksum = (checksum ^ b)
+                        output += data
+                #end if
+                output.append(self._xorChecksum(output[3:]))
+                return output
+        #end def _encodeCommand
+
+        def _sendCommands(self, commands):
+                """Send several commands in a single write
+
+                Args:
+                        commands (list): (command, data) tuples
+
+                Returns:
+                        list: The _MSPResponse of each command (None for a command that couldn't be sent)
+                """
+                output = bytearray()
+                requests = []
+                for command, data in commands:
+                        frame = self._encodeCommand(command, data)
+                        if (frame is None):
+                                requests.append(None)
+                                continue
+                        #end if
+                        output += frame
+                        requests.append(self._MSPResponse(command))
+                #end for
+
+                #Register the requests before writing, so that a fast response can't arrive before it's expected
+                with self._lock:
+                        for request in requests:
+                                if request:
+                                        self._responses.setdefault(request.command, deque()).append(request)
+                                        self._getStats(request.command).requests += 1
+                                #end if
                         #end for
+                #end with
+                try:
+                        with self._writeLock:
+                                self._port.write(output)
+                        #end with
+                except Exception:
+                        for request in requests:
+                                if request:
+                                        self._forget(request)
+                        #end for
+                        return [None] * len(requests)
+                #end try
+                return requests
+        #end def _sendCommands
+
+        def _sendCommand(self, command, data=None):
+                return self._sendCommands([(command, data)])[0]
+        #end def _sendCommand
+
+        def _sendNoReply(self, command, data=None):
+                """Send a command without waiting for (or matching) it's acknowledgement
+
+                Returns:
+                        bool: True if the command was written, False otherwise
+                """
+                frame = self._encodeCommand(command, data)
+                if (frame is None):
+                        return False
                 #end if
-                output.append(checksum)
+                self._noReply.add(command)
                 try:
-                        self._port.write(output)
-                        self._responses.update({command: self._MSPResponse()})
+                        with self._writeLock:
+                                self._port.write(frame)
+                        #end with
                 except Exception:
                         return False
+                #end try
                 return True
-        #end def _sendCommand
+        #end def _sendNoReply
 
-        def _waitForResponse(self, command):
-                if (command in self._responses):
-                        startTime = time()
-                        while True:
-                                if self._responses[command].finished:
-                                        return True
-                                if (time() - startTime > self.responseTimeout):
-                                        return False
-                                sleep(0)
-                        #end while
-                else:
+        def _forget(self, request):
+                with self._lock:
+                        pending = self._responses.get(request.command)
+                        if pending and request in pending:
+                                pending.remove(request)
+                        #end if
+                #end with
+        #end def _forget
+
+        def _commandTimeout(self, command):
+                return self.commandTimeouts.get(command, self.responseTimeout)
+        #end def _commandTimeout
+
+        def _waitForResponse(self, request, timeout=None):
+                if (request is None):
                         return False
+                if (timeout is None):
+                        timeout = self._commandTimeout(request.command)
+                #end if
+                if request.event.wait(timeout):
+                        return True
+                #end if
+                self._forget(request)
+                self._getStats(request.command).timeouts += 1
+                return False
         #end def _waitForResponse
 
+        def _request(self, command, data=None):
+                """Send a command and wait for it's response, resending it up to retries times if it times out
+
+                Returns:
+                        _MSPResponse: the completed request, or None if there was no response
+                """
+                for attempt in range(self.retries + 1):
+                        if (attempt > 0):
+                                self._getStats(command).retries += 1
+                        #end if
+                        request = self._sendCommand(command, data)
+                        if self._waitForResponse(request):
+                                return request
+                        #end if
+                #end for
+                return None
+        #end def _request
+
         def _sendAndWait(self, command, data=None):
-                if (self._sendCommand(command, data)):
-                        return self._waitForResponse(command)
-                else:
-                        return False
+                return self._request(command, data) is not None
         #end def _sendAndWait
 
-        def _sendAndGet(self, command, expectedSize=None):
-                if self._sendAndWait(command):
-                        rdata = self._responses[command].data
-                        del self._responses[command]
-                        if (expectedSize is not None):
-                                if (len(rdata) == expectedSize):
-                                        return rdata
-                                else:
-                                        return None
-                        else:
-                                return rdata
-                        #end if
-                else:
+        def _checkSize(self, request, expectedSize):
+                if (request is None):
                         return None
-                #end if
+                rdata = request.data
+                if (expectedSize is not None) and (len(rdata) != expectedSize):
+                        return None
+                return rdata
+        #end def _checkSize
+
+        def _sendAndGet(self, command, expectedSize=None):
+                return self._checkSize(self._request(command), expectedSize)
         #end def _sendAndGet
 
+        def getMultiple(self, *names):
+                """Pipeline several get* requests, so that they complete in a single round trip
+
+                Args:
+                        names (str): The names of the get* methods (e.g., "getAttitude", "getMisc")
+
+                Returns:
+                        list: The result of each method, in the same order as names
+
+                Notes:
+                        All the requests are written at once, and then the responses are collected as they
+                        arrive. Requests that time out are resent together up to retries times.
+                """
+                entries = [self._REQUESTS[name] for name in names]
+                results = [None] * len(entries)
+                todo = list(range(len(entries)))
+                for attempt in range(self.retries + 1):
+                        if (attempt > 0):
+                                for i in todo:
+                                        self._getStats(entries[i][0]).retries += 1
+                                #end for
+                        #end if
+                        requests = self._sendCommands([(entries[i][0], None) for i in todo])
+
+                        # The responses arrive within one round trip, so they share a single deadline
+                        deadline = time() + max(self._commandTimeout(entries[i][0]) for i in todo)
+                        failed = []
+                        for i, request in zip(todo, requests):
+                                if self._waitForResponse(request, max(0.0, deadline - time())):
+                                        results[i] = request
+                                else:
+                                        failed.append(i)
+                                #end if
+                        #end for
+                        todo = failed
+                        if not todo:
+                                break
+                #end for
+                return [getattr(self, decoder)(self._checkSize(results[i], expectedSize))
+                        for i, (command, expectedSize, decoder) in enumerate(entries)]
+        #end def getMultiple
+
+        def getStats(self):
+                """Get the request statistics of each command
+
+                Returns:
+                        dict of dict
+                        {
+                                command (int):
+                                        {
+                                                "requests": (int)
+                                                "responses": (int)
+                                                "errors": (int) - error responses
+                                                "timeouts": (int)
+                                                "retries": (int)
+                                                "rtt": (float) - average round trip time in seconds
+                                                "rttmax": (float) - maximum round trip time in seconds
+                                        }
+                        }
+                """
+                ret = {}
+                for command, stats in list(self._stats.items()):
+                        ret[command] = {"requests":stats.requests, "responses":stats.responses, "errors":stats.errors,
+                                        "timeouts":stats.timeouts, "retries":stats.retries,
+                                        "rtt":(stats.rttSum / stats.responses) if stats.responses else 0.0,
+                                        "rttmax":stats.rttMax}
+                #end for
+                return ret
+        #end def getStats
+
         def commandRecceived(self, command, data, error=False):
                 """Process a received command from the device
 
@@ -344,15 +798,12 @@ class MultiWii(object):
                                 }
                         See MULTITYPENAMES for a string representation of 'type'
                 """
-                mspVersion = 0
-                quadType = 0
-                rdata = self._sendAndGet(self._MSPCOMMANDS.MSP_IDENT, 7)
-                if rdata:
-                        mspVersion = rdata[0]
-                        quadType = rdata[1]
-                #end if
-                return {"version":mspVersion, "type":quadType}
+                return self._decodeIdent(self._sendAndGet(self._MSPCOMMANDS.MSP_IDENT, 7))
         #end def getIdent
+
+        def _decodeIdent(self, rdata):
+                return _IDENT.decode(rdata)
+        #end def _decodeIdent
         
         def getAttitude(self):
                 """Get attitude (orientation) data from the device
@@ -366,18 +817,13 @@ class MultiWii(object):
                         }
                         All units are in degrees
                 """
-                angx = 0
-                angy = 0
-                heading = 0
-                rdata = self._sendAndGet(self._MSPCOMMANDS.MSP_ATTITUDE, 6)
-                if rdata:
-                        angx = self._toInt16(rdata[0:2]) / 10.0
-                        angy = self._toInt16(rdata[2:4]) / 10.0
-                        heading = self._toInt16(rdata[4:6]) - 180
-                #end if
-                return {"angx":angx, "angy":angy, "heading":heading}
+                return self._decodeAttitude(self._sendAndGet(self._MSPCOMMANDS.MSP_ATTITUDE, 6))
         #end def getAttitude
 
+        def _decodeAttitude(self, rdata):
+                return _ATTITUDE.decode(rdata)
+        #end def _decodeAttitude
+
         def getIMU(self):
                 """Get raw IMU data from the device
 
@@ -396,26 +842,13 @@ class MultiWii(object):
                         }
                         Values depend on the sensor that is installed, and will be zero for any sensor that is not available
                 """
-                acc = [0,0,0]
-                gyr = [0,0,0]
-                mag = [0,0,0]
-                rdata = self._sendAndGet(self._MSPCOMMANDS.MSP_RAW_IMU, 18)
-                if rdata:
-                        acc[0] = self._toInt16(rdata[0:2])
-                        acc[1] = self._toInt16(rdata[2:4])
-                        acc[2] = self._toInt16(rdata[4:6])
-                        gyr[0] = self._toInt16(rdata[6:8])
-                        gyr[1] = self._toInt16(rdata[8:10])
-                        gyr[2] = self._toInt16(rdata[10:12])
-                        mag[0] = self._toInt16(rdata[12:14])
-                        mag[1] = self._toInt16(rdata[14:16])
-                        mag[2] = self._toInt16(rdata[16:18])
-                #end if
-                return {"accx":acc[0], "accy":acc[1], "accz":acc[2],
-                                "gyrx":gyr[0], "gyry":gyr[1], "gyrz":gyr[2],
-                                "magx":mag[0], "magy":mag[1], "magz":mag[2]}
+                return self._decodeIMU(self._sendAndGet(self._MSPCOMMANDS.MSP_RAW_IMU, 18))
         #end def getIMU
 
+        def _decodeIMU(self, rdata):
+                return _IMU.decode(rdata)
+        #end def _decodeIMU
+
         def getRC(self):
                 """Get current RC data from the device
 
@@ -436,28 +869,20 @@ class MultiWii(object):
                 Note: These are the PWM values being used to compute the signal to be sent to the motor. In CleanFlight,
                         they should be between 1000 and 2000.
                 """
-                pitch = 0
-                roll = 0
-                yaw = 0
-                throttle = 0
-                aux = [0,0,0,0]
-                rdata = self._sendAndGet(self._MSPCOMMANDS.MSP_RC)
-                if rdata:
-                        if (len(rdata) >= 8):
-                                pitch = self._toUInt16(rdata[0:2])
-                                roll = self._toUInt16(rdata[2:4])
-                                yaw = self._toUInt16(rdata[4:6])
-                                throttle = self._toUInt16(rdata[6:8])
-                                for i in range(0, 3):
-                                        if (len(rdata) >= (10 + 2 * i)):
-                                                aux[i] = self._toUInt16(rdata[8+2*i:10+2*i])
-                                #end for
-                        #end if
-                #end if
-                return {"pitch":pitch, "roll":roll, "yaw":yaw, "throttle":throttle,
-                                "aux1":aux[0], "aux2":aux[1], "aux3":aux[2], "aux4":aux[3]}
+                return self._decodeRC(self._sendAndGet(self._MSPCOMMANDS.MSP_RC))
         #end def getRC
 
+        def _decodeRC(self, rdata):
+                channels = [0] * 8
+                if rdata and (len(rdata) >= 8):
+                        # Only the first 8 channels are returned, even if the flight controller sends more
+                        count = min(len(rdata) // 2, len(_RC_STRUCTS) - 1)
+                        n = min(count, 8)
+                        channels[:n] = _RC_STRUCTS[count].unpack_from(rdata)[:8]
+                #end if
+                return MSPRC(*channels)
+        #end def _decodeRC
+
         def getAnalog(self):
                 """Get analog sensor data from the device
 
@@ -470,20 +895,13 @@ class MultiWii(object):
                                 "amperage": (int)
                         }
                 """
-                vbat = 0
-                pms = 0
-                rssi = 0
-                amperage = 0
-                rdata = self._sendAndGet(self._MSPCOMMANDS.MSP_ANALOG, 7)
-                if rdata:
-                        vbat = rdata[0]
-                        pms = self._toUInt16(rdata[1:3])
-                        rssp = self._toUInt16(rdata[3:5])
-                        amperage = self._toUInt16(rdata[5:7])
-                #end if
-                return {"vbat":vbat, "powermetersum":pms, "rssi":rssi, "amperage":amperage}
+                return self._decodeAnalog(self._sendAndGet(self._MSPCOMMANDS.MSP_ANALOG, 7))
         #end def getAnalog
 
+        def _decodeAnalog(self, rdata):
+                return _ANALOG.decode(rdata)
+        #end def _decodeAnalog
+
         def getAltitude(self):
                 """Get current altitude of device
 
@@ -494,16 +912,13 @@ class MultiWii(object):
                                 "vari": (int)
                         }
                 """
-                alt = 0
-                vari = 0
-                rdata = self._sendAndGet(self._MSPCOMMANDS.MSP_ALTITUDE, 6)
-                if rdata:
-                        alt = self._toInt32(rdata[0:4])
-                        vari = self._toInt16(rdata[4:6])
-                #end if
-                return {"altitude":alt, "vari":vari}
+                return self._decodeAltitude(self._sendAndGet(self._MSPCOMMANDS.MSP_ALTITUDE, 6))
         #end def getAltitude
 
+        def _decodeAltitude(self, rdata):
+                return _ALTITUDE.decode(rdata)
+        #end def _decodeAltitude
+
         def getGPS(self):
                 """Get GPS coordinate and fix data from the device
 
@@ -519,27 +934,13 @@ class MultiWii(object):
                                 "course": (int)
                         }
                 """
-                gpsFix = False
-                gpsNumSat = 0
-                gpsLat = 0
-                gpsLong = 0
-                gpsAltitude = 0
-                gpsSpeed = 0
-                gpsCourse = 0
-                rdata = self._sendAndGet(self._MSPCOMMANDS.MSP_RAW_GPS, 16)
-                if rdata:
-                        gpsFix = True if (rdata[0] == 1) else False
-                        gpsNumSat = rdata[1]
-                        gpsLat = self._toUInt32(rdata[2:6])
-                        gpsLong = self._toUInt32(rdata[6:10])
-                        gpsAltitude = self._toUInt16(rdata[10:12])
-                        gpsSpeed = self._toUInt16(rdata[12:14])
-                        gpsCourse = self._toUInt16(rdata[14:16])
-                #end if
-                return {"fix":gpsFix, "numsat":gpsNumSat, "latitude":gpsLat, "longitude":gpsLong,
-                                "altitude":gpsAltitude, "speed":gpsSpeed, "course":gpsCourse}
+                return self._decodeGPS(self._sendAndGet(self._MSPCOMMANDS.MSP_RAW_GPS, 16))
         #end def getGPS
 
+        def _decodeGPS(self, rdata):
+                return _GPS.decode(rdata)
+        #end def _decodeGPS
+
         def getStatus(self):
                 """Get status of the device
 
@@ -553,22 +954,13 @@ class MultiWii(object):
                                 "currentset": (int)
                         }
                 """
-                cycletime=0
-                i2cerrorcount=0
-                sensor=0
-                flag=0
-                currentset=0
-                rdata = self._sendAndGet(self._MSPCOMMANDS.MSP_STATUS, 11)
-                if rdata:
-                        cycletime = self._toUInt16(rdata[0:2])
-                        i2cerrorcount = self._toUInt16(rdata[2:4])
-                        sensor = self._toUInt16(rdata[4:6])
-                        flag = self._toUInt32(rdata[6:10])
-                        currentset = rdata[10]
-                #end if
-                return {"cycletime":cycletime, "i2cerrorcount":i2cerrorcount, "sensor":sensor, "flag":flag, "currentset":currentset}
+                return self._decodeStatus(self._sendAndGet(self._MSPCOMMANDS.MSP_STATUS, 11))
         #end def getStatus
 
+        def _decodeStatus(self, rdata):
+                return _STATUS.decode(rdata)
+        #end def _decodeStatus
+
         def getMotors(self):
                 """Get current motor signal values from the device
 
@@ -588,20 +980,13 @@ class MultiWii(object):
                 Note: These are the PWM values being sent to the ESCs by the flight controller, not the actual
                         motor speeds. Motors that are not installed will have a value of zero.
                 """
-                motors = [0,0,0,0,0,0,0,0]
-                rdata = self._sendAndGet(self._MSPCOMMANDS.MSP_MOTOR, 16)
-                if rdata:
-                        for i in range(0,7):
-                                motors[i] = self._toUInt16(rdata[2*i:2*i+2])
-                        #end for
-                #end if
-                ret = {}
-                for i in range(0,7):
-                        ret.update({"motor" + str(i+1):motors[i]})
-                #end for
-                return ret
+                return self._decodeMotors(self._sendAndGet(self._MSPCOMMANDS.MSP_MOTOR, 16))
         #end def getMotors
 
+        def _decodeMotors(self, rdata):
+                return _MOTORS.decode(rdata)
+        #end def _decodeMotors
+
         def getBoxnames(self):
                 """Get the BOX name strings from the device
 
@@ -613,13 +998,16 @@ class MultiWii(object):
 
                 "boxnames" is a string list of the names, separated by ';'.
                 """
+                return self._decodeBoxnames(self._sendAndGet(self._MSPCOMMANDS.MSP_BOXNAMES))
+        #end def getBoxnames
+
+        def _decodeBoxnames(self, rdata):
                 boxNames = ""
-                rdata = self._sendAndGet(self._MSPCOMMANDS.MSP_BOXNAMES)
                 if rdata:
                         boxNames = "".join(map(chr, rdata))
                 #end if
                 return {"boxnames": boxNames}
-        #end def getBoxnames
+        #end def _decodeBoxnames
 
         def getModeRanges(self):
                 """Get mode ranges and channels from the device
@@ -770,6 +1158,10 @@ class MultiWii(object):
                         Note: These ranges are an extension to MSP only used by CleanFlight as a replacement for BOX values.
                                 See http://shipow.github.io/cleanflight-web/docs/api/msp_extensions/ for more information.
                 """
+                return self._decodeModeRanges(self._sendAndGet(self._MSPCOMMANDS.MSP_MODE_RANGES))
+        #end def getModeRanges
+
+        def _decodeModeRanges(self, rdata):
                 curID = 0
                 auxChannel = 0
                 rStart = 0
@@ -779,7 +1171,6 @@ class MultiWii(object):
                 for i in range(0, len(self._MODERANGENAMES)):
                         ret.update({self._MODERANGENAMES[i]: {"channel":0, "start":0, "end":0}})
                 #end for
-                rdata = self._sendAndGet(self._MSPCOMMANDS.MSP_MODE_RANGES)
                 if rdata:
                         for i in range(0, len(rdata), 4):
                                 curID = rdata[i]
@@ -790,7 +1181,7 @@ class MultiWii(object):
                         #end for
                 #end if
                 return ret
-        #end def getModeRanges
+        #end def _decodeModeRanges
 
         def getMisc(self):
                 """Get miscellaneous data from the device
@@ -812,37 +1203,12 @@ class MultiWii(object):
                                 "vbatcrit": (int)
                         }
                 """
-                powerTrigger = 0
-                minThrottle = 0
-                maxThrottle = 0
-                minCommand = 0
-                failsafeThrottle = 0
-                armTime = 0
-                lifeTime = 0
-                magDeclination = 0
-                vBatScale = 0
-                vBatWarn1 = 0
-                vBatWarn2 = 0
-                vBatCrit = 0
-                rdata = self._sendAndGet(self._MSPCOMMANDS.MSP_MISC, 22)
-                if rdata:
-                        powerTrigger = self._toUInt16(rdata[0:2])
-                        minThrottle = self._toUInt16(rdata[2:4])
-                        maxThrottle = self._toUInt16(rdata[4:6])
-                        minCommand = self._toUInt16(rdata[6:8])
-                        failsafeThrottle = self._toUInt16(rdata[8:10])
-                        armTime = self._toUInt16(rdata[10:12])
-                        lifeTime = self._toUInt32(rdata[12:16])
-                        magDeclination = self._toUInt16(rdata[16:18])
-                        vBatScale = rdata[18]
-                        vBatWarn1 = rdata[19]
-                        vBatWarn2 = rdata[20]
-                        vBatCrit = rdata[21]
-                #end if
-                return {"powertrigger":powerTrigger, "minthrottle":minThrottle, "maxthrottle":maxThrottle, "mincommand":minCommand,
-                                "failsafethrottle":failsafeThrottle, "armedtime":armTime, "uptime":lifeTime, "magdeclination":magDeclination,
-                                "vbatscale":vBatScale, "vbatwarn1":vBatWarn1, "vbatwarn2":vBatWarn2, "vbatcrit":vBatCrit}
+                return self._decodeMisc(self._sendAndGet(self._MSPCOMMANDS.MSP_MISC, 22))
         #end def getMisc
+
+        def _decodeMisc(self, rdata):
+                return _MISC.decode(rdata)
+        #end def _decodeMisc
         
         def getDistanceToHome(self):
                 """Get the distance and heading from current position to saved home location.
@@ -857,16 +1223,13 @@ class MultiWii(object):
                 Notes:
                         Document says heading is +/- 180 degrees, but data type is UINT16. Need to test this to see what it actually is
                 """
-                distance = 0
-                heading = 0
-                rdata = self._sendAndGet(self._MSPCOMMANDS.MSP_COMP_GPS, 5)
-                if rdata:
-                        distance = self._toUInt16(rdata[0:2])
-                        heading = self._toUInt16(rdata[2:4])
-                #end if
-                return {"distance":distance, "heading":heading}
+                return self._decodeDistanceToHome(self._sendAndGet(self._MSPCOMMANDS.MSP_COMP_GPS, 5))
         #end def getDistanceToHome
 
+        def _decodeDistanceToHome(self, rdata):
+                return _DISTANCE_TO_HOME.decode(rdata)
+        #end def _decodeDistanceToHome
+
         def getServos(self):
                 """Get current servo signal value from the device
 
@@ -887,29 +1250,22 @@ class MultiWii(object):
                         servo positions. Servos that are not configured will have a value of zero.
 
                 """
-                servos = [0,0,0,0,0,0,0,0]
-                rdata = self._sendAndGet(self._MSPCOMMANDS.MSP_SERVO, 16)
-                if rdata:
-                        for i in range(0, 8):
-                                print(type(i))
-                                servos[i] = self._toUInt16(rdata[2*i:2*i+2])
-                        #end for
-                #end if
-                ret = {}
-                for i in range(0, 8):
-                        ret.update({"servo" + str(i+1):servos[i]})
-                #end for
-                return ret
+                return self._decodeServos(self._sendAndGet(self._MSPCOMMANDS.MSP_SERVO, 16))
         #end def getServos
 
+        def _decodeServos(self, rdata):
+                return _SERVOS.decode(rdata)
+        #end def _decodeServos
+
 # set* methods #################################################################################
-        def setRC(self, values):
+        def setRC(self, values, wait=True):
                 """Sends new RC values to the device.
 
                 Args:
-                        values (dict): New RC values, containing values for one or more of the RC channels.
-                                Available channels are: "pitch", "yaw", "roll", "throttle", "aux1", "aux2",
-                                "aux3", and "aux4". Values not specified will be assumed to be zero.
+                        values (dict or list): New RC values, either a result of getRC or a list of the channel values
+                                in the order that the device expects them.
+                        wait (bool): Wait for the device to acknowledge the values. If False the values are written
+                                immediately and the acknowledgement is ignored, which is what a stream of RC updates needs.
 
                 Returns:
                         bool: True if successful, False otherwise
@@ -919,12 +1275,11 @@ class MultiWii(object):
                         If you want to change a couple of values and keep the rest the same, call getRC()
                         first, modify the values it returns, and pass that to setRC.
                 """
-                data = bytearray()
-                for ch in values:
-                        r = self._fromInt16(ch)
-                        data.append(r[0])
-                        data.append(r[1])
-                        #end for
+                channels = list(values.values() if hasattr(values, "values") else values)[:len(_RC_STRUCTS) - 1]
+                data = _RC_STRUCTS[len(channels)].pack(*channels)
+                if not wait:
+                        return self._sendNoReply(self._MSPCOMMANDS.MSP_SET_RAW_RC, data)
+                #end if
                 return self._sendAndWait(self._MSPCOMMANDS.MSP_SET_RAW_RC, data)
         #end def setRC
 
@@ -7,7 +7,7 @@ import array
 import time
 import logging
 import math
-import numpy as np
+import importlib.util
 import subprocess
 import threading
 import multiprocessing as mp
@@ -17,19 +17,14 @@ from openhd.py_v4l2 import Control
 
 from openhd.format_as_table import format_as_table
 from openhd import fec
+from openhd import tx_scheduler
+from openhd import packet_trace
+from openhd import video_packet
+from openhd import h264
 
-def module_exists(module_name):
-    try:
-        __import__(module_name)
-    except ImportError:
-        return False
-    else:
-        return True
-
-# Try loading picamera module
-found_picamera = module_exists("picamera")
-if found_picamera:
-    import picamera
+# Check for the picamera module without loading it, since it's slow to import and only used when
+# streaming from a Raspberry Pi camera
+found_picamera = importlib.util.find_spec("picamera") is not None
 
 class FPSLogger(object):
 
@@ -58,49 +53,101 @@ class FPSLogger(object):
             self.count = 0
 
 class UDPOutputStream(object):
+    """
+    Packetize the encoded frames and send them over UDP.
 
-    def __init__(self, host, port, broadcast = False, maxpacket = 1400, fec_ratio=0.0):
+    The latest SPS / PPS are cached and sent as a separate (small) frame every header_period seconds,
+    and whenever request_headers() is called, so that the encoder doesn't need to repeat them inline.
+    """
+
+    def __init__(self, host, port, broadcast = False, maxpacket = 1400, fec_ratio=0.0, trace_dir=None,
+                 header_period=0.5):
         self.log = FPSLogger(port)
         self.broadcast = broadcast
         self.maxpacket = maxpacket
         self.host = host
         self.port = port
+        self.set_fec_ratio(fec_ratio)
+
+        # Send through the shared transmit scheduler as the lowest priority traffic class
+        self.sched = tx_scheduler.get_scheduler()
+
+        # Record every packet sent to the (optional) packet trace
+        self.frame = 0
+        self.trace = packet_trace.open_trace(trace_dir, 'air', port)
+
+        # The cached parameter sets
+        self.header_period = header_period
+        self.headers = None
+        self.header_time = 0
+        self.headers_requested = False
+
+    def set_fec_ratio(self, fec_ratio):
         if fec_ratio > 0:
-            self.fec = fec.PyFECBufferEncoder(maxpacket, fec_ratio)
+            self.fec = fec.PyFECBufferEncoder(self.maxpacket, fec_ratio)
         else:
             self.fec = None
 
-        # Create the communication socket
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        if broadcast:
-            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        
+    def request_headers(self):
+        """Send the parameter sets before the next frame"""
+        self.headers_requested = True
+
     def write(self, s):
-        t = time.time()
-        ts = "%03d:%03d" % (int(t) % 1000, round(t * 1000) % 1000)
-        #t = round(time.time() * 1000) % 1000
         self.log.log(len(s))
+
+        # Cache the parameter sets, or inject the cached ones if they're due
+        now = time.monotonic()
+        headers = h264.parameter_sets(s)
+        if headers:
+            self.headers = headers
+            self.header_time = now
+            self.headers_requested = False
+        elif self.headers and (self.headers_requested or
+                               (self.header_period > 0 and (now - self.header_time) >= self.header_period)):
+            self.send(self.headers, packet_trace.FLAG_HEADERS)
+            self.header_time = now
+            self.headers_requested = False
+        self.send(s)
+
+    def send(self, s, flags=0):
         if self.broadcast:
             host = '<broadcast>'
         else:
             host = self.host
-        if self.fec:
-            for b in self.fec.encode_buffer(s):
-                self.sock.sendto(b, (host, self.port))
+        # The encoder can be replaced by set_fec_ratio() from another thread
+        encoder = self.fec
+        if encoder:
+            packets = encoder.encode_buffer(s)
+            flags |= packet_trace.FLAG_FEC
         else:
-            np = math.ceil((len(s) + 8) / self.maxpacket)
-            #s = b'FRAM' + struct.pack('HH', t, np) + s
-            #with open(ts, "wb") as fp:
-            #    fp.write(s)
-            for i in range(0, len(s), self.maxpacket):
-                self.sock.sendto(s[i : min(i + self.maxpacket, len(s))], (host, self.port))
+            # Fragment the frame behind a header so that the ground can reassemble it
+            packets = video_packet.fragment(self.frame, s, self.maxpacket)
+        if self.trace:
+            for i, p in enumerate(packets):
+                self.trace.record(self.port, self.frame, i, len(p), flags)
+        self.frame += 1
+        self.sched.sendto_many('video', packets, (host, self.port))
 
 class Camera(object):
 
-    def __init__(self, host, port, device=False, blocksize=1400, fec_ratio=0.0):
+    def __init__(self, host, port, device=False, blocksize=1400, fec_ratio=0.0, trace_dir=None, header_period=0.5,
+                 keyframe_interval=0.25):
         self.streaming = False
         self.recording = False
         self.device = device
+        self.camera = None
+        self.control = None
+
+        # Keyframe requests
+        self.keyframe_interval = keyframe_interval
+        self.last_keyframe = 0
+        self.keyframe_requests = 0
+        self.keyframes_forced = 0
+        self.stream_splitter_port = 1
+
+        # Parameter changes that are waiting to be applied by the streaming loop
+        self.updates = {}
+        self.update_lock = threading.Lock()
 
         # Streaming - Use the maximum resolution detected
         self.width = 0
@@ -109,7 +156,7 @@ class Camera(object):
         self.fps = 60
         self.intra_period = 3
         self.quality = 20
-        self.inline_headers = True
+        self.inline_headers = False
 
         # Recording - Use the maximum resolution detected
         self.rec_width = 0
@@ -120,13 +167,14 @@ class Camera(object):
         self.rec_inline_headers = True
 
         # Create streaming output
-        self.stream = UDPOutputStream(host, port, maxpacket=blocksize, fec_ratio=fec_ratio)
+        self.stream = UDPOutputStream(host, port, maxpacket=blocksize, fec_ratio=fec_ratio, trace_dir=trace_dir,
+                                      header_period=header_period)
 
     def __del__(self):
         self.stop_streaming()
 
     # Change the parameters for the video stream
-    def streaming_params(self, width, height, bitrate, intra_period = 30, quality=20, fps = 60, inline_headers = True) :
+    def streaming_params(self, width, height, bitrate, intra_period = 30, quality=20, fps = 60, inline_headers = False) :
         self.width = width
         self.height = height
         self.bitrate = bitrate
@@ -150,6 +198,7 @@ class Camera(object):
 
         # Create the camera source
         if self.device == 'picam1' or self.device == 'picam2':
+            import picamera
             if self.device == 'picam1':
                 self.camera = picamera.PiCamera(camera_num=0)
             else:
@@ -170,15 +219,13 @@ class Camera(object):
                 self.recording = True
                 self.camera.start_recording(rec_filename, format='h264', intra_period=self.rec_intra_period,
                                             inline_headers=self.rec_inline_headers, bitrate=self.rec_bitrate, quality=self.rec_quality)
-                self.camera.start_recording(self.stream, format='h264', intra_period=self.intra_period,
-                                            inline_headers=self.inline_headers, bitrate=self.bitrate, quality=self.quality,
-                                            splitter_port=2, resize=(self.width, self.height))
-            else:
-                self.camera.start_recording(self.stream, format='h264', intra_period=self.intra_period,
-                                            inline_headers=self.inline_headers, bitrate=self.bitrate)
+                self.stream_splitter_port = 2
+            self.record_stream()
 
             while self.streaming:
-                self.wait_streaming(1)
+                self.wait_streaming(0.1)
+                if self.updates:
+                    self.apply_updates()
 
         else:
 
@@ -186,10 +233,17 @@ class Camera(object):
             self.width = max(self.width, self.rec_width)
             self.height = max(self.height, self.rec_height)
 
-            # Open the device
-            control = Control(self.device)
-            control.set_control_value(9963800, 2)
-            control.close()
+            # Configure the encoder to only repeat the parameter sets if inline headers are requested (the stream
+            # caches and injects them otherwise), and to use the requested bitrate and GOP length. The control
+            # interface is kept open to force keyframes and change the encoder settings.
+            self.control = Control(self.device)
+            for cid, value in ((v4l.CID_MPEG_VIDEO_REPEAT_SEQ_HEADER, int(self.inline_headers)),
+                               (v4l.CID_MPEG_VIDEO_BITRATE, self.bitrate),
+                               (v4l.CID_MPEG_VIDEO_H264_I_PERIOD, self.intra_period)):
+                try:
+                    self.control.set_control_value(cid, value)
+                except (AttributeError, v4l.CameraError) as e:
+                    logging.debug("Unable to set the encoder control 0x%x: %s" % (cid, e))
 
             # Start streaming frames
             frame = Frame(self.device, self.width, self.height)
@@ -197,13 +251,96 @@ class Camera(object):
             while self.streaming:
                 frame_data = frame.get_frame()
                 self.stream.write(frame_data)
+                if self.updates:
+                    self.apply_updates()
+            self.control.close()
+            self.control = None
+
+    def record_stream(self):
+        """Start the picamera encoder of the video stream"""
+        if self.stream_splitter_port == 2:
+            self.camera.start_recording(self.stream, format='h264', intra_period=self.intra_period,
+                                        inline_headers=self.inline_headers, bitrate=self.bitrate, quality=self.quality,
+                                        splitter_port=2, resize=(self.width, self.height))
+        else:
+            self.camera.start_recording(self.stream, format='h264', intra_period=self.intra_period,
+                                        inline_headers=self.inline_headers, bitrate=self.bitrate)
+
+    def update(self, params):
+        """
+        Change the bitrate, quality, intra_period, fec_ratio, header_period and/or keyframe_interval while
+        streaming. The changes are applied by the streaming loop.
+        """
+        with self.update_lock:
+            self.updates.update(params)
+
+    def apply_updates(self):
+        with self.update_lock:
+            params = self.updates
+            self.updates = {}
+
+        # The quality is only used by the picamera encoder while recording, which is the only time that the
+        # stream is encoded with a quality setting
+        if 'quality' in params and not (self.camera and self.stream_splitter_port == 2):
+            logging.warning("The video quality isn't used by this encoder, so it wasn't changed")
+            del params['quality']
+        if not params:
+            return
+        logging.info("Changing the video stream parameters: " +
+                     ', '.join("%s=%s" % (k, v) for k, v in sorted(params.items())))
+        if 'fec_ratio' in params:
+            self.stream.set_fec_ratio(params['fec_ratio'])
+        if 'header_period' in params:
+            self.stream.header_period = params['header_period']
+        if 'keyframe_interval' in params:
+            self.keyframe_interval = params['keyframe_interval']
+
+        # Reconfigure the encoder. picamera can't change the encoder settings while recording, so only
+        # the stream's encoder is restarted (which starts with a keyframe), and the camera stays open.
+        encoder = [k for k in ('bitrate', 'quality', 'intra_period') if k in params]
+        for k in encoder:
+            setattr(self, k, params[k])
+        if encoder and self.camera:
+            try:
+                self.camera.stop_recording(splitter_port=self.stream_splitter_port)
+                self.record_stream()
+            except Exception as e:
+                logging.error("Unable to restart the video encoder: " + str(e))
+        elif encoder and self.control:
+            for cid, value in ((v4l.CID_MPEG_VIDEO_BITRATE, self.bitrate),
+                               (v4l.CID_MPEG_VIDEO_H264_I_PERIOD, self.intra_period)):
+                try:
+                    self.control.set_control_value(cid, value)
+                except (AttributeError, v4l.CameraError) as e:
+                    logging.warning("Unable to set the encoder control 0x%x: %s" % (cid, e))
+
+    def request_keyframe(self):
+        """Force the encoder to send an IDR frame (and the parameter sets), at most every keyframe_interval seconds"""
+        self.keyframe_requests += 1
+        now = time.monotonic()
+        if not self.streaming or (now - self.last_keyframe) < self.keyframe_interval:
+            return False
+        self.last_keyframe = now
+        try:
+            if self.camera:
+                self.camera.request_key_frame(splitter_port=self.stream_splitter_port)
+            elif self.control:
+                self.control.set_control_value(v4l.CID_MPEG_VIDEO_FORCE_KEY_FRAME, 1)
+            else:
+                return False
+        except Exception as e:
+            logging.warning("Unable to force a keyframe: " + str(e))
+            return False
+        self.stream.request_headers()
+        self.keyframes_forced += 1
+        return True
 
     def wait_streaming(self, time):
         if self.camera:
             self.camera.wait_recording(time)
 
     def stop_streaming(self):
-        if found_picamera:
+        if found_picamera and self.camera:
             if self.recording:
                 self.camera.stop_recording(splitter_port=2)
             if self.streaming:
@@ -215,27 +352,49 @@ class Camera(object):
 class CameraProcess(object):
 
     def __init__(self, width = 10000, height = 10000, device = False, prefer_picam = True,
-                 host = "", port = 5600, bitrate = 3000000, quality = 20, inline_headers = True, \
-                 fps = 30, intra_period = 5, blocksize=1400, fec_ratio=0.0):
+                 host = "", port = 5600, bitrate = 3000000, quality = 20, inline_headers = False, \
+                 fps = 30, intra_period = 5, blocksize=1400, fec_ratio=0.0, trace_dir=None, header_period=0.5,
+                 keyframe_port=0, keyframe_interval=0.25):
         self.host = host
         self.port = port
+        self.keyframe_port = keyframe_port
+        self.keyframe_interval = keyframe_interval
         self.bitrate = bitrate
         self.quality = quality
         self.inline_headers = inline_headers
         self.intra_period = intra_period
         self.blocksize = blocksize
         self.fec_ratio = fec_ratio
+        self.trace_dir = trace_dir
+        self.header_period = header_period
         self.width = width
         self.height = height
         self.device = device
         self.fps = fps
         self.prefer_picam = prefer_picam
+        self.proc = None
+
+        # The control channel that passes parameter changes to the camera process
+        self.updates = mp.Queue()
 
     def start(self):
         self.proc = mp.Process(target=self.run)
         self.proc.start()
         return True;
 
+    def update(self, **params):
+        """Change the parameters that can be changed while streaming (see Camera.update)"""
+        self.updates.put(params)
+
+    def running(self):
+        return self.proc is not None and self.proc.is_alive()
+
+    def stop(self):
+        if self.proc:
+            self.proc.terminate()
+            self.proc.join()
+            self.proc = None
+
     def run(self):
         if self.host != "":
             host_port = self.host + ":" + str(self.port)
@@ -265,18 +424,56 @@ class CameraProcess(object):
         logging.info("Streaming %dx%d/%d video to %s at %f Mbps from %s" % \
                      (self.width, self.height, self.fps, host_port, self.bitrate, self.device))
 
-        self.camera = Camera(self.host, self.port, self.device, blocksize=self.blocksize, fec_ratio=self.fec_ratio)
+        self.camera = Camera(self.host, self.port, self.device, blocksize=self.blocksize, fec_ratio=self.fec_ratio,
+                             trace_dir=self.trace_dir, header_period=self.header_period,
+                             keyframe_interval=self.keyframe_interval)
         self.camera.streaming_params(self.width, self.height, self.bitrate, self.intra_period, self.quality,
                                      self.fps, self.inline_headers)
 
+        # Force keyframes when the ground requests them
+        if self.keyframe_port:
+            self.keyframes = KeyframeListener(self.keyframe_port, self.camera)
+
+        # Pass parameter changes from the controller to the camera
+        self.update_thread = threading.Thread(target = self.receive_updates, daemon=True)
+        self.update_thread.start()
+
         # Start streaming
         self.camera.start_streaming()
 
+    def receive_updates(self):
+        while True:
+            self.camera.update(self.updates.get())
+
     def join(self):
         if self.proc:
             self.proc.join()
 
 
+class KeyframeListener(object):
+    """Receive keyframe requests from the ground and pass them on to the camera"""
+
+    def __init__(self, port, camera):
+        self.camera = camera
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('', port))
+        self.thread = threading.Thread(target = self.start, daemon=True)
+        self.thread.start()
+
+    def start(self):
+        reasons = { video_packet.REASON_START: 'start', video_packet.REASON_LOST_FRAME: 'lost frame' }
+        while True:
+            data = self.sock.recv(64)
+            request = video_packet.parse_keyframe_request(data)
+            if request is None:
+                continue
+            reason, frame = request
+            if self.camera.request_keyframe():
+                logging.debug("Forced a keyframe for the ground (%s after frame %d), %d of %d requests" %
+                              (reasons.get(reason, str(reason)), frame, self.camera.keyframes_forced,
+                               self.camera.keyframe_requests))
+
+
 def detect_cameras(device = False):
     '''
     Detect all available cameras and modes, and return a list containing:
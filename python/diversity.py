@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+import zlib
+import logging
+import collections
+
+from openhd.format_as_table import format_as_table
+
+# The fragments of a sequence number that are tracked, so that the bitmap stays small. Later fragments are
+# passed on without being checked for duplicates.
+MAX_FRAGMENTS = 1024
+
+class StreamWindow(object):
+    """
+    A sliding window over the most recent sequence numbers of a stream, with a bitmap of the
+    fragments seen of each one
+    """
+    __slots__ = ('seqs', 'masks', 'newest')
+
+    def __init__(self, size):
+        self.seqs = [None] * size
+        self.masks = [0] * size
+        self.newest = None
+
+class Interface(object):
+    """The packet counts of one receive interface"""
+    __slots__ = ('name', 'received', 'unique', 'prev_received', 'prev_unique')
+
+    def __init__(self, name):
+        self.name = name
+        self.received = 0
+        self.unique = 0
+        self.prev_received = 0
+        self.prev_unique = 0
+
+class DiversityCombiner(object):
+    """
+    Merge the copies of a packet stream received on several interfaces (e.g. wifi adapters), passing
+    on the first copy of each (stream, sequence, fragment) and dropping the rest. A sequence number more
+    than resync behind the newest one means that the sender restarted, and the window starts over, so resync
+    is limited to less than the window. Packets without a sequence number (e.g. FEC) are matched by their
+    content within unframed_time seconds instead. The number of unique packets contributed by each interface
+    shows which one is actually carrying the link.
+    """
+
+    def __init__(self, interfaces, window=1024, resync=1000, unframed_time=0.2):
+        self.window = window
+        self.resync = min(resync, window - 1)
+        self.streams = {}
+        self.interfaces = [Interface(name) for name in interfaces]
+        self.resyncs = 0
+
+        # The (length, CRC) of the recent unframed packets and when they were first received
+        self.unframed_time = unframed_time
+        self.unframed = {}
+        self.unframed_order = collections.deque()
+
+    def accept(self, iface, stream, seq, fragment):
+        """Returns True if this is the first copy of the packet, counting it against interface index iface"""
+        counts = self.interfaces[iface]
+        counts.received += 1
+        if fragment >= MAX_FRAGMENTS:
+            counts.unique += 1
+            return True
+        win = self.streams.get(stream)
+        if win is None:
+            win = self.streams[stream] = StreamWindow(self.window)
+
+        # Slide the window forward, or start over if the sequence jumped back too far (e.g. the sender
+        # restarted)
+        if win.newest is None:
+            win.newest = seq
+        else:
+            diff = (seq - win.newest) & 0xffffffff
+            if diff & 0x80000000:
+                behind = 0x100000000 - diff
+                if behind > self.resync:
+                    logging.info("Stream %s sequence jumped back from %d to %d, resynchronizing" % (stream, win.newest, seq))
+                    win = self.streams[stream] = StreamWindow(self.window)
+                    win.newest = seq
+                    self.resyncs += 1
+            else:
+                win.newest = seq
+
+        slot = seq % self.window
+        if win.seqs[slot] != seq:
+            win.seqs[slot] = seq
+            win.masks[slot] = 0
+        bit = 1 << fragment
+        if win.masks[slot] & bit:
+            return False
+        win.masks[slot] |= bit
+        counts.unique += 1
+        return True
+
+    def accept_unframed(self, iface, packet, now):
+        """Returns True if this is the first copy of a packet that has no sequence number"""
+        counts = self.interfaces[iface]
+        counts.received += 1
+        if len(self.interfaces) < 2:
+            counts.unique += 1
+            return True
+        while self.unframed_order and (now - self.unframed_order[0][0]) > self.unframed_time:
+            t, key = self.unframed_order.popleft()
+            if self.unframed.get(key) == t:
+                del self.unframed[key]
+        key = (len(packet), zlib.crc32(packet))
+        if key in self.unframed:
+            return False
+        self.unframed[key] = now
+        self.unframed_order.append((now, key))
+        counts.unique += 1
+        return True
+
+    def report(self):
+        """Log the packets received and contributed by each interface since the last report"""
+        if len(self.interfaces) < 2 or not logging.getLogger().isEnabledFor(logging.DEBUG):
+            return
+        rows = []
+        total = sum(i.unique - i.prev_unique for i in self.interfaces)
+        for i in self.interfaces:
+            received = i.received - i.prev_received
+            unique = i.unique - i.prev_unique
+            rows.append({ 'interface': i.name,
+                          'received': received,
+                          'unique': unique,
+                          'duplicate': received - unique,
+                          'share_pct': "%5.1f" % (100.0 * unique / total if total else 0) })
+            i.prev_received = i.received
+            i.prev_unique = i.unique
+        keys = list(rows[0].keys())
+        logging.debug(format_as_table(rows, keys, keys, add_newline=True) + "sequence resyncs: %d" % self.resyncs)
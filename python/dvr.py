@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import bisect
+import struct
+import logging
+import argparse
+import threading
+import collections
+
+from openhd import h264
+
+# Each segment is a raw H.264 stream (<prefix>_<number>.h264) with a frame index (<segment>.fidx) of
+# (offset, timestamp in microseconds since the epoch, flags) records, which is appended as the segment
+# is written so that it survives an unclean shutdown.
+FRAME_INDEX = struct.Struct('<QQB7x')
+
+# Frame index flags
+FLAG_KEYFRAME = h264.FLAG_KEYFRAME
+FLAG_HEADERS = h264.FLAG_HEADERS
+
+class DVRSegment(object):
+    """A single recording segment and it's frame index"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.index = open(filename + '.fidx', 'wb')
+        self.length = 0
+        self.start = time.monotonic()
+
+    def write(self, data, index):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.fd, view):]
+        self.index.write(index)
+        self.index.flush()
+        self.length += len(data)
+
+    def close(self):
+        os.close(self.fd)
+        self.index.close()
+
+class DVRWriter(object):
+    """
+    Record the received video frames to segmented, indexed files from a background thread.
+
+    write() only queues the frame, so it never blocks the display path. The queue holds at most max_queue
+    bytes, and frames that don't fit are dropped, after which recording resumes at the next keyframe.
+    The frames are written in write_size chunks, and a new segment is started on the first keyframe after
+    the segment reaches segment_size bytes or segment_time seconds.
+    """
+
+    def __init__(self, directory, segment_size=256 * 1024 * 1024, segment_time=300.0,
+                 max_queue=16 * 1024 * 1024, write_size=1024 * 1024):
+        os.makedirs(directory, exist_ok=True)
+        self.prefix = os.path.join(directory, time.strftime("%Y%m%d-%H%M%S"))
+        self.segment_size = segment_size
+        self.segment_time = segment_time
+        self.max_queue = max_queue
+        self.write_size = write_size
+        self.number = 0
+        self.segment = None
+        self.headers = None
+        self.done = False
+
+        # The frame queue, which is shared with the display path
+        self.queue = collections.deque()
+        self.queued = 0
+        self.gap = False
+        self.cond = threading.Condition()
+        self.frames = 0
+        self.dropped = 0
+
+        self.thread = threading.Thread(target = self.start, daemon=True)
+        self.thread.start()
+
+    def write(self, frame, t=None):
+        """Queue a frame with the given (or current) wall clock time, dropping it if the queue is full"""
+        if self.queued + len(frame) > self.max_queue:
+            self.dropped += 1
+            self.gap = True
+            return
+        with self.cond:
+            self.queue.append((frame, t if t is not None else time.time(), self.gap))
+            self.queued += len(frame)
+            self.gap = False
+            self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            self.done = True
+            self.cond.notify()
+        self.thread.join()
+
+    def join(self):
+        self.thread.join()
+
+    def start(self):
+        buf = bytearray()
+        index = bytearray()
+        waiting_for_keyframe = True
+        while True:
+
+            # Get the next frame, flushing the buffered frames whenever the queue runs dry
+            with self.cond:
+                if not self.queue and not self.done:
+                    self.cond.wait(1.0)
+                item = self.queue.popleft() if self.queue else None
+                if item:
+                    self.queued -= len(item[0])
+            if item is None:
+                if buf:
+                    self.flush(buf, index)
+                if self.done:
+                    break
+                continue
+            frame, t, gap = item
+            flags = h264.frame_flags(frame)
+            if flags & FLAG_HEADERS:
+                self.headers = h264.parameter_sets(frame)
+
+            # Skip to the next keyframe after dropped frames, and only start new segments on keyframes
+            if gap:
+                waiting_for_keyframe = True
+            if waiting_for_keyframe and not (flags & FLAG_KEYFRAME):
+                continue
+            waiting_for_keyframe = False
+            if (flags & FLAG_KEYFRAME) and (self.segment is None or self.segment_full(len(buf))):
+                self.flush(buf, index)
+                self.rotate()
+                if not (flags & FLAG_HEADERS) and self.headers:
+                    self.append(buf, index, self.headers, t, FLAG_HEADERS)
+
+            self.append(buf, index, frame, t, flags)
+            self.frames += 1
+            if len(buf) >= self.write_size:
+                self.flush(buf, index)
+
+        if self.segment:
+            self.segment.close()
+            self.segment = None
+
+    def segment_full(self, pending):
+        return (self.segment.length + pending) >= self.segment_size or \
+            (time.monotonic() - self.segment.start) >= self.segment_time
+
+    def append(self, buf, index, frame, t, flags):
+        index += FRAME_INDEX.pack(self.segment.length + len(buf), int(t * 1e6), flags)
+        buf += frame
+
+    def flush(self, buf, index):
+        if not buf:
+            return
+        try:
+            self.segment.write(buf, index)
+        except OSError as e:
+            logging.warning("Error writing the DVR segment %s: %s" % (self.segment.filename, e))
+        del buf[:]
+        del index[:]
+
+    def rotate(self):
+        if self.segment:
+            self.segment.close()
+        filename = "%s_%04d.h264" % (self.prefix, self.number)
+        self.number += 1
+        logging.debug("Recording video to " + filename)
+        self.segment = DVRSegment(filename)
+
+def read_index(filename):
+    """Read the frame index of a segment as a list of (offset, timestamp, flags) tuples"""
+    with open(filename + '.fidx', 'rb') as fp:
+        buf = fp.read()
+    return [FRAME_INDEX.unpack_from(buf, i) for i in range(0, len(buf) - FRAME_INDEX.size + 1, FRAME_INDEX.size)]
+
+def seek(index, t):
+    """
+    The position in the index of the last keyframe at or before t (seconds since the epoch), backed up to the
+    parameter set (FLAG_HEADERS) records that immediately precede it
+    """
+    keyframes = [i for i, e in enumerate(index) if e[2] & FLAG_KEYFRAME]
+    if not keyframes:
+        return 0
+    k = bisect.bisect_right([index[i][1] for i in keyframes], int(t * 1e6)) - 1
+    i = keyframes[max(0, k)]
+    while i > 0 and not (index[i][2] & FLAG_HEADERS) and (index[i - 1][2] & FLAG_HEADERS):
+        i -= 1
+    return i
+
+def extract(segment, index, t, dst):
+    """
+    Copy a segment to the dst file object from the keyframe before t (seconds since the epoch), starting with the
+    latest parameter sets so that the clip can be decoded on it's own
+    """
+    i = seek(index, t)
+    with open(segment, 'rb') as src:
+
+        # Write the SPS/PPS of the latest earlier headers record if the clip doesn't start with one
+        if not (index[i][2] & FLAG_HEADERS):
+            for j in range(i - 1, -1, -1):
+                if index[j][2] & FLAG_HEADERS:
+                    src.seek(index[j][0])
+                    headers = h264.parameter_sets(src.read(index[j + 1][0] - index[j][0]))
+                    if headers:
+                        dst.write(headers)
+                    break
+
+        src.seek(index[i][0])
+        while True:
+            data = src.read(1024 * 1024)
+            if not data:
+                break
+            dst.write(data)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Extract a clip from a DVR segment starting at the keyframe before a time")
+    parser.add_argument('segment', help="the segment file (e.g. /var/log/openhd/20200101-120000_0000.h264)")
+    parser.add_argument('-s', '--start', type=float, default=0, help="the start time (seconds from the start of the segment)")
+    parser.add_argument('-o', '--output', help="write the clip to this file (the index is summarized if not given)")
+    args = parser.parse_args()
+
+    index = read_index(args.segment)
+    if not index:
+        print("The segment has no frames: " + args.segment)
+        sys.exit(1)
+    t0 = index[0][1] / 1e6
+    if not args.output:
+        keyframes = sum(1 for e in index if e[2] & FLAG_KEYFRAME)
+        print("frames: %d  keyframes: %d  duration: %7.2f s" % (len(index), keyframes, index[-1][1] / 1e6 - t0))
+        sys.exit(0)
+    with open(args.output, 'wb') as dst:
+        extract(args.segment, index, t0 + args.start, dst)
@@ -1,5 +1,4 @@
 
-import numpy as np
 import sys
 import math
 import struct
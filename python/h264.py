@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+# H.264 NAL unit types
+NAL_SLICE = 1
+NAL_IDR = 5
+NAL_SEI = 6
+NAL_SPS = 7
+NAL_PPS = 8
+NAL_AUD = 9
+
+# Flags describing the contents of a frame (access unit)
+FLAG_KEYFRAME = 0x01
+FLAG_HEADERS = 0x02
+
+# How far into a frame to look for the NAL units, since the parameter sets and the first slice are
+# at the start of an access unit
+SCAN_LENGTH = 256
+
+START_CODE = b'\x00\x00\x01'
+
+def nal_units(frame, limit=SCAN_LENGTH):
+    """
+    Yield (type, start, end) for each NAL unit that starts in the first limit bytes of an Annex B
+    frame, where start is the offset of it's start code (including a leading zero byte if there is one)
+    """
+    i = frame.find(START_CODE, 0, min(len(frame), limit))
+    while i >= 0 and i + 3 < len(frame):
+        nal = frame[i + 3] & 0x1f
+        start = i - 1 if i > 0 and frame[i - 1] == 0 else i
+
+        # The unit ends at the next start code, which may be beyond the limit
+        i = frame.find(START_CODE, i + 3)
+        end = len(frame) if i < 0 else (i - 1 if frame[i - 1] == 0 else i)
+        yield nal, start, end
+        if i >= limit:
+            break
+
+def frame_flags(frame):
+    """Determine if a frame contains an IDR slice (FLAG_KEYFRAME) and/or an SPS (FLAG_HEADERS)"""
+    flags = 0
+    for nal, start, end in nal_units(frame):
+        if nal == NAL_IDR:
+            flags |= FLAG_KEYFRAME
+        elif nal == NAL_SPS:
+            flags |= FLAG_HEADERS
+    return flags
+
+def parameter_sets(frame):
+    """Return the SPS and PPS NAL units (with their start codes) at the start of a frame, or None"""
+    ret = b''
+    for nal, start, end in nal_units(frame):
+        if nal == NAL_SPS or nal == NAL_PPS:
+            ret += frame[start:end]
+    return ret or None
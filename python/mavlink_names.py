@@ -0,0 +1,15 @@
+#!/usr/bin/env python3
+
+# The MAVLink v2 dialect is a superset of v1, so it can name every message that can be received
+from pymavlink.dialects.v20 import ardupilotmega as mavlink
+
+def message_id(name):
+    """The ID of a MAVLink message name (e.g. 'ATTITUDE'), or None if it's unknown"""
+    return getattr(mavlink, 'MAVLINK_MSG_ID_' + name.upper(), None)
+
+def message_name(msgid):
+    """The name of a MAVLink message ID, or '' if it's unknown"""
+    cls = mavlink.mavlink_map.get(msgid)
+    if cls is None:
+        return ''
+    return cls.msgname if hasattr(cls, 'msgname') else cls.name
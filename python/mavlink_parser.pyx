@@ -0,0 +1,229 @@
+from libc.string cimport memchr, memcpy, memmove
+from libc.stdlib cimport malloc, free
+from libc.stdint cimport uint8_t, uint16_t, uint32_t, uint64_t
+
+cdef extern from 'ardupilotmega/mavlink.h':
+    enum: MAVLINK_STX
+    enum: MAVLINK_STX_MAVLINK1
+    enum: MAVLINK_IFLAG_SIGNED
+    enum: MAVLINK_SIGNATURE_BLOCK_LEN
+    enum: MAV_MSG_ENTRY_FLAG_HAVE_TARGET_SYSTEM
+    enum: MAV_MSG_ENTRY_FLAG_HAVE_TARGET_COMPONENT
+
+    ctypedef struct mavlink_msg_entry_t:
+        uint32_t msgid
+        uint8_t crc_extra
+        uint8_t min_msg_len
+        uint8_t max_msg_len
+        uint8_t flags
+        uint8_t target_system_ofs
+        uint8_t target_component_ofs
+
+    const mavlink_msg_entry_t *mavlink_get_msg_entry(uint32_t msgid)
+    void crc_init(uint16_t *crcAccum)
+    void crc_accumulate(uint8_t data, uint16_t *crcAccum)
+    void crc_accumulate_buffer(uint16_t *crcAccum, const char *pBuffer, uint16_t length)
+
+# The header length (including the start byte) of each protocol version
+DEF V1_HEADER_LEN = 6
+DEF V2_HEADER_LEN = 10
+DEF CRC_LEN = 2
+
+cdef class MavlinkParser:
+    """
+    Find MAVLink v1/v2 frames in a raw byte stream and validate their CRC.
+
+    Bytes are appended with feed(), and each call to parse() that returns True exposes the next
+    valid frame through the msgid, sysid, compid, seq, version, target_system, target_component
+    and offset attributes and the frame and payload memory views. The target is 0 (broadcast) for
+    messages without target fields. The views point into the parser buffer and are only valid until the
+    next call to feed().
+
+    Frames with a msgid that isn't in the dialect can't be CRC checked, so they are counted as unknown and
+    skipped as noise, unless pass_unknown is set, in which case they are returned with crc_checked False.
+    """
+    cdef uint8_t *buf
+    cdef size_t capacity
+    cdef size_t head
+    cdef size_t tail
+    cdef size_t frame_start
+    cdef size_t frame_len
+    cdef size_t payload_start
+    cdef size_t payload_len
+
+    cdef readonly uint64_t base
+    cdef readonly uint64_t offset
+    cdef readonly uint32_t msgid
+    cdef readonly uint8_t sysid
+    cdef readonly uint8_t compid
+    cdef readonly uint8_t seq
+    cdef readonly uint8_t version
+    cdef readonly uint8_t target_system
+    cdef readonly uint8_t target_component
+    cdef readonly bint crc_checked
+    cdef readonly bint pass_unknown
+    cdef readonly uint64_t frames
+    cdef readonly uint64_t crc_errors
+    cdef readonly uint64_t unknown
+    cdef readonly uint64_t bad_bytes
+
+    def __cinit__(self, size_t capacity=16384, bint pass_unknown=False):
+        self.buf = <uint8_t*>malloc(capacity)
+        if self.buf == NULL:
+            raise MemoryError()
+        self.capacity = capacity
+        self.pass_unknown = pass_unknown
+        self.head = 0
+        self.tail = 0
+        self.base = 0
+
+    def __dealloc__(self):
+        free(self.buf)
+
+    def feed(self, const uint8_t[:] data):
+        """Append bytes to the parse buffer"""
+        cdef size_t n = data.shape[0]
+        cdef size_t drop
+        if n == 0:
+            return
+
+        # Only keep the most recent bytes if there's more data than buffer space
+        if n > self.capacity:
+            self.bad_bytes += (self.tail - self.head) + (n - self.capacity)
+            self.base += (self.tail - self.head) + (n - self.capacity)
+            self.head = self.tail = 0
+            data = data[n - self.capacity:]
+            n = self.capacity
+
+        # Compact the buffer, dropping the oldest bytes if they still don't fit
+        if self.tail + n > self.capacity:
+            if (self.tail - self.head) + n > self.capacity:
+                drop = (self.tail - self.head) + n - self.capacity
+                self.head += drop
+                self.base += drop
+                self.bad_bytes += drop
+            memmove(self.buf, self.buf + self.head, self.tail - self.head)
+            self.tail -= self.head
+            self.head = 0
+
+        memcpy(self.buf + self.tail, &data[0], n)
+        self.tail += n
+
+    def pending(self):
+        """The number of buffered bytes that are not yet part of a complete frame"""
+        return self.tail - self.head
+
+    def take_pending(self):
+        """Remove and return the buffered partial frame"""
+        ret = self.buf[self.head:self.tail]
+        self.base += self.tail - self.head
+        self.head = self.tail = 0
+        return ret
+
+    cdef inline void skip(self, size_t n):
+        self.head += n
+        self.base += n
+        self.bad_bytes += n
+
+    def parse(self):
+        """Find the next valid frame. Returns False if more data is needed"""
+        cdef uint8_t *p
+        cdef uint8_t *next_v1
+        cdef uint8_t *next_v2
+        cdef size_t avail, hlen, flen, plen
+        cdef uint16_t crc
+        cdef uint32_t msgid
+        cdef const mavlink_msg_entry_t *entry
+
+        while True:
+            avail = self.tail - self.head
+            if avail < 3:
+                return False
+            p = self.buf + self.head
+
+            # Resynchronize on the next start byte
+            if p[0] != MAVLINK_STX and p[0] != MAVLINK_STX_MAVLINK1:
+                next_v1 = <uint8_t*>memchr(p, MAVLINK_STX_MAVLINK1, avail)
+                next_v2 = <uint8_t*>memchr(p, MAVLINK_STX, avail)
+                if next_v1 == NULL and next_v2 == NULL:
+                    self.skip(avail)
+                elif next_v1 == NULL or (next_v2 != NULL and next_v2 < next_v1):
+                    self.skip(next_v2 - p)
+                else:
+                    self.skip(next_v1 - p)
+                continue
+
+            # Determine the frame length
+            plen = p[1]
+            if p[0] == MAVLINK_STX_MAVLINK1:
+                hlen = V1_HEADER_LEN
+                flen = hlen + plen + CRC_LEN
+            else:
+                hlen = V2_HEADER_LEN
+                flen = hlen + plen + CRC_LEN
+                if p[2] & MAVLINK_IFLAG_SIGNED:
+                    flen += MAVLINK_SIGNATURE_BLOCK_LEN
+            if avail < flen:
+                return False
+
+            if p[0] == MAVLINK_STX_MAVLINK1:
+                msgid = p[5]
+            else:
+                msgid = p[7] | (p[8] << 8) | (p[9] << 16)
+
+            # Validate the CRC if this is a known message. Unknown messages are resynchronized past
+            # unless they are passed through unchecked.
+            self.target_system = 0
+            self.target_component = 0
+            entry = mavlink_get_msg_entry(msgid)
+            if entry != NULL:
+                crc_init(&crc)
+                crc_accumulate_buffer(&crc, <const char*>(p + 1), hlen - 1 + plen)
+                crc_accumulate(entry.crc_extra, &crc)
+                if (p[hlen + plen] | (p[hlen + plen + 1] << 8)) != crc:
+                    self.crc_errors += 1
+                    self.skip(1)
+                    continue
+                self.crc_checked = True
+
+                # Extract the target, which may have been truncated from a v2 payload if it was zero
+                if (entry.flags & MAV_MSG_ENTRY_FLAG_HAVE_TARGET_SYSTEM) and entry.target_system_ofs < plen:
+                    self.target_system = p[hlen + entry.target_system_ofs]
+                if (entry.flags & MAV_MSG_ENTRY_FLAG_HAVE_TARGET_COMPONENT) and entry.target_component_ofs < plen:
+                    self.target_component = p[hlen + entry.target_component_ofs]
+            else:
+                self.unknown += 1
+                if not self.pass_unknown:
+                    self.skip(1)
+                    continue
+                self.crc_checked = False
+
+            # Fill in the frame information
+            self.msgid = msgid
+            self.seq = p[2] if hlen == V1_HEADER_LEN else p[4]
+            self.sysid = p[3] if hlen == V1_HEADER_LEN else p[5]
+            self.compid = p[4] if hlen == V1_HEADER_LEN else p[6]
+            self.version = 1 if hlen == V1_HEADER_LEN else 2
+            self.frame_start = self.head
+            self.frame_len = flen
+            self.payload_start = self.head + hlen
+            self.payload_len = plen
+            self.offset = self.base
+            self.head += flen
+            self.base += flen
+            self.frames += 1
+            return True
+
+    @property
+    def frame(self):
+        """A view of the complete current frame"""
+        if self.frame_len == 0:
+            return None
+        return memoryview(<uint8_t[:self.frame_len]>(self.buf + self.frame_start))
+
+    @property
+    def payload(self):
+        """A view of the payload of the current frame"""
+        if self.payload_len == 0:
+            return memoryview(b'')
+        return memoryview(<uint8_t[:self.payload_len]>(self.buf + self.payload_start))
@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import socket
+import logging
+import selectors
+import threading
+import collections
+
+import serial
+
+from openhd.mavlink_parser import MavlinkParser
+from openhd.format_as_table import format_as_table
+
+class Endpoint(object):
+    """
+    The common state of a router endpoint: a parser for the incoming byte stream, a bounded queue of
+    outgoing frames, the systems that have been seen on it, and it's counters.
+    """
+
+    def __init__(self, name, max_queue=256):
+        self.name = name
+        self.parser = MavlinkParser()
+        self.queue = collections.deque()
+        self.max_queue = max_queue
+        self.systems = set()
+        self.components = set()
+        self.rx_frames = 0
+        self.tx_frames = 0
+        self.tx_bytes = 0
+        self.drops = 0
+        self.errors = 0
+
+    def push(self, frame):
+        """Queue a frame, dropping the oldest queued frame if the queue is full"""
+        if len(self.queue) >= self.max_queue:
+            self.queue.popleft()
+            self.drops += 1
+        self.queue.append(frame)
+
+    def learn(self, sysid, compid):
+        self.systems.add(sysid)
+        self.components.add((sysid, compid))
+
+    def accepts(self, target_system, target_component):
+        """Does a message addressed to this target need to go to this endpoint?"""
+        if target_system not in self.systems:
+            return False
+        return target_component == 0 or (target_system, target_component) in self.components
+
+    def close(self):
+        pass
+
+class StreamEndpoint(Endpoint):
+    """An endpoint on a byte stream (a UART or TCP connection), written with non-blocking writes"""
+
+    def __init__(self, name, fd, max_queue=256, max_write=4096):
+        Endpoint.__init__(self, name, max_queue)
+        self.fd = fd
+        self.max_write = max_write
+        self.pending = b''
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        """Return the data that's available, or None if the endpoint has closed"""
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return b''
+        except OSError as e:
+            logging.warning("Error reading from " + self.name + ": " + str(e))
+            return None
+        return data if data else None
+
+    def flush(self):
+        """Write as much of the queue as the endpoint will take without blocking"""
+
+        # Coalesce the queued frames into a single write, finishing any partial write first
+        out = bytearray(self.pending)
+        while self.queue and len(out) < self.max_write:
+            out += self.queue.popleft()
+            self.tx_frames += 1
+        if not out:
+            return True
+        try:
+            n = os.write(self.fd, out)
+        except BlockingIOError:
+            n = 0
+        except OSError as e:
+            logging.warning("Error writing to " + self.name + ": " + str(e))
+            self.errors += 1
+            self.pending = b''
+            return False
+        self.tx_bytes += n
+        self.pending = bytes(out[n:])
+        return True
+
+    def busy(self):
+        return bool(self.pending or self.queue)
+
+class SerialEndpoint(StreamEndpoint):
+    """A UART connection (e.g. to a flight controller or a telemetry radio)"""
+
+    def __init__(self, uart, baudrate, max_queue=256):
+        self.serial = serial.Serial(uart, int(baudrate), timeout=0)
+        os.set_blocking(self.serial.fileno(), False)
+
+        # Limit each write to ~20ms worth of bytes so that the queue, not the tty buffer, absorbs bursts
+        max_write = max(64, int(0.02 * int(baudrate) / 10))
+        StreamEndpoint.__init__(self, uart, self.serial.fileno(), max_queue, max_write)
+
+    def close(self):
+        self.serial.close()
+
+class TCPEndpoint(StreamEndpoint):
+    """An accepted TCP connection (e.g. from a GCS)"""
+
+    def __init__(self, sock, addr, max_queue=256):
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        StreamEndpoint.__init__(self, "tcp:%s:%d" % addr, sock.fileno(), max_queue)
+
+    def close(self):
+        self.sock.close()
+
+class UDPEndpoint(Endpoint):
+    """
+    A UDP endpoint. A 'udp' endpoint is bound to a local port and replies to the address that it last
+    received from, and an 'udpout' endpoint sends to a fixed address. Queued frames are packed into
+    datagrams of up to mtu bytes.
+    """
+
+    def __init__(self, name, bind=None, remote=None, max_queue=256, mtu=1400):
+        Endpoint.__init__(self, name, max_queue)
+        self.remote = remote
+        self.fixed = remote is not None
+        self.mtu = mtu
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        if bind:
+            self.sock.bind(bind)
+        self.sock.setblocking(False)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def read(self):
+        try:
+            data, addr = self.sock.recvfrom(65536)
+        except BlockingIOError:
+            return b''
+        except OSError as e:
+            # An ICMP port unreachable from a previous send, which isn't fatal for UDP
+            self.errors += 1
+            return b''
+        if not self.fixed:
+            self.remote = addr
+        return data
+
+    def flush(self):
+        if not self.remote:
+            self.queue.clear()
+            return True
+        while self.queue:
+            out = bytearray(self.queue.popleft())
+            frames = 1
+            while self.queue and len(out) + len(self.queue[0]) <= self.mtu:
+                out += self.queue.popleft()
+                frames += 1
+            try:
+                self.sock.sendto(out, self.remote)
+            except BlockingIOError:
+                # Wait for the socket to become writable
+                self.queue.appendleft(bytes(out))
+                return True
+            except OSError as e:
+                self.errors += 1
+                self.drops += frames
+                continue
+            self.tx_frames += frames
+            self.tx_bytes += len(out)
+        return True
+
+    def busy(self):
+        return bool(self.queue)
+
+    def close(self):
+        self.sock.close()
+
+class TCPServer(object):
+    """Accept TCP connections and add them to the router as endpoints"""
+
+    def __init__(self, name, bind, max_queue=256):
+        self.name = name
+        self.max_queue = max_queue
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(bind)
+        self.sock.listen(4)
+        self.sock.setblocking(False)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def accept(self):
+        try:
+            sock, addr = self.sock.accept()
+        except OSError:
+            return None
+        return TCPEndpoint(sock, addr, self.max_queue)
+
+    def close(self):
+        self.sock.close()
+
+def parse_endpoint(spec, max_queue=256, mtu=1400):
+    """
+    Create an endpoint from a mavproxy style connection string:
+       udp:<host>:<port>     listen on a UDP port and reply to the last sender
+       udpout:<host>:<port>  send to a UDP address
+       tcp:<port>            accept TCP connections (e.g. from a GCS)
+       /dev/<uart>:<baud>    a serial port
+    """
+    spec = spec.strip()
+    fields = spec.split(':')
+    if fields[0] == 'udp' and len(fields) == 3:
+        return UDPEndpoint(spec, bind=(fields[1], int(fields[2])), max_queue=max_queue, mtu=mtu)
+    elif fields[0] == 'udpout' and len(fields) == 3:
+        return UDPEndpoint(spec, remote=(fields[1], int(fields[2])), max_queue=max_queue, mtu=mtu)
+    elif fields[0] == 'tcp' and len(fields) == 2:
+        return TCPServer(spec, ('', int(fields[1])), max_queue)
+    elif fields[0].startswith('/dev/'):
+        return SerialEndpoint(fields[0], fields[1] if len(fields) > 1 else 57600, max_queue)
+    raise Exception("Invalid MAVLink router endpoint: " + spec)
+
+class MavlinkRouter(object):
+    """
+    Forward MAVLink frames between any number of endpoints from a single thread.
+
+    Messages with a target system are only sent to the endpoints that the target has been seen on
+    (or all other endpoints if the target hasn't been seen yet), and everything else is sent to all
+    other endpoints. Frames that arrive on more than one endpoint (e.g. over redundant links) within
+    dedup_time seconds of the first copy are only forwarded once.
+    """
+
+    def __init__(self, endpoints, max_queue=256, mtu=1400, dedup_time=0.25, report_period=10.0):
+        if isinstance(endpoints, str):
+            endpoints = [parse_endpoint(s, max_queue, mtu) for s in endpoints.split(',') if s.strip()]
+        self.selector = selectors.DefaultSelector()
+        self.endpoints = []
+        self.servers = []
+        self.dedup_time = dedup_time
+        self.recent = collections.deque()
+        self.first_seen = {}
+        self.duplicates = 0
+        self.report_period = report_period
+        self.done = False
+        for e in endpoints:
+            self.add(e)
+        self.thread = threading.Thread(target = self.start, daemon=True)
+        self.thread.start()
+
+    def add(self, endpoint):
+        if isinstance(endpoint, TCPServer):
+            self.servers.append(endpoint)
+        else:
+            self.endpoints.append(endpoint)
+        self.selector.register(endpoint, selectors.EVENT_READ)
+
+    def remove(self, endpoint):
+        self.selector.unregister(endpoint)
+        self.endpoints.remove(endpoint)
+        endpoint.close()
+
+    def join(self):
+        self.thread.join()
+
+    def duplicate(self, src, key, now):
+        """
+        Is this frame, identified by (sysid, compid, seq, msgid), a copy of one that was recently received
+        on another endpoint? Repeats on the same endpoint are new frames (e.g. after the seq wraps).
+        """
+        while self.recent and (now - self.recent[0][0]) > self.dedup_time:
+            t, k = self.recent.popleft()
+            first = self.first_seen.get(k)
+            if first is not None and first[1] == t:
+                del self.first_seen[k]
+        first = self.first_seen.get(key)
+        if first is not None and first[0] is not src:
+            self.duplicates += 1
+            return True
+        self.first_seen[key] = (src, now)
+        self.recent.append((now, key))
+        return False
+
+    def route(self, src):
+        """Forward all the complete frames received from an endpoint"""
+        parser = src.parser
+        now = time.monotonic()
+        while parser.parse():
+            src.rx_frames += 1
+            src.learn(parser.sysid, parser.compid)
+            if self.duplicate(src, (parser.sysid, parser.compid, parser.seq, parser.msgid), now):
+                continue
+            frame = bytes(parser.frame)
+            target = parser.target_system
+            if target:
+                dests = [e for e in self.endpoints if e is not src and e.accepts(target, parser.target_component)]
+                if not dests:
+                    dests = [e for e in self.endpoints if e is not src]
+            else:
+                dests = [e for e in self.endpoints if e is not src]
+            for e in dests:
+                e.push(frame)
+
+    def flush(self, endpoint):
+        """Write the endpoint queue, closing TCP connections that have failed"""
+        if endpoint.flush() or not isinstance(endpoint, TCPEndpoint):
+            return True
+        logging.info("MAVLink router: closing " + endpoint.name)
+        self.remove(endpoint)
+        return False
+
+    def update_events(self, endpoint):
+        events = selectors.EVENT_READ
+        if endpoint.busy():
+            events |= selectors.EVENT_WRITE
+        if self.selector.get_key(endpoint).events != events:
+            self.selector.modify(endpoint, events)
+
+    def start(self):
+        prev_report = time.monotonic()
+        while not self.done:
+            for key, events in self.selector.select(1.0):
+                e = key.fileobj
+                if isinstance(e, TCPServer):
+                    conn = e.accept()
+                    if conn:
+                        logging.info("MAVLink router: new connection " + conn.name)
+                        self.add(conn)
+                    continue
+                if events & selectors.EVENT_READ:
+                    data = e.read()
+                    if data is None:
+                        logging.info("MAVLink router: closing " + e.name)
+                        self.remove(e)
+                        continue
+                    if data:
+                        e.parser.feed(data)
+                        self.route(e)
+                if events & selectors.EVENT_WRITE:
+                    self.flush(e)
+
+            # Try to write the newly queued frames immediately, and wait for the endpoints that are full
+            for e in list(self.endpoints):
+                if e.busy() and not self.flush(e):
+                    continue
+                self.update_events(e)
+
+            now = time.monotonic()
+            if (now - prev_report) > self.report_period:
+                self.report()
+                prev_report = now
+
+    def stats(self):
+        return [{ 'endpoint': e.name,
+                  'systems': ' '.join(str(s) for s in sorted(e.systems)),
+                  'rx': e.rx_frames,
+                  'tx': e.tx_frames,
+                  'queued': len(e.queue),
+                  'drops': e.drops,
+                  'errors': e.errors } for e in self.endpoints]
+
+    def report(self):
+        if self.endpoints and logging.getLogger().isEnabledFor(logging.DEBUG):
+            stats = self.stats()
+            keys = list(stats[0].keys())
+            logging.debug(format_as_table(stats, keys, keys, add_newline=True) +
+                          "duplicates: %d" % self.duplicates)
+
+if __name__ == '__main__':
+    import sys
+    logging.basicConfig(level=logging.DEBUG)
+    if len(sys.argv) < 3:
+        sys.stderr.write("Usage: " + sys.argv[0] + " <endpoint> <endpoint> [...]\n")
+        sys.exit(1)
+    router = MavlinkRouter(",".join(sys.argv[1:]), report_period=2.0)
+    router.join()
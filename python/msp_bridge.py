@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+import math
+import time
+import logging
+import threading
+
+from pymavlink.dialects.v10 import ardupilotmega as mavlink
+from openhd import tx_scheduler
+from openhd.format_as_table import format_as_table
+
+# The MSP messages that can be polled: name -> (MultiWii getter, MSP command, response payload size)
+MSP_MESSAGES = {
+    'attitude': ('getAttitude', 108, 6),
+    'altitude': ('getAltitude', 109, 6),
+    'gps': ('getGPS', 106, 16),
+    'analog': ('getAnalog', 110, 7),
+    'status': ('getStatus', 101, 11)
+}
+
+# The overhead of an MSP v1 request / response ('$', 'M', direction, size, command, checksum)
+MSP_OVERHEAD = 6
+
+# The fraction of the UART bandwidth that the polling is allowed to use
+MAX_UTILIZATION = 0.8
+
+def parse_msp_rates(spec):
+    """
+    Parse a polling rate specification of the form:
+       attitude:20, altitude:10, gps:5, analog:2, status:2
+    Returns a dictionary of message name -> rate in Hz
+    """
+    ret = {}
+    for entry in spec.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        fields = [f.strip() for f in entry.split(':')]
+        if len(fields) != 2 or fields[0] not in MSP_MESSAGES:
+            raise Exception("Invalid MSP rate entry: " + entry)
+        ret[fields[0]] = float(fields[1])
+    return ret
+
+class PolledMessage(object):
+    """The schedule and counters of one polled MSP message"""
+    __slots__ = ('name', 'getter', 'command', 'size', 'requested', 'rate', 'period', 'next_time', 'responses')
+
+    def __init__(self, name, rate):
+        self.name = name
+        self.getter, self.command, self.size = MSP_MESSAGES[name]
+        self.requested = rate
+        self.set_rate(rate)
+        self.next_time = 0
+        self.responses = 0
+
+    def set_rate(self, rate):
+        self.rate = rate
+        self.period = 1.0 / rate
+
+    def poll_bytes(self):
+        """The number of bytes on the UART for one request and response"""
+        return MSP_OVERHEAD + MSP_OVERHEAD + self.size
+
+class MSPBridge(object):
+    """
+    Poll a MultiWii (MSP) flight controller at a configurable rate per message, and send the equivalent
+    MAVLink messages (ATTITUDE, GPS_RAW_INT, SYS_STATUS, VFR_HUD and HEARTBEAT) to the telemetry port
+    """
+
+    def __init__(self, mw, host, port, baudrate=115200, rates='attitude:20, altitude:5, gps:5, analog:2, status:2',
+                 report_period=10.0):
+        self.mw = mw
+        self.host = host
+        self.port = port
+        self.report_period = report_period
+        self.done = False
+        self.mav = mavlink.MAVLink(None, srcSystem=1, srcComponent=1)
+        self.baudrate = baudrate
+        self.set_rates(rates)
+
+        # The latest values of each message, which are combined into the MAVLink messages
+        self.attitude = None
+        self.altitude = None
+        self.gps = None
+        self.analog = None
+        self.status = None
+
+        self.thread = threading.Thread(target = self.start)
+        self.thread.start()
+
+    def running(self):
+        return self.thread.is_alive()
+
+    def join(self):
+        self.thread.join()
+
+    def set_rates(self, rates):
+        """Set the polling rates, which replaces the polling schedule"""
+        messages = [PolledMessage(name, rate) for name, rate in parse_msp_rates(rates).items() if rate > 0]
+
+        # Scale the rates down if the polling would use more than the available UART bandwidth
+        capacity = MAX_UTILIZATION * int(self.baudrate) / 10.0
+        demand = sum(m.requested * m.poll_bytes() for m in messages)
+        if demand > capacity:
+            scale = capacity / demand
+            logging.warning("MSP polling needs %d bytes/s but only %d are available at %d baud, so scaling the rates by %4.2f" %
+                            (demand, capacity, int(self.baudrate), scale))
+            for m in messages:
+                m.set_rate(m.requested * scale)
+        self.messages = messages
+
+    def start(self):
+        sched = tx_scheduler.get_scheduler()
+        next_heartbeat = 0
+        prev_report = time.monotonic()
+        prev_stats = self.mw.getStats()
+
+        while not self.done:
+
+            # Sleep until the next message is due to be polled
+            now = time.monotonic()
+            next_time = min([m.next_time for m in self.messages] + [next_heartbeat])
+            if next_time > now:
+                time.sleep(next_time - now)
+                now = time.monotonic()
+
+            # Poll all the messages that are due with a single pipelined request
+            due = [m for m in self.messages if now >= m.next_time]
+            frames = bytearray()
+            if due:
+                results = self.mw.getMultiple(*[m.getter for m in due])
+                for m, result in zip(due, results):
+                    m.next_time = max(m.next_time + m.period, now)
+                    setattr(self, m.name, result)
+                frames += self.encode(set(m.name for m in due))
+            if now >= next_heartbeat:
+                frames += self.heartbeat()
+                next_heartbeat = now + 1.0
+            if frames:
+                sched.sendto('telemetry', frames, (self.host, self.port))
+
+            # Periodically report the achieved polling rates
+            if (now - prev_report) > self.report_period:
+                stats = self.mw.getStats()
+                self.report(stats, prev_stats, now - prev_report)
+                prev_stats = stats
+                prev_report = now
+
+    def encode(self, updated):
+        """Encode the MAVLink messages that depend on the MSP messages that were just updated"""
+        out = bytearray()
+        boot_ms = int(time.monotonic() * 1000) & 0xFFFFFFFF
+        att = self.attitude
+        if 'attitude' in updated and att:
+            # MSP pitch is positive nose down, and the heading is offset by -180 degrees by the getter
+            out += self.mav.attitude_encode(boot_ms, math.radians(att.angx), -math.radians(att.angy),
+                                            self.yaw(), 0, 0, 0).pack(self.mav)
+        if 'gps' in updated and self.gps:
+            gps = self.gps
+            out += self.mav.gps_raw_int_encode(int(time.time() * 1e6), 3 if gps.fix else 1,
+                                               gps.latitude, gps.longitude, gps.altitude * 1000,
+                                               65535, 65535, gps.speed, gps.course * 10,
+                                               gps.numsat).pack(self.mav)
+        if ('analog' in updated or 'status' in updated) and self.analog:
+            errors = self.status.i2cerrorcount if self.status else 0
+            out += self.mav.sys_status_encode(0, 0, 0, 0, self.analog.vbat * 100, min(self.analog.amperage, 32767),
+                                              -1, 0, errors, 0, 0, 0, 0).pack(self.mav)
+        if 'altitude' in updated and self.altitude:
+            heading = int(math.degrees(self.yaw())) % 360
+            speed = self.gps.speed / 100.0 if self.gps else 0
+            out += self.mav.vfr_hud_encode(0, speed, heading, 0, self.altitude.altitude / 100.0,
+                                           self.altitude.vari / 100.0).pack(self.mav)
+        return out
+
+    def yaw(self):
+        if not self.attitude:
+            return 0
+        heading = (self.attitude.heading + 180) % 360
+        return math.radians(heading - 360 if heading > 180 else heading)
+
+    def heartbeat(self):
+        base_mode = 0
+        if self.status and (self.status.flag & 1):
+            base_mode |= mavlink.MAV_MODE_FLAG_SAFETY_ARMED
+        return self.mav.heartbeat_encode(mavlink.MAV_TYPE_ONBOARD_CONTROLLER, mavlink.MAV_AUTOPILOT_INVALID,
+                                         base_mode, 0, mavlink.MAV_STATE_ACTIVE).pack(self.mav)
+
+    def report(self, stats, prev_stats, dur):
+        """Log the requested, scheduled and achieved polling rate of each message"""
+        if not logging.getLogger().isEnabledFor(logging.DEBUG):
+            return
+        rows = []
+        for m in self.messages:
+            cur = stats.get(m.command, {})
+            prev = prev_stats.get(m.command, {})
+            responses = cur.get('responses', 0) - prev.get('responses', 0)
+            timeouts = cur.get('timeouts', 0) - prev.get('timeouts', 0)
+            rows.append({ 'message': m.name,
+                          'requested_hz': "%6.1f" % m.requested,
+                          'scheduled_hz': "%6.1f" % m.rate,
+                          'achieved_hz': "%6.1f" % (responses / dur),
+                          'timeouts': timeouts,
+                          'rtt_ms': "%6.2f" % (1e3 * cur.get('rtt', 0)) })
+        if rows:
+            keys = list(rows[0].keys())
+            logging.debug(format_as_table(rows, keys, keys, add_newline=True))
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import mmap
+import time
+import struct
+import logging
+import argparse
+
+# The trace file is a fixed size ring of fixed size records behind a small header.
+#   header: magic, version, record size, capacity (records), total records written
+#   record: monotonic time, frame sequence number, stream (port), fragment, size, flags
+HEADER = struct.Struct('<4sHHIQ')
+HEADER_SIZE = 32
+RECORD = struct.Struct('<dIHHHBx')
+MAGIC = b'OHDT'
+VERSION = 1
+
+# Record flags
+FLAG_FEC = 0x01
+FLAG_HEADERS = 0x02
+
+class PacketTrace(object):
+    """Append fixed size packet records to a memory mapped ring file"""
+
+    def __init__(self, filename, capacity=65536):
+        self.filename = filename
+        self.capacity = capacity
+        size = HEADER_SIZE + capacity * RECORD.size
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.count = 0
+        self.map[0:HEADER.size] = HEADER.pack(MAGIC, VERSION, RECORD.size, capacity, 0)
+
+    def __del__(self):
+        self.close()
+
+    def record(self, stream, frame, fragment, size, flags=0):
+        offset = HEADER_SIZE + (self.count % self.capacity) * RECORD.size
+        RECORD.pack_into(self.map, offset, time.monotonic(), frame & 0xffffffff, stream,
+                         fragment & 0xffff, size, flags)
+        self.count += 1
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, RECORD.size, self.capacity, self.count)
+
+    def close(self):
+        if getattr(self, 'map', None):
+            self.map.close()
+            self.map = None
+
+def open_trace(directory, role, port, capacity=65536):
+    """Open the trace file for the given role ('air' or 'ground') and port, or None if disabled"""
+    if not directory:
+        return None
+    try:
+        os.makedirs(directory, exist_ok=True)
+        return PacketTrace(os.path.join(directory, "%s_%d.trace" % (role, port)), capacity)
+    except OSError as e:
+        logging.warning("Unable to open the packet trace in %s: %s" % (directory, e))
+        return None
+
+def read_trace(filename):
+    """Read all the records in a trace file, oldest first, as tuples of
+    (time, frame, stream, fragment, size, flags)"""
+    with open(filename, 'rb') as fp:
+        buf = fp.read()
+    magic, version, record_size, capacity, count = HEADER.unpack_from(buf, 0)
+    if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+        raise Exception("Invalid packet trace file: " + filename)
+    if count <= capacity:
+        indexes = range(count)
+    else:
+        indexes = [(count + i) % capacity for i in range(capacity)]
+    return [RECORD.unpack_from(buf, HEADER_SIZE + i * RECORD.size) for i in indexes]
+
+def align(air, ground):
+    """
+    Match air and ground records by (stream, frame, fragment) and return a dictionary of per-stream
+    statistics. The air and ground monotonic clocks are not synchronized, so latency is reported
+    relative to the fastest packet (i.e. the queueing / retransmission delay above the minimum).
+    """
+    received = {}
+    for rec in ground:
+        key = (rec[2], rec[1], rec[3])
+        if key not in received:
+            received[key] = rec[0]
+
+    streams = {}
+    deltas = []
+    for rec in air:
+        key = (rec[2], rec[1], rec[3])
+        s = streams.setdefault(rec[2], { 'sent': 0, 'lost': 0, 'deltas': [] })
+        s['sent'] += 1
+        if key in received:
+            delta = received[key] - rec[0]
+            s['deltas'].append(delta)
+            deltas.append(delta)
+        else:
+            s['lost'] += 1
+    offset = min(deltas) if deltas else 0
+
+    ret = {}
+    for stream, s in streams.items():
+        lat = sorted([d - offset for d in s['deltas']])
+        n = len(lat)
+        ret[stream] = { 'stream': stream,
+                        'sent': s['sent'],
+                        'lost': s['lost'],
+                        'loss_pct': "%5.2f" % (100.0 * s['lost'] / s['sent']),
+                        'lat_avg_ms': "%7.2f" % (1e3 * sum(lat) / n if n else 0),
+                        'lat_p99_ms': "%7.2f" % (1e3 * lat[min(n - 1, int(0.99 * n))] if n else 0),
+                        'lat_max_ms': "%7.2f" % (1e3 * lat[-1] if n else 0) }
+    return ret
+
+if __name__ == '__main__':
+    from openhd.format_as_table import format_as_table
+
+    parser = argparse.ArgumentParser(description="Compute per-packet loss and latency from air and ground packet traces")
+    parser.add_argument('-a', '--air', nargs='+', required=True, help="the air side trace file(s)")
+    parser.add_argument('-g', '--ground', nargs='+', required=True, help="the ground side trace file(s)")
+    args = parser.parse_args()
+
+    air = []
+    for f in args.air:
+        air.extend(read_trace(f))
+    ground = []
+    for f in args.ground:
+        ground.extend(read_trace(f))
+    stats = list(align(air, ground).values())
+    if not stats:
+        print("No air side packets found")
+        sys.exit(1)
+    keys = list(stats[0].keys())
+    print(format_as_table(stats, keys, keys, 'stream'))
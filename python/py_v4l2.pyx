@@ -4,6 +4,14 @@ import glob
 class CameraError(Exception):
     pass
 
+# The V4L2 controls used to configure the H.264 encoder (from linux/v4l2-controls.h)
+CID_POWER_LINE_FREQUENCY = 0x00980900 + 24
+CID_MPEG_BASE = 0x00990900
+CID_MPEG_VIDEO_BITRATE = CID_MPEG_BASE + 207
+CID_MPEG_VIDEO_REPEAT_SEQ_HEADER = CID_MPEG_BASE + 226
+CID_MPEG_VIDEO_FORCE_KEY_FRAME = CID_MPEG_BASE + 229
+CID_MPEG_VIDEO_H264_I_PERIOD = CID_MPEG_BASE + 358
+
 from libc.errno cimport errno, EINTR, EINVAL
 from libc.string cimport memset, memcpy, strerror
 from libc.stdlib cimport malloc, calloc, free
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+import time
+import struct
+import binascii
+
+# An RC frame is a small header, the channel values and a CRC.
+#   header: magic, version, channel count, sequence number, send time (microseconds since the epoch)
+#   channels: channel count little endian uint16 values
+#   crc: CRC-16/CCITT (binascii.crc_hqx) of the header and channels
+HEADER = struct.Struct('<2sBBIQ')
+CRC = struct.Struct('<H')
+MAGIC = b'RC'
+VERSION = 1
+MAX_CHANNELS = 32
+
+# The channel structs of every possible channel count
+_CHANNELS = [struct.Struct('<%dH' % n) for n in range(MAX_CHANNELS + 1)]
+
+class RCFrameError(Exception):
+    pass
+
+class RCFrame(object):
+    """A decoded RC frame"""
+    __slots__ = ('seq', 'timestamp', 'channels')
+
+    def __init__(self, seq, timestamp, channels):
+        self.seq = seq
+        self.timestamp = timestamp
+        self.channels = channels
+
+    def __repr__(self):
+        return "RCFrame(seq=%d, timestamp=%d, channels=%r)" % (self.seq, self.timestamp, self.channels)
+
+def pack(seq, channels, timestamp=None):
+    """Encode an RC frame. The timestamp defaults to the current time in microseconds."""
+    if len(channels) > MAX_CHANNELS:
+        raise RCFrameError("Too many RC channels: %d" % len(channels))
+    if timestamp is None:
+        timestamp = int(time.time() * 1e6)
+    data = HEADER.pack(MAGIC, VERSION, len(channels), seq & 0xffffffff, timestamp) + _CHANNELS[len(channels)].pack(*channels)
+    return data + CRC.pack(binascii.crc_hqx(data, 0xffff))
+
+def unpack(data):
+    """Decode an RC frame, raising RCFrameError if it's malformed"""
+    if len(data) < HEADER.size + CRC.size:
+        raise RCFrameError("RC frame too short: %d bytes" % len(data))
+    magic, version, count, seq, timestamp = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise RCFrameError("Invalid RC frame magic: %r" % magic)
+    if version != VERSION:
+        raise RCFrameError("Unsupported RC frame version: %d" % version)
+    if count > MAX_CHANNELS or len(data) != HEADER.size + 2 * count + CRC.size:
+        raise RCFrameError("RC frame of %d bytes doesn't match %d channels" % (len(data), count))
+    end = len(data) - CRC.size
+    if CRC.unpack_from(data, end)[0] != binascii.crc_hqx(memoryview(data)[:end], 0xffff):
+        raise RCFrameError("RC frame CRC error")
+    return RCFrame(seq, timestamp, _CHANNELS[count].unpack_from(data, HEADER.size))
+
+def seq_diff(seq, prev):
+    """The signed difference between two 32 bit sequence numbers, allowing for wrap around"""
+    diff = (seq - prev) & 0xffffffff
+    return diff - 0x100000000 if diff & 0x80000000 else diff
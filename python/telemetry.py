@@ -2,191 +2,230 @@
 
 import math
 import time
-import queue
+import logging
 import threading
 import socket
-import struct
-import pymavlink.mavutil as mavutil
-from pymavlink.dialects.v10 import ardupilotmega as mavlink2
+from openhd import rc_frame
+from openhd import udp_batch
 from openhd.MultiWii import MultiWii
 from openhd.MavlinkTelemetry import MavlinkTelemetry
+from openhd.msp_bridge import MSPBridge
+
+# A step back in the RC sequence numbers larger than this is taken as a restart of the transmitter
+RC_RESYNC = 1000
 
 class Telemetry(object):
     '''Process (send/receive/relay) telemetry of various types'''
 
     def __init__(self, protocol='mavlink', uart = "/dev/ttyS0", baudrate = 57600,
                  host = "127.0.0.1", port = 14550,
-                 rc_host = None, rc_port = 14551):
+                 rc_host = None, rc_port = 14551, max_delay = 0, rates = '',
+                 uplink_port = 14556, mtu = 1400, max_hold = 0.005, log_dir = None,
+                 state_socket = None, msp_rates = 'attitude:20, altitude:5, gps:5, analog:2, status:2',
+                 rc_failsafe_timeout = 0.5, rc_failsafe_channels = None):
         self.uart = uart
         self.baudrate = baudrate
         self.done = False
         self.rc_host = rc_host
         self.rc_port = rc_port
-        self.rc_chan = None
+        self.rc_failsafe_channels = rc_failsafe_channels
         self.mavlink = None
-        self.msp_thread = None
+        self.bridge = None
 
         if protocol == "msp":
 
             # Create the MSP interface to the flight controller.
             self.mw = MultiWii()
+            self.mw.responseTimeout = 0.1
+            self.mw.retries = 1
             self.mw.connect(uart, baudrate)
 
-            # Create the mavlink UDP output port
-            self.mavdown = mavutil.mavlink_connection('udpout:127.0.0.1:14550')
-
-            # Create the procesing thread
-            self.msp_thread = threading.Thread(target = self.start_msp)
+            # Poll the flight controller and relay the telemetry as MAVLink
+            self.bridge = MSPBridge(self.mw, host, port, baudrate, msp_rates)
 
         elif protocol == "mavlink":
 
             # Create the mavlink telemetry class
-            self.mavlink = MavlinkTelemetry(uart=uart, baudrate=baudrate, host=host, port=port,
-                                            rc_host=rc_host, rc_port=rc_port)
+            self.mavlink = MavlinkTelemetry(uart=uart, baudrate=baudrate, host=host, port=port, max_delay=max_delay,
+                                            rates=rates, uplink_port=uplink_port, mtu=mtu,
+                                            max_hold=max_hold, log_dir=log_dir, state_socket=state_socket)
 
         else:
             raise Exception("Unsupported telemetry format: " + protocol)
 
-        # Create the RC receive thread
+        # Forward the RC frames to the flight controller as they arrive
         if rc_host:
-            self.recv_thread = threading.Thread(target = self.recv_rc)
+            self.rc = RCReceiver(rc_host, rc_port, self.apply_rc, self.rc_failsafe, rc_failsafe_timeout)
         else:
-            self.recv_thread = None
-
-        # Start the processing threads
-        if self.msp_thread:
-            self.msp_thread.start()
-        if self.recv_thread:
-            self.recv_thread.start()
+            self.rc = None
 
     def __del__(self):
         self.done = True
         self.join()
 
+    def running(self):
+        return bool((self.bridge and self.bridge.running()) or (self.mavlink and self.mavlink.running()))
+
     def join(self):
-        if self.msp_thread:
-            self.thread.join()
-        if self.recv_thread:
-            self.recv_thread.start()
+        if self.bridge:
+            self.bridge.join()
         if self.mavlink:
             self.mavlink.join()
                     
-    def start_msp(self):
-
-        counter = 0
-        while not self.done:
-
-            # High frequency messages
-            if counter % 10:
-                att = self.mw.getAttitude()
-                misc = self.mw.getMisc()
-
-                # Send the attitude message
-                roll = float(att["angx"]) * math.pi / 180.0
-                pitch = float(att["angy"]) * math.pi / 180.0
-                yaw = float(att["heading"]) * math.pi / 18.0
-                rollspeed = 0; # rad/s
-                pitchspeed = 0; # rad/s
-                yawspeed = 0; # rad/s
-                self.mavdown.mav.attitude_send(0, roll, pitch, yaw, rollspeed, pitchspeed, yawspeed)
-            
-            # Low frequency messages
-            if counter % 100:
-
-                # Send a heartbeat message
-                self.mavdown.mav.heartbeat_send(mavutil.mavlink.MAV_TYPE_ONBOARD_CONTROLLER,
-                                                mavutil.mavlink.MAV_AUTOPILOT_INVALID, 0, 0, 0)
-
-            # Update the RC channels if available
-            if self.rc_chan:
-                self.mw.setRC(self.rc_chan)
-                self.rc_chan = None
-
-            # Loop with a period of 10ms
-            counter += 1
-            time.sleep(0.01)
-
-    def recv_rc(self):
-
-        # Create the receive socket
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-
-        # Find to the receive port
-        sock.bind((self.rc_host, self.rc_port))
-
-        # Receive RC messages off the UDP port
-        while True:
-
-            # Receive the next RC message
-            data, addr = sock.recvfrom(1024)
-
-            # Unpack the channels
-            self.rc_chan = struct.unpack("<HHHHHHHHHHHHHHHH", data)
-
-class UDPTelemetryRx(object):
-    """Receive telemetry over a standard UDP port"""
-
-    def __init__(self, queue, host, port):
-        self.queue = queue
+    def set_rates(self, rates, msp_rates):
+        """Change the MAVLink rate policy or the MSP polling rates while running"""
+        if self.mavlink:
+            self.mavlink.set_rates(rates)
+        if self.bridge:
+            self.bridge.set_rates(msp_rates)
+
+    def apply_rc(self, channels):
+        """Forward a set of RC channels to the flight controller without waiting for a response"""
+        if self.bridge:
+            self.mw.setRC(channels, wait=False)
+        elif self.mavlink:
+            self.mavlink.send_rc(channels)
+
+    def rc_failsafe(self):
+        """
+        Called when the RC frames stop. Send the configured failsafe channels if there are any, otherwise
+        release the MAVLink overrides, or stop sending MSP RC so that the flight controller's own failsafe engages.
+        """
+        if self.rc_failsafe_channels:
+            self.apply_rc(self.rc_failsafe_channels)
+        elif self.mavlink:
+            self.mavlink.release_rc()
+
+class RCReceiver(object):
+    """
+    Receive RC frames over UDP and apply them as soon as they arrive. Frames that arrive out of order
+    are dropped rather than applied. If no frames arrive for failsafe_timeout seconds, failsafe is
+    called (and then again every failsafe_timeout seconds) until they resume. A failsafe_timeout of 0 (or
+    less) disables the failsafe.
+
+    The latency is measured against the transmitter's clock, so it's only absolute if the ground and air
+    clocks are synchronized, but the variation is meaningful either way.
+    """
+
+    def __init__(self, host, port, apply, failsafe, failsafe_timeout=0.5, report_period=10.0):
         self.host = host
         self.port = port
+        self.apply = apply
+        self.failsafe = failsafe
+        self.failsafe_timeout = failsafe_timeout
+        self.report_period = report_period
         self.done = False
-        self.mavs = mavutil.mavlink_connection(host + ":" + str(port), write=False, input=True)
-        self.thread = threading.Thread(target = self.start)
+        self.failsafes = 0
+        self.reset_stats()
+        self.thread = threading.Thread(target = self.start, daemon=True)
         self.thread.start()
 
-    def __del__(self):
-        self.done = True
-        self.thread.join()
-
-    def start(self):
-        while not self.done:
-            msg = self.mavs.recv_msg()
-            if msg:
-                self.queue.put(msg)
-
-class UDPTelemetryTx(object):
-    """Send telemetry over a UDP socket"""
+    def reset_stats(self):
+        self.frames = 0
+        self.bad_frames = 0
+        self.lost = 0
+        self.reordered = 0
+        self.interval_sum = 0.0
+        self.interval_sum2 = 0.0
+        self.interval_max = 0.0
+        self.latency_sum = 0.0
+        self.latency_min = None
+        self.latency_max = None
+        self.apply_max = 0.0
 
-    def __init__(self, queue, host, port, broadcast=False):
-        self.queue = queue
-        self.host = host
-        self.port = port
-        self.done = False
-        self.mavs = mavutil.mavlink_connection(host + ":" + str(port), write=True, input=False)
-        self.thread = threading.Thread(target = self.start)
-        self.thread.start()
-
-    def __del__(self):
-        self.done = True
+    def join(self):
         self.thread.join()
 
     def start(self):
-        while not self.done:
-            msg = self.queue.get()
-            self.mavs.write(msg.get_msgbuf())
-
-class SerialTelemetryTx(object):
-    """Send telemetry over a standard UART connection"""
-
-    def __init__(self, queue, uart = "/dev/ttyS1", baudrate = 57600):
-        self.queue = queue
-        self.uart = uart
-        self.baudrate = baudrate
-        self.done = False
-        self.mavs = mavutil.mavlink_connection(uart, baud=baudrate)
-        self.thread = threading.Thread(target = self.start)
-        self.thread.start()
 
-    def __del__(self):
-        self.done = True
-        self.thread.join()
+        # Create the receive socket. The timeout detects the loss of the RC link.
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((self.host, self.port))
+        sock.settimeout(self.failsafe_timeout if self.failsafe_timeout > 0 else None)
 
-    def start(self):
+        in_failsafe = False
+        prev_frame = None
+        prev_seq = None
+        prev_report = time.monotonic()
         while not self.done:
-            msg = self.mavs.recv_msg()
-            if msg:
-                self.queue.put(msg)
+
+            # Receive the next RC message
+            try:
+                data, addr = sock.recvfrom(1024)
+            except socket.timeout:
+                if not in_failsafe:
+                    logging.warning("RC failsafe: no RC frames received for %4.2f seconds" % self.failsafe_timeout)
+                    self.failsafes += 1
+                    in_failsafe = True
+                self.call(self.failsafe)
+                prev_frame = None
+                prev_seq = None
+                continue
+            now = time.monotonic()
+            received = time.time()
+
+            # Decode the frame
+            try:
+                frame = rc_frame.unpack(data)
+            except rc_frame.RCFrameError as e:
+                logging.debug(str(e))
+                self.bad_frames += 1
+                continue
+
+            # Drop old and duplicate frames. A large step back means the transmitter has restarted.
+            if prev_seq is not None:
+                diff = rc_frame.seq_diff(frame.seq, prev_seq)
+                if diff <= 0 and diff > -RC_RESYNC:
+                    self.reordered += 1
+                    continue
+                if diff > 1:
+                    self.lost += min(diff, RC_RESYNC) - 1
+            prev_seq = frame.seq
+
+            # Apply the channels
+            self.call(self.apply, frame.channels)
+            applied = time.monotonic()
+            if in_failsafe:
+                logging.info("RC frames resumed")
+                in_failsafe = False
+
+            # Track the inter-arrival jitter, the latency and the time taken to apply each frame
+            self.frames += 1
+            if prev_frame is not None:
+                interval = now - prev_frame
+                self.interval_sum += interval
+                self.interval_sum2 += interval * interval
+                self.interval_max = max(self.interval_max, interval)
+            latency = received - 1e-6 * frame.timestamp
+            self.latency_sum += latency
+            self.latency_min = latency if self.latency_min is None else min(self.latency_min, latency)
+            self.latency_max = latency if self.latency_max is None else max(self.latency_max, latency)
+            self.apply_max = max(self.apply_max, applied - now)
+            prev_frame = now
+
+            if (now - prev_report) > self.report_period:
+                self.report()
+                prev_report = now
+
+    def call(self, func, *args):
+        try:
+            func(*args)
+        except Exception as e:
+            logging.warning("Error forwarding RC: " + str(e))
+
+    def report(self):
+        if self.frames > 1:
+            n = self.frames - 1
+            mean = self.interval_sum / n
+            jitter = math.sqrt(max(0.0, self.interval_sum2 / n - mean * mean))
+            loss = 100.0 * self.lost / (self.frames + self.lost)
+            logging.debug("rc: %d frames  interval avg: %6.2f ms  jitter: %6.2f ms  max: %6.2f ms  apply max: %6.2f ms  bad: %d  failsafes: %d" %
+                          (self.frames, 1e3 * mean, 1e3 * jitter, 1e3 * self.interval_max, 1e3 * self.apply_max,
+                           self.bad_frames, self.failsafes))
+            logging.debug("rc: lost: %d (%5.2f%%)  reordered: %d  latency avg: %6.2f ms  min: %6.2f ms  max: %6.2f ms" %
+                          (self.lost, loss, self.reordered, 1e3 * self.latency_sum / self.frames,
+                           1e3 * self.latency_min, 1e3 * self.latency_max))
+        self.reset_stats()
 
 class UDPStatusRx(object):
     """Receive link status messages over UDP"""
@@ -194,9 +233,10 @@ class UDPStatusRx(object):
     def __init__(self, host, port):
         self.max_packet = 1500
 
-        # Create the receive socket
+        # Create the receive socket, and receive any queued messages with a single call
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.bind((host, port))
+        self.receiver = udp_batch.BatchReceiver(self.sock, batch=8, max_packet=self.max_packet)
 
         # Start the receive thread
         self.done = False
@@ -209,8 +249,9 @@ class UDPStatusRx(object):
 
     def start(self):
         while not self.done:
-            data, addr = self.sock.recvfrom(self.max_packet)
-            status = str(data.decode('utf-8')).split(',')
+            for data in self.receiver.views():
+                status = str(data, 'utf-8', 'replace').split(',')
+            self.receiver.recv(1.0)
 
     def join(self):
         self.thread.join()
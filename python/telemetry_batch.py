@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+import time
+import logging
+
+class DatagramBatcher(object):
+    """
+    Pack whole telemetry frames into datagrams of up to mtu bytes, holding a partially filled
+    datagram for at most max_hold seconds
+    """
+
+    def __init__(self, mtu=1400, max_hold=0.005):
+        self.mtu = mtu
+        self.max_hold = max_hold
+        self.buf = bytearray()
+        self.times = []
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.datagrams = 0
+        self.frames = 0
+        self.bytes = 0
+        self.hold_sum = 0.0
+        self.hold_max = 0.0
+
+    def add(self, frame, now):
+        """Add a frame to the current datagram, returning a list of the datagrams that are complete"""
+        ret = []
+        if self.buf and (len(self.buf) + len(frame)) > self.mtu:
+            ret.append(self.flush(now))
+        self.buf += frame
+        self.times.append(now)
+        if len(self.buf) >= self.mtu or self.max_hold <= 0:
+            ret.append(self.flush(now))
+        return ret
+
+    def deadline(self):
+        """The time when the current datagram must be sent, or None if it's empty"""
+        if not self.buf:
+            return None
+        return self.times[0] + self.max_hold
+
+    def flush(self, now):
+        """Return the current datagram (or None if empty) and start a new one"""
+        if not self.buf:
+            return None
+        ret = bytes(self.buf)
+        for t in self.times:
+            self.hold_sum += now - t
+        self.hold_max = max(self.hold_max, now - self.times[0])
+        self.datagrams += 1
+        self.frames += len(self.times)
+        self.bytes += len(ret)
+        self.buf = bytearray()
+        self.times = []
+        return ret
+
+    def report(self):
+        if self.datagrams > 0:
+            logging.debug("telemetry batching: %d datagrams  %5.2f frames/datagram  fill: %5.1f%%  added latency avg: %6.2f ms  max: %6.2f ms" %
+                          (self.datagrams, self.frames / self.datagrams,
+                           100.0 * self.bytes / (self.datagrams * self.mtu),
+                           1e3 * self.hold_sum / self.frames, 1e3 * self.hold_max))
+        self.reset_stats()
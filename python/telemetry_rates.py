@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+import time
+import logging
+
+from openhd.format_as_table import format_as_table
+from openhd.mavlink_names import message_id, message_name
+
+# The per message policies
+PASS = 'pass'
+DROP = 'drop'
+DECIMATE = 'decimate'
+LATEST = 'latest'
+
+def parse_rates(spec):
+    """
+    Parse a rate specification string of the form:
+       ATTITUDE:10, GPS_RAW_INT:5, SYS_STATUS:latest:2, 253:drop, default:pass
+    Messages can be specified by name or by ID. A number is the maximum rate in Hz,
+    'latest:<Hz>' sends only the most recent value at the given rate.
+    Returns a dictionary of msgid (or 'default') -> (policy, rate)
+    """
+    ret = {}
+    for entry in spec.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        fields = [f.strip() for f in entry.split(':')]
+        name = fields[0]
+        if name == 'default':
+            msgid = 'default'
+        elif name.isdigit():
+            msgid = int(name)
+        else:
+            msgid = message_id(name)
+            if msgid is None:
+                raise Exception("Unknown MAVLink message in telemetry rates: " + name)
+        if len(fields) < 2:
+            raise Exception("Invalid telemetry rate entry: " + entry)
+        if fields[1] == PASS:
+            ret[msgid] = (PASS, 0)
+        elif fields[1] == DROP:
+            ret[msgid] = (DROP, 0)
+        elif fields[1] == LATEST and len(fields) == 3:
+            ret[msgid] = (LATEST, float(fields[2]))
+        else:
+            ret[msgid] = (DECIMATE, float(fields[1]))
+    return ret
+
+class MessageRate(object):
+    """The policy, state and counters of a single message ID"""
+    __slots__ = ('policy', 'period', 'next_time', 'held', 'in_msgs', 'in_bytes', 'out_msgs', 'out_bytes')
+
+    def __init__(self, policy, rate):
+        self.policy = policy
+        self.period = (1.0 / rate) if rate > 0 else 0
+        self.next_time = 0
+        self.held = None
+        self.in_msgs = 0
+        self.in_bytes = 0
+        self.out_msgs = 0
+        self.out_bytes = 0
+
+class RateLimiter(object):
+    """Apply a per message ID rate policy (pass, decimate, drop or latest value only) to a telemetry stream"""
+
+    def __init__(self, spec='', report_period=10.0):
+        self.rates = parse_rates(spec) if isinstance(spec, str) else dict(spec)
+        self.default = self.rates.get('default', (PASS, 0))
+        self.msgs = {}
+        self.held = {}
+        self.report_period = report_period
+        self.prev_report = time.monotonic()
+
+    def _get(self, msgid):
+        m = self.msgs.get(msgid)
+        if m is None:
+            m = MessageRate(*self.rates.get(msgid, self.default))
+            self.msgs[msgid] = m
+        return m
+
+    def submit(self, msgid, frame, now):
+        """
+        Returns True if the frame should be sent immediately. Frames with the latest value only policy
+        are copied and held until they are due (see due()).
+        """
+        m = self._get(msgid)
+        size = len(frame)
+        m.in_msgs += 1
+        m.in_bytes += size
+        if m.policy == PASS:
+            pass
+        elif m.policy == DROP:
+            return False
+        elif m.policy == LATEST:
+            m.held = bytes(frame)
+            self.held[msgid] = m
+            return False
+        elif now < m.next_time:
+            return False
+        else:
+            m.next_time = max(m.next_time, now) + m.period
+        m.out_msgs += 1
+        m.out_bytes += size
+        return True
+
+    def next_due(self):
+        """The time that the next held frame is due to be sent, or None"""
+        if not self.held:
+            return None
+        return min(m.next_time for m in self.held.values())
+
+    def due(self, now):
+        """Return a list of the held (latest value only) frames that are due to be sent"""
+        out = []
+        for msgid in [k for k, m in self.held.items() if now >= m.next_time]:
+            m = self.held.pop(msgid)
+            out.append(m.held)
+            m.out_msgs += 1
+            m.out_bytes += len(m.held)
+            m.held = None
+            m.next_time = max(m.next_time, now) + m.period
+        return out
+
+    def stats(self):
+        """Return the per message ID counters, largest input bandwidth first"""
+        ret = []
+        dur = max(time.monotonic() - self.prev_report, 1e-6)
+        for msgid, m in sorted(self.msgs.items(), key=lambda i: i[1].in_bytes, reverse=True):
+            ret.append({ 'msgid': msgid,
+                         'name': message_name(msgid),
+                         'policy': m.policy,
+                         'in_hz': "%6.1f" % (m.in_msgs / dur),
+                         'in_Bps': "%7.1f" % (m.in_bytes / dur),
+                         'out_hz': "%6.1f" % (m.out_msgs / dur),
+                         'out_Bps': "%7.1f" % (m.out_bytes / dur) })
+        return ret
+
+    def report(self, now):
+        if (now - self.prev_report) < self.report_period:
+            return
+        if self.msgs and logging.getLogger().isEnabledFor(logging.DEBUG):
+            stats = self.stats()
+            keys = list(stats[0].keys())
+            logging.debug(format_as_table(stats, keys, keys, add_newline=True))
+        for m in self.msgs.values():
+            m.in_msgs = m.in_bytes = m.out_msgs = m.out_bytes = 0
+        self.prev_report = now
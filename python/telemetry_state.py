@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import threading
+
+from pymavlink.dialects.v20 import ardupilotmega as mavlink
+from openhd.mavlink_names import message_name
+
+class StateEntry(object):
+    """The most recent frame of a message from one system, and the (frame, dict) it was last decoded from"""
+    __slots__ = ('frame', 'time', 'updates', 'decoded')
+
+    def __init__(self):
+        self.frame = None
+        self.time = 0
+        self.updates = 0
+        self.decoded = None
+
+class TelemetryState(object):
+    """
+    Keep the latest value of every message ID / system ID seen on the telemetry stream, and serve
+    it to other processes (e.g. the OSD) over a local Unix datagram socket.
+
+    A request is the message name or ID optionally followed by a system ID (e.g. "ATTITUDE 1"),
+    or "list". The reply is a JSON object.
+    """
+
+    def __init__(self, socket_path='/tmp/openhd_telemetry.sock'):
+        self.entries = {}
+        self.sysids = {}
+        self.lock = threading.Lock()
+        self.mav = mavlink.MAVLink(None)
+        self.socket_path = socket_path
+        self.thread = None
+        if socket_path:
+            self.thread = threading.Thread(target = self.serve, daemon=True)
+            self.thread.start()
+
+    def update(self, msgid, sysid, frame, now):
+        """Store the latest frame of a message (called from the telemetry parser thread)"""
+        key = (msgid, sysid)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = StateEntry()
+            self.sysids.setdefault(msgid, sysid)
+        entry.frame = bytes(frame)
+        entry.time = now
+        entry.updates += 1
+
+    def get(self, msgid, sysid=None):
+        """Return the latest decoded message as a dictionary with it's age in seconds, or None"""
+        if sysid is None:
+            sysid = self.sysids.get(msgid)
+        entry = self.entries.get((msgid, sysid))
+        if entry is None:
+            return None
+        with self.lock:
+            frame = entry.frame
+            cached = entry.decoded
+            if cached is not None and cached[0] is frame:
+                decoded = cached[1]
+            else:
+                try:
+                    msg = self.mav.decode(bytearray(frame))
+                except mavlink.MAVError as e:
+                    return { 'msgid': msgid, 'sysid': sysid, 'error': str(e) }
+                decoded = msg.to_dict()
+                decoded['sysid'] = sysid
+                decoded['compid'] = msg.get_srcComponent()
+                entry.decoded = (frame, decoded)
+        ret = dict(decoded)
+        ret['age'] = time.monotonic() - entry.time
+        ret['updates'] = entry.updates
+        return ret
+
+    def list(self):
+        return [{ 'msgid': k[0], 'sysid': k[1], 'name': message_name(k[0]) } for k in list(self.entries.keys())]
+
+    def handle(self, request):
+        fields = request.split()
+        if not fields:
+            return { 'error': 'empty request' }
+        if fields[0] == 'list':
+            return self.list()
+        if fields[0].isdigit():
+            msgid = int(fields[0])
+        else:
+            msgid = getattr(mavlink, 'MAVLINK_MSG_ID_' + fields[0].upper(), None)
+            if msgid is None:
+                return { 'error': 'unknown message: ' + fields[0] }
+        sysid = int(fields[1]) if len(fields) > 1 else None
+        ret = self.get(msgid, sysid)
+        if ret is None:
+            return { 'error': 'no data', 'msgid': msgid }
+        return ret
+
+    def serve(self):
+        try:
+            os.unlink(self.socket_path)
+        except OSError:
+            pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.bind(self.socket_path)
+        except OSError as e:
+            logging.warning("Unable to create the telemetry state socket %s: %s" % (self.socket_path, e))
+            return
+        while True:
+            data, addr = sock.recvfrom(256)
+            if not addr:
+                continue
+            reply = self.handle(data.decode('utf-8', 'replace'))
+            try:
+                sock.sendto(json.dumps(reply, default=str).encode('utf-8'), addr)
+            except OSError as e:
+                logging.debug("Error replying to telemetry state request: " + str(e))
+
+def query(request, socket_path='/tmp/openhd_telemetry.sock', timeout=1.0):
+    """Query the telemetry state of a running controller, e.g. query('ATTITUDE')"""
+    client_path = "%s.%d" % (socket_path, os.getpid())
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.bind(client_path)
+        sock.settimeout(timeout)
+        sock.sendto(request.encode('utf-8'), socket_path)
+        data = sock.recv(65536)
+        return json.loads(data.decode('utf-8'))
+    finally:
+        sock.close()
+        os.unlink(client_path)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.stderr.write("Usage: " + sys.argv[0] + " <message name|id|list> [sysid]\n")
+        sys.exit(1)
+    print(json.dumps(query(" ".join(sys.argv[1:])), indent=2))
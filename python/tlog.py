@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import mmap
+import glob
+import time
+import array
+import bisect
+import struct
+import argparse
+import threading
+
+# Each record is a standard tlog record (a big endian microsecond timestamp followed by the raw
+# MAVLink frame), so the segments can also be read directly by the pymavlink tools.
+TIMESTAMP = struct.Struct('>Q')
+
+# The index files written when a segment is closed:
+#   <segment>.tidx: (timestamp, offset) pairs every time_step seconds
+#   <segment>.midx: a (msgid, start, count) table followed by the record offsets grouped by msgid
+TIME_INDEX = struct.Struct('<QI')
+MSGID_HEADER = struct.Struct('<I')
+MSGID_ENTRY = struct.Struct('<III')
+
+def frame_length(buf, offset):
+    """The length of the MAVLink frame starting at offset, or 0 if there isn't a valid frame there"""
+    if offset + 3 > len(buf):
+        return 0
+    stx = buf[offset]
+    if stx == 0xFE:
+        return 6 + buf[offset + 1] + 2
+    elif stx == 0xFD:
+        return 10 + buf[offset + 1] + 2 + (13 if buf[offset + 2] & 0x01 else 0)
+    return 0
+
+def frame_msgid(buf, offset):
+    if buf[offset] == 0xFE:
+        return buf[offset + 5]
+    return buf[offset + 7] | (buf[offset + 8] << 8) | (buf[offset + 9] << 16)
+
+class TlogSegment(object):
+    """A single memory mapped, preallocated log segment and it's in memory indexes"""
+
+    def __init__(self, filename, size, time_step):
+        self.filename = filename
+        self.size = size
+        self.time_step = time_step
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.length = 0
+        self.times = array.array('Q')
+        self.time_offsets = array.array('I')
+        self.msgids = {}
+
+    def append(self, frame, usec):
+        """Append a record, returning False if the segment is full"""
+        end = self.length + TIMESTAMP.size + len(frame)
+        if end > self.size:
+            return False
+        offset = self.length
+        TIMESTAMP.pack_into(self.map, offset, usec)
+        self.map[offset + TIMESTAMP.size : end] = frame
+        self.length = end
+
+        # Update the sparse time index and the msgid index
+        if not self.times or (usec - self.times[-1]) >= self.time_step * 1e6:
+            self.times.append(usec)
+            self.time_offsets.append(offset)
+        msgid = frame_msgid(frame, 0)
+        offsets = self.msgids.get(msgid)
+        if offsets is None:
+            offsets = self.msgids[msgid] = array.array('I')
+        offsets.append(offset)
+        return True
+
+    def close(self):
+        """Trim the segment to the length written and write the index files"""
+        self.map.close()
+        os.truncate(self.filename, self.length)
+        write_indexes(self.filename, self.times, self.time_offsets, self.msgids)
+
+def write_indexes(filename, times, time_offsets, msgids):
+    with open(filename + '.tidx', 'wb') as fp:
+        for t, o in zip(times, time_offsets):
+            fp.write(TIME_INDEX.pack(t, o))
+    with open(filename + '.midx', 'wb') as fp:
+        fp.write(MSGID_HEADER.pack(len(msgids)))
+        start = 0
+        for msgid in sorted(msgids):
+            fp.write(MSGID_ENTRY.pack(msgid, start, len(msgids[msgid])))
+            start += len(msgids[msgid])
+        for msgid in sorted(msgids):
+            fp.write(msgids[msgid].tobytes())
+
+class TlogRecorder(object):
+    """Record timestamped raw MAVLink frames to a segmented, indexed log"""
+
+    def __init__(self, directory, segment_size=16 * 1024 * 1024, time_step=1.0):
+        os.makedirs(directory, exist_ok=True)
+        self.prefix = os.path.join(directory, time.strftime("%Y%m%d-%H%M%S"))
+        self.segment_size = segment_size
+        self.time_step = time_step
+        self.number = 0
+        self.lock = threading.Lock()
+        self.segment = None
+        self._rotate()
+
+    def __del__(self):
+        self.close()
+
+    def _rotate(self):
+        if self.segment:
+            self.segment.close()
+        filename = "%s_%04d.tlog" % (self.prefix, self.number)
+        self.number += 1
+        self.segment = TlogSegment(filename, self.segment_size, self.time_step)
+
+    def write(self, frame, t=None):
+        """Append a frame with the given (or current) wall clock time"""
+        usec = int((t if t is not None else time.time()) * 1e6)
+        with self.lock:
+            if not self.segment:
+                return
+            if not self.segment.append(frame, usec):
+                self._rotate()
+                self.segment.append(frame, usec)
+
+    def close(self):
+        with self.lock:
+            if self.segment:
+                self.segment.close()
+                self.segment = None
+
+class TlogReader(object):
+    """Seek and filter a log written by TlogRecorder using it's indexes"""
+
+    def __init__(self, prefix):
+        self.segments = sorted(glob.glob(prefix + '*.tlog'))
+        self.index = [self._load_time_index(s) for s in self.segments]
+
+    def _load(self, filename):
+        with open(filename, 'rb') as fp:
+            return fp.read()
+
+    def _map(self, filename):
+        """Memory map a segment, so that only the records that are visited are read"""
+        if os.path.getsize(filename) == 0:
+            return b''
+        with open(filename, 'rb') as fp:
+            return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _scan(self, buf):
+        """Rebuild the indexes of a segment that wasn't closed cleanly"""
+        times = []
+        offsets = []
+        msgids = {}
+        offset = 0
+        while offset + TIMESTAMP.size < len(buf):
+            usec = TIMESTAMP.unpack_from(buf, offset)[0]
+            flen = frame_length(buf, offset + TIMESTAMP.size)
+            if usec == 0 or flen == 0:
+                break
+            times.append(usec)
+            offsets.append(offset)
+            msgids.setdefault(frame_msgid(buf, offset + TIMESTAMP.size), []).append(offset)
+            offset += TIMESTAMP.size + flen
+        return times, offsets, msgids
+
+    def _load_time_index(self, segment):
+        if not os.path.exists(segment + '.tidx'):
+            times, offsets, msgids = self._scan(self._map(segment))
+            return times, offsets
+        buf = self._load(segment + '.tidx')
+        entries = [TIME_INDEX.unpack_from(buf, i) for i in range(0, len(buf), TIME_INDEX.size)]
+        return [e[0] for e in entries], [e[1] for e in entries]
+
+    def _msgid_offsets(self, segment, msgids):
+        if not os.path.exists(segment + '.midx'):
+            index = self._scan(self._map(segment))[2]
+            return sorted(o for m in msgids for o in index.get(m, []))
+        buf = self._load(segment + '.midx')
+        count = MSGID_HEADER.unpack_from(buf, 0)[0]
+        base = MSGID_HEADER.size + count * MSGID_ENTRY.size
+        ret = []
+        for i in range(count):
+            msgid, start, n = MSGID_ENTRY.unpack_from(buf, MSGID_HEADER.size + i * MSGID_ENTRY.size)
+            if msgid in msgids:
+                offsets = array.array('I')
+                offsets.frombytes(buf[base + start * 4 : base + (start + n) * 4])
+                ret.extend(offsets)
+        return sorted(ret)
+
+    def _start_offset(self, seg, start):
+        times, offsets = self.index[seg]
+        i = bisect.bisect_right(times, start) - 1
+        return offsets[i] if i >= 0 else 0
+
+    def messages(self, msgids=None, start=None, end=None):
+        """
+        Yield (timestamp, frame) tuples, optionally limited to a set of message IDs and a time range
+        (in seconds since the epoch)
+        """
+        start_us = int(start * 1e6) if start is not None else 0
+        end_us = int(end * 1e6) if end is not None else None
+        for seg, segment in enumerate(self.segments):
+            times = self.index[seg][0]
+            if not times:
+                continue
+            if end_us is not None and times[0] > end_us:
+                break
+            if seg + 1 < len(self.segments) and self.index[seg + 1][0] and self.index[seg + 1][0][0] <= start_us:
+                continue
+            buf = self._map(segment)
+            first = self._start_offset(seg, start_us)
+            if msgids is not None:
+                offsets = [o for o in self._msgid_offsets(segment, set(msgids)) if o >= first]
+            else:
+                offsets = None
+            offset = first
+            i = 0
+            while True:
+                if offsets is not None:
+                    if i >= len(offsets):
+                        break
+                    offset = offsets[i]
+                    i += 1
+                if offset + TIMESTAMP.size >= len(buf):
+                    break
+                usec = TIMESTAMP.unpack_from(buf, offset)[0]
+                flen = frame_length(buf, offset + TIMESTAMP.size)
+                if usec == 0 or flen == 0:
+                    break
+                if end_us is not None and usec > end_us:
+                    return
+                if usec >= start_us:
+                    yield usec / 1e6, buf[offset + TIMESTAMP.size : offset + TIMESTAMP.size + flen]
+                if offsets is None:
+                    offset += TIMESTAMP.size + flen
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Seek and filter an indexed telemetry log")
+    parser.add_argument('prefix', help="the log prefix (e.g. /var/log/openhd/20200101-120000)")
+    parser.add_argument('-m', '--msgid', type=int, nargs='*', help="only show these message IDs")
+    parser.add_argument('-s', '--start', type=float, help="the start time (seconds from the start of the log)")
+    parser.add_argument('-e', '--end', type=float, help="the end time (seconds from the start of the log)")
+    args = parser.parse_args()
+
+    reader = TlogReader(args.prefix)
+    if not reader.segments:
+        print("No log segments found matching: " + args.prefix)
+        sys.exit(1)
+    first = next(reader.messages(), None)
+    if first is None:
+        print("No messages found in the log segments matching: " + args.prefix)
+        sys.exit(1)
+    t0 = first[0]
+    start = t0 + args.start if args.start is not None else None
+    end = t0 + args.end if args.end is not None else None
+    for t, frame in reader.messages(args.msgid, start, end):
+        print("%10.3f  msgid: %d  length: %d" % (t - t0, frame_msgid(frame, 0), len(frame)))
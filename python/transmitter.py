@@ -1,28 +1,47 @@
 
+import math
 import time
+import ctypes
+import logging
 import threading
 import socket
-import struct
 
 import sdl2
 
+from openhd import tx_scheduler
+from openhd import rc_frame
+
+# The highest rate that the RC channels will be sent
+MAX_RATE = 250.0
+
+# The SDL events that change the channel values
+CHANGE_EVENTS = (sdl2.SDL_JOYAXISMOTION, sdl2.SDL_JOYBUTTONDOWN, sdl2.SDL_JOYBUTTONUP, sdl2.SDL_JOYHATMOTION)
+
 class Transmitter(object):
     """Read the transmitter stick/switch postions and relay them out over UDP"""
 
-    def __init__(self, channels=16, period=0.02, ip="127.0.0.1", port=14551):
-        """Initialize the joystick class"""
+    def __init__(self, channels=16, period=0.02, ip="127.0.0.1", port=14551, max_rate=MAX_RATE, report_period=10.0):
+        """
+        Initialize the joystick class. The channels are sent as soon as they change (at up to max_rate Hz),
+        and at least every period seconds as a keepalive.
+        """
         self.channels = channels
         self.done = False
-        self.period = period
+        self.period = max(period, 1.0 / MAX_RATE)
+        self.min_interval = 1.0 / min(max_rate, MAX_RATE)
         self.ip = ip
         self.port = port
         self.joystick = None
+        self.report_period = report_period
+        self.seq = 0
+        self.reset_stats()
 
-        # Initialize the SDL joystick module
+        # Initialize the SDL joystick module, and enable the joystick events that drive the send loop
         sdl2.SDL_Init(sdl2.SDL_INIT_JOYSTICK)
+        sdl2.SDL_JoystickEventState(sdl2.SDL_ENABLE)
 
-        # Create the UDP socket
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Send through the transmit scheduler as the highest priority traffic class
+        self.sched = tx_scheduler.get_scheduler()
 
         # Spawn a thread to read the transmitter values
         self.thread = threading.Thread(target = self.start)
@@ -32,6 +51,13 @@ class Transmitter(object):
         self.done = True
         self.thread.join()
 
+    def reset_stats(self):
+        self.keepalives = 0
+        self.changes = 0
+        self.late_sum = 0.0
+        self.late_sum2 = 0.0
+        self.late_max = 0.0
+
     def read(self):
         """Read all the sticks and switches"""
 
@@ -58,19 +84,82 @@ class Transmitter(object):
         return ret
 
     def send(self, channels):
-        """Send the channels using a custom UDP message"""
-        msg = bytes()
-        for ch in channels:
-            msg = msg + struct.pack('<H', ch)
-        self.sock.sendto(msg, (self.ip, self.port))
+        """Send the channels as a sequenced and timestamped RC frame"""
+        self.sched.sendto('rc', rc_frame.pack(self.seq, channels), (self.ip, self.port))
+        self.seq = (self.seq + 1) & 0xffffffff
+
+    def wait_for_change(self, timeout):
+        """Wait up to timeout seconds for joystick events, returning True if any of them changed a channel"""
+        event = sdl2.SDL_Event()
+        if not sdl2.SDL_WaitEventTimeout(ctypes.byref(event), max(0, int(math.ceil(timeout * 1000.0)))):
+            return False
+        changed = False
+        while True:
+            if event.type in CHANGE_EVENTS:
+                changed = True
+            if not sdl2.SDL_PollEvent(ctypes.byref(event)):
+                return changed
 
     def start(self):
-        """Periodically read the transmitter and send the values over UDP"""
+        """
+        Send the transmitter values when they change, and as a keepalive on a fixed schedule of
+        monotonic deadlines, so that the time taken to read and send doesn't add to the period
+        """
+        next_keepalive = time.monotonic()
+        last_send = 0
+        last_channels = None
+        pending = False
+        prev_report = time.monotonic()
         while not self.done:
-            channels = self.read()
-            if channels:
-                self.send(channels)
-            time.sleep(self.period)
+
+            # Wait for the keepalive deadline, a change of the sticks, or the end of the rate limit on changes
+            now = time.monotonic()
+            deadline = next_keepalive
+            if pending:
+                deadline = min(deadline, last_send + self.min_interval)
+            if self.wait_for_change(deadline - now):
+                pending = True
+            now = time.monotonic()
+
+            if now >= next_keepalive:
+
+                # Track how late the keepalive is relative to it's deadline
+                late = now - next_keepalive
+                self.late_sum += late
+                self.late_sum2 += late * late
+                self.late_max = max(self.late_max, late)
+                next_keepalive += self.period
+                if next_keepalive < now:
+                    next_keepalive = now + self.period
+
+                channels = self.read()
+                if channels:
+                    self.send(channels)
+                    self.keepalives += 1
+                    last_channels = channels
+                last_send = now
+                pending = False
+
+            elif pending and (now - last_send) >= self.min_interval:
+                channels = self.read()
+                if channels and channels != last_channels:
+                    self.send(channels)
+                    self.changes += 1
+                    last_channels = channels
+                    last_send = now
+                pending = False
+
+            if (now - prev_report) > self.report_period:
+                self.report()
+                prev_report = now
+
+    def report(self):
+        if self.keepalives > 0:
+            mean = self.late_sum / self.keepalives
+            jitter = math.sqrt(max(0.0, self.late_sum2 / self.keepalives - mean * mean))
+            logging.debug("rc tx: %d keepalives  %d changes  period: %6.2f ms  lateness avg: %6.2f ms  jitter: %6.2f ms  max: %6.2f ms" %
+                          (self.keepalives, self.changes, 1e3 * self.period, 1e3 * mean, 1e3 * jitter, 1e3 * self.late_max))
+        self.reset_stats()
 
     def join(self):
         self.thread.join()
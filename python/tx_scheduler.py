@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import socket
+import logging
+import threading
+import collections
+
+from openhd.format_as_table import format_as_table
+
+# The default traffic classes. Lower priority numbers are sent first in strict mode, the weight is
+# used in weighted mode, and the rate is a cap in bits per second (0 == uncapped).
+# so_priority is the Linux SO_PRIORITY (skb->priority) and dscp is the IP DSCP codepoint, which
+# let the kernel qdisc / wifi driver prioritize the classes across processes as well.
+DEFAULT_CLASSES = {
+    'rc':        { 'priority': 0, 'weight': 4, 'rate': 0, 'so_priority': 6, 'dscp': 46, 'max_queue': 16 },
+    'telemetry': { 'priority': 1, 'weight': 2, 'rate': 0, 'so_priority': 5, 'dscp': 40, 'max_queue': 256 },
+    'video':     { 'priority': 2, 'weight': 1, 'rate': 0, 'so_priority': 4, 'dscp': 34, 'max_queue': 2048 }
+}
+
+class TrafficClass(object):
+    """The queue, rate limiter, socket and statistics for a single class of traffic"""
+
+    def __init__(self, name, priority=0, weight=1, rate=0, so_priority=0, dscp=0, max_queue=1024,
+                 quantum=1500):
+        self.name = name
+        self.priority = priority
+        self.weight = weight
+        self.max_queue = max_queue
+        self.queue = collections.deque()
+
+        # Token bucket rate limiter (bytes and bytes/sec)
+        self.rate = rate / 8.0
+        self.burst = max(self.rate * 0.02, 2 * quantum)
+        self.tokens = self.burst
+        self.last_refill = time.monotonic()
+
+        # The deficit round robin state used in weighted mode
+        self.quantum = weight * quantum
+        self.deficit = 0
+
+        # Create the socket for this class and mark it's priority
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_PRIORITY, so_priority)
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_TOS, dscp << 2)
+        except (OSError, AttributeError) as e:
+            logging.warning("Unable to set the socket priority of the %s traffic class: %s" % (name, e))
+
+        # Statistics
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.packets = 0
+        self.bytes = 0
+        self.drops = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+
+    def refill(self, now):
+        if self.rate > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def can_send(self, size):
+        """
+        A packet that's larger than the burst can be sent once the bucket is full, and the tokens go negative
+        after sending it, so that the average rate is still held
+        """
+        return self.rate <= 0 or self.tokens >= min(size, self.burst)
+
+    def wait_time(self, size):
+        """The time until enough tokens are available to send a packet of the given size"""
+        if self.can_send(size):
+            return 0
+        return (min(size, self.burst) - self.tokens) / self.rate
+
+class TransmitScheduler(object):
+    """
+    Send UDP packets from several traffic classes (video, telemetry, RC) through one set of
+    prioritized queues, so that a large video frame burst doesn't delay the small control packets
+    """
+
+    def __init__(self, classes=DEFAULT_CLASSES, mode='strict', report_period=2.0):
+        if mode not in ('strict', 'weighted'):
+            raise Exception("Unsupported transmit scheduler mode: " + mode)
+        self.mode = mode
+        self.report_period = report_period
+        self.classes = {}
+        for name, params in classes.items():
+            self.classes[name] = TrafficClass(name, **params)
+        self.ordered = sorted(self.classes.values(), key=lambda c: c.priority)
+        self.rr_index = 0
+        self.cond = threading.Condition()
+        self.prev_report = time.monotonic()
+
+        # Start the send thread
+        self.done = False
+        self.thread = threading.Thread(target = self.start, daemon=True)
+        self.thread.start()
+
+    def __del__(self):
+        self.done = True
+
+    def sendto(self, cls, data, addr):
+        """Queue a single packet for transmission. Returns False if it was dropped"""
+        return self.sendto_many(cls, (data,), addr) == 1
+
+    def sendto_many(self, cls, packets, addr):
+        """Queue several packets (e.g. the fragments of a frame) with a single lock acquisition"""
+        tc = self.classes[cls]
+        now = time.monotonic()
+        queued = 0
+        with self.cond:
+            for data in packets:
+                if len(tc.queue) >= tc.max_queue:
+                    tc.drops += 1
+                    continue
+                tc.queue.append((now, data, addr))
+                queued += 1
+            if queued:
+                self.cond.notify()
+        return queued
+
+    def _next_strict(self, now):
+        wait = None
+        for tc in self.ordered:
+            if tc.queue:
+                size = len(tc.queue[0][1])
+                tc.refill(now)
+                if tc.can_send(size):
+                    return tc, 0
+                w = tc.wait_time(size)
+                wait = w if wait is None else min(wait, w)
+        return None, wait
+
+    def _next_weighted(self, now):
+        wait = None
+        nclasses = len(self.ordered)
+        for i in range(2 * nclasses):
+            tc = self.ordered[self.rr_index]
+            if tc.queue:
+                size = len(tc.queue[0][1])
+                tc.refill(now)
+                if not tc.can_send(size):
+                    w = tc.wait_time(size)
+                    wait = w if wait is None else min(wait, w)
+                elif tc.deficit >= size:
+                    return tc, 0
+                else:
+                    tc.deficit += tc.quantum
+                    if tc.deficit >= size:
+                        return tc, 0
+            else:
+                tc.deficit = 0
+            self.rr_index = (self.rr_index + 1) % nclasses
+        return None, wait
+
+    def start(self):
+        while not self.done:
+            with self.cond:
+                now = time.monotonic()
+                if self.mode == 'strict':
+                    tc, wait = self._next_strict(now)
+                else:
+                    tc, wait = self._next_weighted(now)
+                if not tc:
+                    self.cond.wait(wait if wait is not None else self.report_period)
+                    self.report()
+                    continue
+                t, data, addr = tc.queue.popleft()
+                if self.mode == 'weighted':
+                    tc.deficit -= len(data)
+                if tc.rate > 0:
+                    tc.tokens -= len(data)
+
+            # Send outside of the lock so producers are never blocked on the socket
+            try:
+                tc.sock.sendto(data, addr)
+            except OSError as e:
+                tc.drops += 1
+                logging.debug("Error sending %s packet: %s" % (tc.name, e))
+                continue
+            latency = time.monotonic() - t
+            tc.packets += 1
+            tc.bytes += len(data)
+            tc.latency_sum += latency
+            tc.latency_max = max(tc.latency_max, latency)
+            self.report()
+
+    def stats(self):
+        """Return the per-class statistics since the last report"""
+        ret = []
+        dur = max(time.monotonic() - self.prev_report, 1e-6)
+        for tc in self.ordered:
+            ret.append({ 'class': tc.name,
+                         'queued': len(tc.queue),
+                         'packets': tc.packets,
+                         'drops': tc.drops,
+                         'Mbps': "%6.3f" % (8e-6 * tc.bytes / dur),
+                         'avg_ms': "%6.2f" % (1e3 * tc.latency_sum / tc.packets if tc.packets else 0),
+                         'max_ms': "%6.2f" % (1e3 * tc.latency_max) })
+        return ret
+
+    def report(self):
+        now = time.monotonic()
+        if (now - self.prev_report) < self.report_period:
+            return
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            stats = self.stats()
+            keys = list(stats[0].keys())
+            logging.debug(format_as_table(stats, keys, keys, add_newline=True))
+        for tc in self.ordered:
+            tc.reset_stats()
+        self.prev_report = now
+
+
+# The per-process scheduler is created on first use, so that each process (e.g. the camera
+# processes) gets it's own send thread.
+_config = { 'mode': 'strict', 'rates': {} }
+_scheduler = None
+_scheduler_pid = None
+_scheduler_lock = threading.Lock()
+
+def configure(mode='strict', rates=None):
+    """Set the scheduler mode and the per-class rate caps (bits/sec) prior to first use"""
+    _config['mode'] = mode
+    _config['rates'] = dict(rates or {})
+
+def get_scheduler():
+    """Return the transmit scheduler for this process"""
+    global _scheduler, _scheduler_pid
+    with _scheduler_lock:
+        if _scheduler is None or _scheduler_pid != os.getpid():
+            classes = {}
+            for name, params in DEFAULT_CLASSES.items():
+                classes[name] = dict(params)
+                if name in _config['rates']:
+                    classes[name]['rate'] = _config['rates'][name]
+            _scheduler = TransmitScheduler(classes, mode=_config['mode'])
+            _scheduler_pid = os.getpid()
+        return _scheduler
@@ -0,0 +1,182 @@
+from libc.stdlib cimport malloc, calloc, free
+from libc.stdint cimport uint8_t, uint64_t
+from libc.errno cimport errno, EAGAIN, EINTR
+
+cdef extern from '<time.h>':
+    struct timespec:
+        long tv_sec
+        long tv_nsec
+
+cdef extern from '<poll.h>':
+    struct pollfd:
+        int fd
+        short events
+        short revents
+    enum: POLLIN
+    int poll(pollfd *fds, unsigned long nfds, int timeout) nogil
+
+cdef extern from '<sys/socket.h>':
+    ctypedef unsigned int socklen_t
+    struct iovec:
+        void *iov_base
+        size_t iov_len
+    struct msghdr:
+        void *msg_name
+        socklen_t msg_namelen
+        iovec *msg_iov
+        size_t msg_iovlen
+        void *msg_control
+        size_t msg_controllen
+        int msg_flags
+    struct mmsghdr:
+        msghdr msg_hdr
+        unsigned int msg_len
+    struct cmsghdr:
+        size_t cmsg_len
+        int cmsg_level
+        int cmsg_type
+    enum: SOL_SOCKET
+    enum: SO_TIMESTAMPNS
+    enum: SCM_TIMESTAMPNS
+    enum: MSG_DONTWAIT
+    enum: MSG_TRUNC
+    size_t CMSG_SPACE(size_t length)
+    cmsghdr *CMSG_FIRSTHDR(msghdr *msg)
+    cmsghdr *CMSG_NXTHDR(msghdr *msg, cmsghdr *cmsg)
+    unsigned char *CMSG_DATA(cmsghdr *cmsg)
+    int setsockopt(int fd, int level, int optname, const void *optval, socklen_t optlen)
+    int recvmmsg(int fd, mmsghdr *msgvec, unsigned int vlen, int flags, timespec *timeout) nogil
+
+cdef class BatchReceiver:
+    """
+    Receive up to batch datagrams from a UDP socket with each recvmmsg call.
+
+    The datagrams are received into a preallocated arena of batch * max_packet bytes. After each call
+    to recv() the datagrams are available through view() / views(), which are memory views into the arena
+    and are only valid until the next call to recv(). If timestamps is set the kernel receive time
+    (SO_TIMESTAMPNS, seconds since the epoch) of each datagram is available through timestamp().
+    """
+    cdef uint8_t *arena
+    cdef mmsghdr *msgs
+    cdef iovec *iovs
+    cdef uint8_t *control
+    cdef size_t control_len
+    cdef double *stamps
+    cdef int fd
+    cdef object sock
+
+    cdef readonly unsigned int batch
+    cdef readonly size_t max_packet
+    cdef readonly bint timestamps
+    cdef readonly unsigned int count
+    cdef readonly uint64_t calls
+    cdef readonly uint64_t datagrams
+    cdef readonly uint64_t truncated
+
+    def __cinit__(self, sock, unsigned int batch=32, size_t max_packet=2048, bint timestamps=False):
+        cdef int one = 1
+        cdef unsigned int i
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.batch = batch
+        self.max_packet = max_packet
+        self.timestamps = timestamps
+        self.control_len = CMSG_SPACE(sizeof(timespec)) if timestamps else 0
+        self.arena = <uint8_t*>malloc(batch * max_packet)
+        self.msgs = <mmsghdr*>calloc(batch, sizeof(mmsghdr))
+        self.iovs = <iovec*>calloc(batch, sizeof(iovec))
+        self.stamps = <double*>calloc(batch, sizeof(double))
+        self.control = <uint8_t*>calloc(batch, self.control_len) if timestamps else NULL
+        if self.arena == NULL or self.msgs == NULL or self.iovs == NULL or self.stamps == NULL or \
+           (timestamps and self.control == NULL):
+            raise MemoryError()
+        for i in range(batch):
+            self.iovs[i].iov_base = self.arena + i * max_packet
+            self.iovs[i].iov_len = max_packet
+            self.msgs[i].msg_hdr.msg_iov = &self.iovs[i]
+            self.msgs[i].msg_hdr.msg_iovlen = 1
+        if timestamps and setsockopt(self.fd, SOL_SOCKET, SO_TIMESTAMPNS, &one, sizeof(one)) != 0:
+            raise OSError(errno, "Unable to enable SO_TIMESTAMPNS")
+        self.count = 0
+
+    def __dealloc__(self):
+        free(self.arena)
+        free(self.msgs)
+        free(self.iovs)
+        free(self.stamps)
+        free(self.control)
+
+    def recv(self, double timeout=-1):
+        """
+        Wait up to timeout seconds (forever if negative) for datagrams, and receive as many as are
+        available (up to batch). Returns the number of datagrams received, which is 0 on a timeout.
+        """
+        cdef pollfd pfd
+        cdef int ret
+        cdef int ms = -1 if timeout < 0 else <int>(timeout * 1000.0 + 0.999)
+        cdef unsigned int i
+        cdef cmsghdr *cmsg
+        cdef timespec *ts
+
+        # Reset the control buffer lengths, which the kernel shrinks to the length it used
+        if self.control:
+            for i in range(self.count if self.calls else self.batch):
+                self.msgs[i].msg_hdr.msg_control = self.control + i * self.control_len
+                self.msgs[i].msg_hdr.msg_controllen = self.control_len
+        self.count = 0
+
+        pfd.fd = self.fd
+        pfd.events = POLLIN
+        with nogil:
+            ret = poll(&pfd, 1, ms)
+            if ret > 0:
+                ret = recvmmsg(self.fd, self.msgs, self.batch, MSG_DONTWAIT, NULL)
+        self.calls += 1
+        if ret < 0:
+            if errno == EAGAIN or errno == EINTR:
+                return 0
+            raise OSError(errno, "recvmmsg failed")
+        self.count = ret
+        self.datagrams += ret
+
+        for i in range(self.count):
+            if self.msgs[i].msg_hdr.msg_flags & MSG_TRUNC:
+                self.truncated += 1
+            self.stamps[i] = 0
+            if self.control:
+                cmsg = CMSG_FIRSTHDR(&self.msgs[i].msg_hdr)
+                while cmsg != NULL:
+                    if cmsg.cmsg_level == SOL_SOCKET and cmsg.cmsg_type == SCM_TIMESTAMPNS:
+                        ts = <timespec*>CMSG_DATA(cmsg)
+                        self.stamps[i] = ts.tv_sec + 1e-9 * ts.tv_nsec
+                    cmsg = CMSG_NXTHDR(&self.msgs[i].msg_hdr, cmsg)
+        return self.count
+
+    cdef inline size_t length_of(self, unsigned int i):
+        return min(self.msgs[i].msg_len, self.max_packet)
+
+    def length(self, unsigned int i):
+        """The length of the i'th datagram of the last batch"""
+        if i >= self.count:
+            raise IndexError("datagram index out of range")
+        return self.length_of(i)
+
+    def timestamp(self, unsigned int i):
+        """The kernel receive time of the i'th datagram of the last batch (0 if timestamps are disabled)"""
+        if i >= self.count:
+            raise IndexError("datagram index out of range")
+        return self.stamps[i]
+
+    def view(self, unsigned int i):
+        """A view of the i'th datagram of the last batch"""
+        cdef size_t n
+        if i >= self.count:
+            raise IndexError("datagram index out of range")
+        n = self.length_of(i)
+        if n == 0:
+            return memoryview(b'')
+        return memoryview(<uint8_t[:n]>(self.arena + i * self.max_packet))
+
+    def views(self):
+        """Views of all the datagrams of the last batch"""
+        return [self.view(i) for i in range(self.count)]
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+import struct
+
+# Each video packet carries one fragment of an encoded frame (access unit) behind a small header.
+#   header: magic, version, flags, frame sequence number, fragment index, fragment count
+HEADER = struct.Struct('<2sBBIHH')
+MAGIC = b'HV'
+VERSION = 1
+
+def fragment(frame, data, maxpacket):
+    """Split a frame into packets of at most maxpacket bytes (including the header)"""
+    size = maxpacket - HEADER.size
+    count = max(1, (len(data) + size - 1) // size)
+    frame &= 0xffffffff
+    return [HEADER.pack(MAGIC, VERSION, 0, frame, i, count) + data[i * size : (i + 1) * size] for i in range(count)]
+
+def parse(packet):
+    """Return (frame, fragment, count) of a video packet, or None if it doesn't have a video header"""
+    if len(packet) < HEADER.size or packet[0:2] != MAGIC:
+        return None
+    magic, version, flags, frame, index, count = HEADER.unpack_from(packet)
+    if version != VERSION or index >= count:
+        return None
+    return frame, index, count
+
+def seq_diff(seq, prev):
+    """The signed difference between two 32 bit frame sequence numbers, allowing for wrap around"""
+    diff = (seq - prev) & 0xffffffff
+    return diff - 0x100000000 if diff & 0x80000000 else diff
+
+# A keyframe request sent from the ground to the air side:
+#   magic, version, reason, the last frame sequence number that was written to the player
+KEYFRAME_REQUEST = struct.Struct('<2sBBI')
+KEYFRAME_MAGIC = b'HK'
+
+# Keyframe request reasons
+REASON_START = 0
+REASON_LOST_FRAME = 1
+
+def keyframe_request(frame, reason):
+    return KEYFRAME_REQUEST.pack(KEYFRAME_MAGIC, VERSION, reason, frame & 0xffffffff)
+
+def parse_keyframe_request(data):
+    """Return (reason, frame) of a keyframe request, or None if it isn't one"""
+    if len(data) != KEYFRAME_REQUEST.size:
+        return None
+    magic, version, reason, frame = KEYFRAME_REQUEST.unpack(data)
+    if magic != KEYFRAME_MAGIC or version != VERSION:
+        return None
+    return reason, frame
@@ -1,16 +1,310 @@
 #!/usr/bin/env python3
 
 import os
+import time
+import fcntl
+import select
+import socket
+import logging
 import threading
 import subprocess as sp
 
+from openhd import udp_batch
+from openhd import packet_trace
+from openhd import video_packet
+from openhd import diversity
+from openhd import dvr
+from openhd import h264
+from openhd import tx_scheduler
+
+# The size to grow the player pipe to, so that it holds several whole frames
+PIPE_SIZE = 1048576
+
+# The number of packets received with each call, and the largest packet
+RECV_BATCH = 32
+MAX_PACKET = 8192
+
+# A jump in the frame sequence numbers larger than this is taken as a restart of the air side
+FRAME_RESYNC = 1000
+
+class PendingFrame(object):
+    """The fragments of a frame that is being reassembled"""
+    __slots__ = ('fragments', 'received', 'first_time')
+
+    def __init__(self, count, now):
+        self.fragments = [None] * count
+        self.received = 0
+        self.first_time = now
+
+    def complete(self):
+        return self.received == len(self.fragments)
+
+class VideoReceiver(object):
+    """
+    Receive the video packets, reassemble them into frames in sequence order, and write each complete
+    frame to the player with a single write.
+
+    Frames are held in a small jitter buffer while they're incomplete or a frame before them is missing.
+    The buffer delay adapts to the observed reassembly and reordering delay (between min_delay and
+    max_delay seconds), after which the missing frame is dropped. Packets without a video header (e.g.
+    FEC blocks) are passed straight through.
+
+    The same stream can also be received on diversity_ports (e.g. from additional wifi adapters), in which
+    case the first copy of each packet is used and the rest are dropped. The complete frames are also
+    passed to the (optional) DVR writer.
+
+    If keyframe_addr is set, a keyframe is requested from the air side (at most every keyframe_interval
+    seconds) when receiving starts and after a frame is dropped, until a keyframe is received. Keyframes
+    can't be detected in packets that are passed through, so the requests stop if any are received.
+    """
+
+    def __init__(self, port, out_fd, min_delay=0.002, max_delay=0.05, trace_dir=None, report_period=10.0,
+                 diversity_ports=(), dvr=None, keyframe_addr=None, keyframe_interval=0.25):
+        self.port = port
+        self.dvr = dvr
+        self.keyframe_addr = keyframe_addr
+        self.keyframe_interval = keyframe_interval
+        self.need_keyframe = keyframe_addr is not None
+        self.keyframe_reason = video_packet.REASON_START
+        self.last_request = 0
+        self.out_fd = out_fd
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.report_period = report_period
+        self.done = False
+        self.pending = {}
+        self.next_frame = None
+        self.newest_frame = None
+        self.jitter = 0.0
+        self.delay = max_delay
+        self.prev_calls = 0
+        self.trace = packet_trace.open_trace(trace_dir, 'ground', port)
+        self.reset_stats()
+
+        # Grow the pipe so that the writes of whole frames don't block on the pipe buffer
+        try:
+            fcntl.fcntl(out_fd, getattr(fcntl, 'F_SETPIPE_SZ', 1031), PIPE_SIZE)
+        except OSError as e:
+            logging.debug("Unable to set the video pipe size: " + str(e))
+
+        # Receive the packets in batches on each port, with the kernel receive time of each one
+        ports = [port] + [p for p in diversity_ports if p != port]
+        self.receivers = []
+        self.fds = {}
+        self.poll = select.poll()
+        for p in ports:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(('', p))
+            self.poll.register(sock.fileno(), select.POLLIN)
+            self.fds[sock.fileno()] = len(self.receivers)
+            self.receivers.append(udp_batch.BatchReceiver(sock, RECV_BATCH, MAX_PACKET, timestamps=True))
+        self.combiner = diversity.DiversityCombiner(["port %d" % p for p in ports], resync=FRAME_RESYNC)
+
+        self.thread = threading.Thread(target = self.start)
+        self.thread.start()
+
+    def reset_stats(self):
+        self.packets = 0
+        self.frames = 0
+        self.bytes = 0
+        self.late = 0
+        self.dropped = 0
+        self.keyframe_requests = 0
+        self.duplicates = 0
+        self.passthrough = 0
+
+    def join(self):
+        self.thread.join()
+
+    def start(self):
+        prev_report = time.monotonic()
+        while not self.done:
+
+            # Wait for the next packets, or until the frame at the head of the buffer has to be dropped
+            deadline = self.deadline()
+            if deadline is None:
+                timeout = self.report_period
+            else:
+                timeout = max(0.0, deadline - time.monotonic())
+            try:
+                ready = self.wait(timeout)
+            except OSError as e:
+                logging.warning("Error receiving video: " + str(e))
+                break
+
+            # Convert the kernel receive times to the monotonic clock
+            now = time.monotonic()
+            offset = time.time() - now
+            for iface in ready:
+                receiver = self.receivers[iface]
+                for i in range(receiver.count):
+                    stamp = receiver.timestamp(i)
+                    self.receive(iface, receiver.view(i), min(stamp - offset, now) if stamp else now)
+            self.flush(now)
+            if self.need_keyframe and (now - self.last_request) >= self.keyframe_interval:
+                self.request_keyframe(now)
+
+            if (now - prev_report) > self.report_period:
+                self.report(now - prev_report)
+                prev_report = now
+
+    def wait(self, timeout):
+        """Wait for packets, and return the indexes of the receivers that received some"""
+        if len(self.receivers) == 1:
+            return [0] if self.receivers[0].recv(timeout) else []
+        ready = []
+        for fd, event in self.poll.poll(int(timeout * 1000.0 + 0.999)):
+            iface = self.fds[fd]
+            if self.receivers[iface].recv(0):
+                ready.append(iface)
+        return ready
+
+    def receive(self, iface, packet, now):
+        """Add a packet to the frame it belongs to"""
+        self.packets += 1
+        header = video_packet.parse(packet)
+        if header is None:
+            if not self.combiner.accept_unframed(iface, packet, now):
+                self.duplicates += 1
+                return
+            self.passthrough += 1
+            if self.keyframe_addr:
+                logging.info("Video port %d is receiving unframed (e.g. FEC) packets, so not requesting keyframes" % self.port)
+                self.keyframe_addr = None
+                self.need_keyframe = False
+            self.write(packet)
+            return
+        frame, index, count = header
+        if not self.combiner.accept(iface, self.port, frame, index):
+            self.duplicates += 1
+            return
+        if self.trace:
+            self.trace.record(self.port, frame, index, len(packet))
+
+        # Start with the first frame seen, and start over if the air side restarts
+        if self.next_frame is None or abs(video_packet.seq_diff(frame, self.next_frame)) > FRAME_RESYNC:
+            if self.next_frame is not None:
+                logging.info("Video frame sequence jumped from %d to %d, resynchronizing" % (self.next_frame, frame))
+            self.pending.clear()
+            self.next_frame = frame
+            self.newest_frame = frame
+
+        # Frames that have already been written or dropped are late
+        if video_packet.seq_diff(frame, self.next_frame) < 0:
+            self.late += 1
+            return
+
+        # Reordering delays the frames behind this one, so the buffer has to cover it
+        if video_packet.seq_diff(frame, self.newest_frame) > 0:
+            self.newest_frame = frame
+        elif frame != self.newest_frame and self.newest_frame in self.pending:
+            self.adapt(now - self.pending[self.newest_frame].first_time)
+
+        pending = self.pending.get(frame)
+        if pending is None:
+            pending = self.pending[frame] = PendingFrame(count, now)
+        if index < len(pending.fragments) and pending.fragments[index] is None:
+            pending.fragments[index] = bytes(packet[video_packet.HEADER.size:])
+            pending.received += 1
+            if pending.complete():
+                self.adapt(now - pending.first_time)
+
+    def adapt(self, sample):
+        """Track the reassembly / reordering delay, rising quickly and decaying slowly"""
+        if sample > self.jitter:
+            self.jitter = sample
+        else:
+            self.jitter += 0.01 * (sample - self.jitter)
+        self.delay = min(self.max_delay, max(self.min_delay, 2.0 * self.jitter))
+
+    def deadline(self):
+        """The time at which the frame at the head of the buffer is dropped if it's still incomplete"""
+        if not self.pending:
+            return None
+        head = self.pending.get(self.next_frame)
+        if head is not None:
+            return head.first_time + self.delay
+        return min(p.first_time for p in self.pending.values()) + self.delay
+
+    def flush(self, now):
+        """Write the complete frames at the head of the buffer, dropping the head frame if it's overdue"""
+        while self.pending:
+            head = self.pending.get(self.next_frame)
+            if head is not None and head.complete():
+                del self.pending[self.next_frame]
+                data = b''.join(head.fragments)
+                self.write(data)
+                if self.dvr:
+                    self.dvr.write(data)
+                self.frames += 1
+                if self.need_keyframe and (h264.frame_flags(data) & h264.FLAG_KEYFRAME):
+                    self.need_keyframe = False
+            elif now >= self.deadline():
+                if head is not None:
+                    del self.pending[self.next_frame]
+                self.dropped += 1
+
+                # The frames that reference the dropped frame can't be decoded until the next keyframe
+                if self.keyframe_addr and not self.need_keyframe:
+                    self.need_keyframe = True
+                    self.keyframe_reason = video_packet.REASON_LOST_FRAME
+            else:
+                break
+            self.next_frame = (self.next_frame + 1) & 0xffffffff
+
+    def request_keyframe(self, now):
+        last_frame = (self.next_frame - 1) & 0xffffffff if self.next_frame is not None else 0
+        try:
+            tx_scheduler.get_scheduler().sendto('telemetry', video_packet.keyframe_request(last_frame, self.keyframe_reason),
+                                                self.keyframe_addr)
+        except OSError as e:
+            logging.debug("Error sending a keyframe request: " + str(e))
+        self.last_request = now
+        self.keyframe_requests += 1
+
+    def write(self, data):
+        self.bytes += len(data)
+        view = memoryview(data)
+        while view:
+            try:
+                written = os.write(self.out_fd, view)
+            except OSError as e:
+                logging.warning("Error writing to the video player: " + str(e))
+                self.done = True
+                return
+            view = view[written:]
+
+    def report(self, dur):
+        total_calls = sum(r.calls for r in self.receivers)
+        calls = total_calls - self.prev_calls
+        self.prev_calls = total_calls
+        logging.debug("video port: %d  packets: %d  frames: %d  late: %d  dropped: %d  keyframe requests: %d  duplicates: %d  passthrough: %d  Mbps: %6.3f  delay: %5.1f ms  packets/call: %4.1f  truncated: %d" %
+                      (self.port, self.packets, self.frames, self.late, self.dropped, self.keyframe_requests, self.duplicates, self.passthrough,
+                       8e-6 * self.bytes / dur, 1e3 * self.delay, self.packets / max(1, calls),
+                       sum(r.truncated for r in self.receivers)))
+        self.combiner.report()
+        self.reset_stats()
+
 class VideoPlayer(object):
     '''Constrols the ground-side video player / OSD'''
     video_player="/home/pi/wifibroadcast-hello_video/hello_video.bin.48-mm"
     osd_program="/usr/local/bin/QOpenHD"
 
-    def __init__(self):
+    def __init__(self, port=5600, max_delay=0.05, trace_dir=None, diversity_ports=(), dvr_dir=None,
+                 dvr_segment_size=256 * 1024 * 1024, dvr_segment_time=300.0, dvr_max_queue=16 * 1024 * 1024,
+                 keyframe_addr=None, keyframe_interval=0.25):
         self.done = False;
+        self.port = port
+        self.keyframe_addr = keyframe_addr
+        self.keyframe_interval = keyframe_interval
+        self.diversity_ports = diversity_ports
+        self.dvr_dir = dvr_dir
+        self.dvr_segment_size = dvr_segment_size
+        self.dvr_segment_time = dvr_segment_time
+        self.dvr_max_queue = dvr_max_queue
+        self.max_delay = max_delay
+        self.trace_dir = trace_dir
+        self.receiver = None
         if os.path.isfile(self.video_player) and os.access(self.video_player, os.X_OK) and \
            os.path.isfile(self.osd_program) and os.access(self.osd_program, os.X_OK):
             self.video_thread = threading.Thread(target = self.start_video)
@@ -26,7 +320,15 @@ class VideoPlayer(object):
         self.join()
 
     def running(self):
-        return self.video_thread or self.osd_thread
+        return any(t and t.is_alive() for t in (self.video_thread, self.osd_thread))
+
+    def update(self, max_delay, keyframe_interval):
+        """Change the maximum reassembly delay and the keyframe request interval while receiving"""
+        self.max_delay = max_delay
+        self.keyframe_interval = keyframe_interval
+        if self.receiver:
+            self.receiver.max_delay = max_delay
+            self.receiver.keyframe_interval = keyframe_interval
 
     def join(self):
         if self.video_thread:
@@ -35,9 +337,24 @@ class VideoPlayer(object):
             self.osd_thread.join()
 
     def start_video(self):
-        nc = sp.Popen(["/bin/nc", "-l", "-u", "5600"], stdout=sp.PIPE)
-        hv = sp.Popen([self.video_player], stdin=nc.stdout)
+        hv = sp.Popen([self.video_player], stdin=sp.PIPE)
+
+        # Record the received video on the ground if requested
+        recorder = None
+        if self.dvr_dir:
+            try:
+                recorder = dvr.DVRWriter(self.dvr_dir, self.dvr_segment_size, self.dvr_segment_time, self.dvr_max_queue)
+            except OSError as e:
+                logging.warning("Unable to record video to %s: %s" % (self.dvr_dir, e))
+
+        self.receiver = VideoReceiver(self.port, hv.stdin.fileno(), max_delay=self.max_delay, trace_dir=self.trace_dir,
+                                      diversity_ports=self.diversity_ports, dvr=recorder,
+                                      keyframe_addr=self.keyframe_addr, keyframe_interval=self.keyframe_interval)
         hv.wait()
+        self.receiver.done = True
+        if recorder:
+            self.receiver.join()
+            recorder.close()
 
     def start_osd(self):
         qopenhd = sp.run(self.osd_program)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+# Compare the cost of decoding MSP responses with the precompiled struct codecs against the
+# original field at a time decoders of the MultiWii getters.
+
+import sys
+import struct
+import timeit
+import argparse
+
+from openhd.MultiWii import MultiWii
+
+class LegacyDecoders(MultiWii):
+    """The original getter decoders, which unpack each field through _toInt16 / _toUInt16 / etc."""
+
+    def attitude(self, rdata):
+        angx = self._toInt16(rdata[0:2]) / 10.0
+        angy = self._toInt16(rdata[2:4]) / 10.0
+        heading = self._toInt16(rdata[4:6]) - 180
+        return {"angx":angx, "angy":angy, "heading":heading}
+
+    def imu(self, rdata):
+        v = [self._toInt16(rdata[i:i+2]) for i in range(0, 18, 2)]
+        return {"accx":v[0], "accy":v[1], "accz":v[2], "gyrx":v[3], "gyry":v[4], "gyrz":v[5],
+                "magx":v[6], "magy":v[7], "magz":v[8]}
+
+    def analog(self, rdata):
+        return {"vbat":rdata[0], "powermetersum":self._toUInt16(rdata[1:3]),
+                "rssi":self._toUInt16(rdata[3:5]), "amperage":self._toUInt16(rdata[5:7])}
+
+    def gps(self, rdata):
+        return {"fix":rdata[0] == 1, "numsat":rdata[1], "latitude":self._toUInt32(rdata[2:6]),
+                "longitude":self._toUInt32(rdata[6:10]), "altitude":self._toUInt16(rdata[10:12]),
+                "speed":self._toUInt16(rdata[12:14]), "course":self._toUInt16(rdata[14:16])}
+
+    def status(self, rdata):
+        return {"cycletime":self._toUInt16(rdata[0:2]), "i2cerrorcount":self._toUInt16(rdata[2:4]),
+                "sensor":self._toUInt16(rdata[4:6]), "flag":self._toUInt32(rdata[6:10]), "currentset":rdata[10]}
+
+    def rc(self, rdata):
+        v = [self._toUInt16(rdata[i:i+2]) for i in range(0, 16, 2)]
+        return {"pitch":v[0], "roll":v[1], "yaw":v[2], "throttle":v[3], "aux1":v[4], "aux2":v[5],
+                "aux3":v[6], "aux4":v[7]}
+
+    def misc(self, rdata):
+        return {"powertrigger":self._toUInt16(rdata[0:2]), "minthrottle":self._toUInt16(rdata[2:4]),
+                "maxthrottle":self._toUInt16(rdata[4:6]), "mincommand":self._toUInt16(rdata[6:8]),
+                "failsafethrottle":self._toUInt16(rdata[8:10]), "armedtime":self._toUInt16(rdata[10:12]),
+                "uptime":self._toUInt32(rdata[12:16]), "magdeclination":self._toUInt16(rdata[16:18]),
+                "vbatscale":rdata[18], "vbatwarn1":rdata[19], "vbatwarn2":rdata[20], "vbatcrit":rdata[21]}
+
+# The message name, a sample payload, the legacy decoder and the codec decoder
+MESSAGES = [
+    ("MSP_ATTITUDE", struct.pack("<hhh", 123, -45, 270), "attitude", "_decodeAttitude"),
+    ("MSP_RAW_IMU", struct.pack("<9h", *range(9)), "imu", "_decodeIMU"),
+    ("MSP_ANALOG", struct.pack("<BHHH", 120, 1000, 512, 1500), "analog", "_decodeAnalog"),
+    ("MSP_RAW_GPS", struct.pack("<BBiiHHH", 1, 12, 473977419, 85455939, 500, 1200, 900), "gps", "_decodeGPS"),
+    ("MSP_STATUS", struct.pack("<HHHIB", 3500, 0, 0x27, 5, 0), "status", "_decodeStatus"),
+    ("MSP_MISC", bytes(range(22)), "misc", "_decodeMisc"),
+    ("MSP_RC", struct.pack("<8H", *range(1000, 1800, 100)), "rc", "_decodeRC"),
+    ("MSP_RC (18 ch)", struct.pack("<18H", *range(1000, 1900, 50)), "rc", "_decodeRC"),
+]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the MSP response decoders")
+    parser.add_argument('-n', '--number', type=int, default=20000, help="decodes per measurement")
+    args = parser.parse_args()
+
+    legacy = LegacyDecoders()
+    mw = MultiWii()
+    print("%-14s %12s %12s %8s" % ("message", "legacy (us)", "codec (us)", "speedup"))
+    for name, payload, old, new in MESSAGES:
+        rdata = bytearray(payload)
+        old_fn = getattr(legacy, old)
+        new_fn = getattr(mw, new)
+
+        # Make sure that both decoders agree before timing them
+        a = old_fn(rdata)
+        b = new_fn(rdata)
+        for key in a:
+            if name != "MSP_RAW_GPS" and a[key] != b[key]:
+                sys.stderr.write("%s: %s differs (%r != %r)\n" % (name, key, a[key], b[key]))
+                sys.exit(1)
+
+        t_old = min(timeit.repeat(lambda: old_fn(rdata), number=args.number, repeat=3)) / args.number
+        t_new = min(timeit.repeat(lambda: new_fn(rdata), number=args.number, repeat=3)) / args.number
+        print("%-14s %12.2f %12.2f %7.1fx" % (name, t_old * 1e6, t_new * 1e6, t_old / t_new))
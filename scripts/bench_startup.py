@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+# Measure how long openhd_controller takes to start: the time to import the modules that each role
+# loads, and the time from launching the controller to the first video packet that it sends (air)
+# or receives (ground). Exits with an error if the first packet takes longer than --max seconds, so
+# that it can be used as a regression check.
+
+import os
+import sys
+import time
+import signal
+import socket
+import argparse
+import statistics
+import subprocess
+
+# The openhd modules that are imported by each role
+ROLES = {
+    'common': ['tx_scheduler', 'format_as_table'],
+    'air': ['camera', 'telemetry'],
+    'ground': ['video_player'],
+}
+
+def import_time(module, python):
+    """The time (seconds) to import an openhd module in a fresh interpreter"""
+    code = "import time; t = time.monotonic(); import openhd.%s; print(time.monotonic() - t)" % module
+    out = subprocess.run([python, '-c', code], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if out.returncode != 0:
+        return None
+    return float(out.stdout)
+
+def first_packet_time(controller, config, port, timeout):
+    """The time (seconds) from launching the controller to the first packet on the video port, or None"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('', port))
+    sock.settimeout(timeout)
+    start = time.monotonic()
+    proc = subprocess.Popen([controller, config], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                            start_new_session=True)
+    try:
+        sock.recv(65536)
+        return time.monotonic() - start
+    except socket.timeout:
+        return None
+    finally:
+        sock.close()
+
+        # Stop the controller and the camera processes that it started
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        proc.wait()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the openhd_controller startup")
+    parser.add_argument('config', nargs='?', help="the controller config file (only the imports are timed if not given)")
+    parser.add_argument('-c', '--controller', default='openhd_controller', help="the controller executable")
+    parser.add_argument('-p', '--port', type=int, default=5600, help="the video port")
+    parser.add_argument('-n', '--runs', type=int, default=3, help="the number of measurements")
+    parser.add_argument('-t', '--timeout', type=float, default=30.0, help="the maximum time to wait for a packet (seconds)")
+    parser.add_argument('-m', '--max', type=float, default=0, help="fail if the median time to the first packet exceeds this (seconds)")
+    args = parser.parse_args()
+
+    # Time the imports of each role
+    print("%-8s %-16s %10s" % ("role", "module", "import (ms)"))
+    for role, modules in ROLES.items():
+        for module in modules:
+            times = [import_time(module, sys.executable) for i in range(args.runs)]
+            if None in times:
+                print("%-8s %-16s %10s" % (role, module, "failed"))
+            else:
+                print("%-8s %-16s %10.1f" % (role, module, min(times) * 1000.0))
+    if not args.config:
+        sys.exit(0)
+
+    # Time the launch to the first video packet
+    times = []
+    for i in range(args.runs):
+        t = first_packet_time(args.controller, args.config, args.port, args.timeout)
+        if t is None:
+            print("No video packet received within %.1f seconds" % args.timeout)
+            sys.exit(1)
+        times.append(t)
+    median = statistics.median(times)
+    print("first video packet: median %.3f s  min %.3f s  max %.3f s" % (median, min(times), max(times)))
+    if args.max and median > args.max:
+        print("The first video packet took longer than %.3f s" % args.max)
+        sys.exit(1)
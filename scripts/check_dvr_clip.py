@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+
+# Check that the clips extracted from a DVR segment can be decoded on their own: record a synthetic stream
+# with separate SPS/PPS frames, keyframes with and without preceding parameter sets, and P frames, then
+# extract a clip at every frame time and check that each one begins with an SPS followed by a keyframe.
+
+import io
+import sys
+import tempfile
+
+from openhd import h264
+from openhd import dvr
+
+def nal(nal_type, size=32):
+    return b'\x00\x00\x00\x01' + bytes([0x60 | nal_type]) + bytes(size)
+
+HEADERS = nal(h264.NAL_SPS, 8) + nal(h264.NAL_PPS, 4)
+KEYFRAME = nal(h264.NAL_IDR, 512)
+PFRAME = nal(h264.NAL_SLICE, 64)
+
+# Headers only at the start, headers in a separate frame before a keyframe, and a keyframe without headers
+STREAM = [HEADERS, KEYFRAME] + [PFRAME] * 9 + [HEADERS, KEYFRAME] + [PFRAME] * 9 + [KEYFRAME] + [PFRAME] * 9
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as directory:
+        writer = dvr.DVRWriter(directory)
+        t0 = 1600000000.0
+        for i, frame in enumerate(STREAM):
+            writer.write(frame, t0 + i * 0.1)
+        writer.close()
+        segment = writer.prefix + '_0000.h264'
+        index = dvr.read_index(segment)
+
+        failed = 0
+        for e in index:
+            clip = io.BytesIO()
+            dvr.extract(segment, index, e[1] / 1e6, clip)
+            units = [u[0] for u in h264.nal_units(clip.getvalue(), limit=len(clip.getvalue()))]
+            if units[:3] != [h264.NAL_SPS, h264.NAL_PPS, h264.NAL_IDR]:
+                print("The clip at %.1f s starts with the NAL units %s" % (e[1] / 1e6 - t0, units[:3]))
+                failed += 1
+        print("%d clips checked, %d failed" % (len(index), failed))
+        sys.exit(1 if failed else 0)